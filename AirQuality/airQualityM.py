@@ -1,31 +1,113 @@
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager, nullcontext
+import queue
+import threading
+import time
+import uuid
 import requests
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 from bs4 import BeautifulSoup
 import os
 from sqlDataParser import DataParser
+from loadManifest import LoadManifest
+from sourceLoader import SourceStore, defaultSourceStore
+from metrics import RunMetrics, defaultRunMetrics, fileRecord, addFiltered, peakRssMB, profiled, stageCounter, attachStage
+from AirQuality.parquetReader import iterMeasurementBatches, MEASUREMENT_COLUMNS
+from AirQuality.dailyAggregation import DailyAggregator, buildAirMeasurements
+from AirQuality.eeaClient import EEAClient
+from AirQuality.catalogCache import CatalogCache
+from AirQuality.partitions import partitionYears, routeByYear
+from AirQuality.monthlyRollup import monthlyPartials, upsertMonthlyRollup
+from AirQuality.streamingIngest import STREAM_CHUNK_SIZE, downloadPath, fetchToSpool, folderBytes, keepCopy
+from AirQuality.compaction import COMPACTED_COLUMNS, COMPACTED_KEYS, COMPACTED_TABLE, compactDownloads, cityKey, resolveCityIds
+from dimensionRegistry import DimensionRegistry
+from workLease import WorkLeases
+from taskGraph import POOL_CONTEXT
+from frameSchema import MemoryBudget, defaultMemoryBudget, compactTable, parquetBytesPerRow
+
+#parser of the current worker process, created once by initParseWorker and reused for every file
+workerDataParser = None
+workerLoadManifest = None
+#years with an airMeasurement partition, rows are copied into their partition directly
+workerPartitionYears = frozenset()
+#measure unit and chemical codes of the database handed out by the dimension registry
+workerKnownUnits = None
+workerKnownChemicals = None
+#share of the memory budget of one worker, sizes the parquet batches and COPY chunks
+workerMemoryBudget = defaultMemoryBudget
+#http session of the current worker and bytes of streamed files it kept on disk per streaming run
+workerHttpSession = None
+workerKeptBytes = {}
+
+def initParseWorker(db_params,connectionsPerWorker,partitionYears=frozenset(),knownUnits=None,knownChemicals=None,memoryBudget=defaultMemoryBudget):
+    """
+    Initializer of the parse process pool, builds one pooled engine per worker process.
+    """
+    global workerDataParser, workerLoadManifest, workerPartitionYears, workerKnownUnits, workerKnownChemicals, workerMemoryBudget
+    workerDataParser = DataParser.fromParams(db_params,poolSize=connectionsPerWorker,maxOverflow=0,testConnection=False,memoryBudget=memoryBudget)
+    workerLoadManifest = LoadManifest(workerDataParser)
+    workerPartitionYears = frozenset(partitionYears)
+    workerKnownUnits = knownUnits
+    workerKnownChemicals = knownChemicals
+    workerMemoryBudget = memoryBudget
+
+def shareParseWorker(dataParser,partitionYears=frozenset(),knownUnits=None,knownChemicals=None,memoryBudget=defaultMemoryBudget,stage=None):
+    """
+    Initializer of the parse thread pool used for embedded databases, every thread shares the parser of the main process.
+
+    :param stage: counter of the stage starting the pool, the rows loaded by the thread count towards it
+    """
+    attachStage(stage)
+    global workerDataParser, workerLoadManifest, workerPartitionYears, workerKnownUnits, workerKnownChemicals, workerMemoryBudget
+    workerDataParser = dataParser
+    workerLoadManifest = LoadManifest(dataParser)
+    workerPartitionYears = frozenset(partitionYears)
+    workerKnownUnits = knownUnits
+    workerKnownChemicals = knownChemicals
+    workerMemoryBudget = memoryBudget
 
 class AirQualityData():
     """
     Class Responsible for parsing Air Quality data.
     """
-    def __init__(self,dataParser:DataParser,db_params):
+    def __init__(self,dataParser:DataParser,db_params,maxConnections:int=8,eeaClient:EEAClient=None,catalogCache:CatalogCache=None,sourceStore:SourceStore=defaultSourceStore,metrics:RunMetrics=defaultRunMetrics,dimensions:DimensionRegistry=None,memoryBudget:MemoryBudget=defaultMemoryBudget):
+        """
+        :param maxConnections: upper bound of database connections opened by all parse workers together
+        :param eeaClient: client for the EEA download api, a default client is created if not given
+        :param catalogCache: cache of the city listing and url manifests, a default cache is created if not given
+        :param sourceStore: memoized store of the vocabulary csv files
+        :param metrics: collects the metrics of every parsed parquet file
+        :param dimensions: registry of the dimension keys shared with the other loaders, a registry is created if not given
+        :param memoryBudget: memory of all parse workers together, every worker sizes its batches from its share
+        """
         self.db_params = db_params
+        self.maxConnections = maxConnections
+        self.eeaClient = eeaClient if eeaClient is not None else EEAClient()
+        self.catalogCache = catalogCache if catalogCache is not None else CatalogCache()
+        self.catalogLock = threading.Lock()
+        self.loadManifest = LoadManifest(dataParser)
+        self.sourceStore = sourceStore
+        self.metrics = metrics
+        self.memoryBudget = memoryBudget
+        self.dimensions = dimensions if dimensions is not None else DimensionRegistry(dataParser)
+        #parse pool and download threads kept open by sharedPools, every load inside it reuses them
+        self.sharedParsePool = None
+        self.sharedDownloader = None
         #We need a pollutant mapping from type to notation
-        pollutant = pd.read_csv(os.path.join("AirQuality","chemicalVocabulary.csv"))
+        pollutant = sourceStore.load("chemicalVocabulary")
         pollutant = pollutant[["chemicalID","chemicalCode"]]
-        pollutant["chemicalID"] = pollutant["chemicalID"].astype(int)
         self.pollutantMapNotation = pollutant.set_index("chemicalID")["chemicalCode"].to_dict() 
         #We need a pollutant mapping from type to recommended unit notation for empty unit data
-        chemUnitMap = pd.read_csv(os.path.join("AirQuality","chemicalUnitMap.csv"))
+        chemUnitMap = sourceStore.load("chemicalUnitMap")
         self.pollutantMapUnit = chemUnitMap.set_index("chemicalID")["recommendedUnit"].to_dict()
         #we need a dictonary to convert from iso2 to iso3 country codes      
-        countryCodes = pd.read_csv(os.path.join("AirQuality","countryCodes.csv"))
-        countryCodes = countryCodes[["alpha-2","alpha-3"]]
+        countryCodes = sourceStore.load("countryCodes")
         self.countryCodeMap = countryCodes.set_index("alpha-2")["alpha-3"].to_dict()
         self.dataParser = dataParser
 
-    def parseAllAirQualityData(self,dataset1:bool,dataset2:bool,dataset3:bool):
+    def parseAllAirQualityData(self,dataset1:bool,dataset2:bool,dataset3:bool,pipelined:bool=True,streaming:dict=None,compacted:dict=None):
         """
         Parses all relevant data from the EAA air quality dataset
         Warning, dataset 3 has the size of 800 GB.
@@ -34,6 +116,9 @@ class AirQualityData():
         :param p1: parse air dataset1
         :param p2: parse air dataset2
         :param p3: parse air dataset3
+        :param pipelined: parse files while the remaining files are still downloading
+        :param streaming: options of streamAirQualityData, loads the files from the http stream without downloading them if given
+        :param compacted: options of compactAirQualityData, the downloaded files are compacted into a partitioned dataset which is loaded instead if given
         """ 
         self.parseCityData()
         print("City data parsed successfully.")
@@ -41,89 +126,97 @@ class AirQualityData():
         print("Chemical data parsed successfully.")
         self.parseMeasurementData()
         print("Measurement data parsed successfully.")
+        self.downloadAirQualityData(dataset1,dataset2,dataset3,pipelined,streaming,compacted)
+        self.loadAirQualityData(pipelined,streaming,compacted)
+
+    def downloadAirQualityData(self,dataset1:bool,dataset2:bool,dataset3:bool,pipelined:bool=True,streaming:dict=None,compacted:dict=None):
+        """
+        Downloads the parquet file urls and, unless they are streamed or downloaded while parsing, the parquet files.
+        Needs no database tables, so it can run while the dimensions are loaded.
+        """
         #download parquet files urls
         self.downloadParquetUrls(dataset1,dataset2,dataset3)
         print("Parquet file urls downloaded successfully.")
-        #download data with 20 threads
-        self.download_parquet_files(os.path.join("AirQuality","download"),20)
+        if streaming is None and (not pipelined or compacted is not None):
+            #download data with 20 threads
+            self.download_parquet_files(os.path.join("AirQuality","download"),20)
+
+    def loadAirQualityData(self,pipelined:bool=True,streaming:dict=None,compacted:dict=None):
+        """
+        Loads the parquet files of downloadAirQualityData, needs the city, chemical and measureUnit rows.
+        """
+        if streaming is not None:
+            self.streamAirQualityData(os.path.join("AirQuality","download"),4,**streaming)
+            return
+        if pipelined and compacted is None:
+            #download with 20 threads and parse with 4 processes at the same time
+            self.pipelineAirQualityData(os.path.join("AirQuality","download"),20,4)
+            return
+        if compacted is not None:
+            #compact the small per city files and parse the dataset with 4 processes
+            self.compactAirQualityData(os.path.join("AirQuality","download"),compacted["datasetFolder"],compacted["rowGroupSize"])
+            self.parseCompactedAirQualityData(compacted["datasetFolder"],4)
+            return
         #parse data with 4 processes
         self.parseAirQualityData(os.path.join("AirQuality","download"),4)
     
     def downloadParquetUrls(self,dataset1,dataset2,dataset3):
         countryCity = self.fetchCountryCityData()
-        for _, row in countryCity.iterrows():
-            country_code = row['countryCode']
-            city_name = row['cityName']
-            if(dataset1):
-                self.make_ParquetRequest(country_code, city_name,1,"day")
-            if(dataset2):
-                self.make_ParquetRequest(country_code, city_name,2,"day")
-            if(dataset3):
-                self.make_ParquetRequest(country_code, city_name,3,"day")
+        datasets = [dataset for dataset, selected in ((1,dataset1),(2,dataset2),(3,dataset3)) if selected]
+        jobs = [(row.countryCode, row.cityName, dataset) for row in countryCity.itertuples() for dataset in datasets]
+        self.fetchUrlManifests(jobs)
 
-    def fetchCountryCityData(self):
-        #Api URL
-        EAAAPi = "https://eeadmz1-downloads-api-appservice.azurewebsites.net"
-        #fetch all available countries 
-        countriesResponse = requests.get(F"{EAAAPi}/Country")
-        if countriesResponse.status_code != 200:
-            raise Exception(f"Failed to fetch countries: {countriesResponse.status_code}")
-        countries = countriesResponse.json()
-
-        countryCityData = []
-        #fetch all available cities for each country
-        for country in countries:
-            country_code = country["countryCode"]
-            country_name = country["countryName"]
-            #Send request for country
-            citiesResponse = requests.post(F"{EAAAPi}/City", json=[country_code])
-            if citiesResponse.status_code != 200:
-                print(f"Failed to fetch cities for {country_name} ({country_code}): {citiesResponse.status_code}")
+    def fetchUrlManifests(self,jobs):
+        """
+        Writes the url manifest of every (iso2 country code, city name, dataset) job into the download folder of its city.
+
+        :return: list of the jobs whose url manifest could not be fetched
+        """
+        missingJobs = []
+        for country_code, city_name, dataset in jobs:
+            hit, content = self.catalogCache.loadUrlManifest(country_code, city_name, dataset)
+            if not hit:
+                missingJobs.append((country_code, city_name, dataset))
+            elif content is not None:
+                self.writeUrlManifest(country_code, city_name, dataset, content)
+        print(f"{len(jobs) - len(missingJobs)} url manifests cached, fetching {len(missingJobs)}.")
+        #url manifests are fetched concurrently, files are written as responses arrive
+        failedJobs = []
+        for (country_code, city_name, dataset), content, error in self.eeaClient.fetchUrlManifests(missingJobs):
+            if error is not None:
+                #failed requests are not cached, the next run fetches them again
+                print(error)
+                failedJobs.append((country_code, city_name, dataset))
                 continue
-            cities = citiesResponse.json()
-            #store result in dictionary
-            for city in cities:
-                countryCityData.append({
-                    "countryCode": country_code,
-                    "countryName": country_name,
-                    "cityName": city["cityName"]
-                })
-
-        #create DataFrame
-        return pd.DataFrame(countryCityData)
-
-    def make_ParquetRequest(self,country_code, city_name,dataset,aggregationType):
-        #create folder structure for download
+            self.catalogCache.storeUrlManifest(country_code, city_name, dataset, content)
+            if content is not None:
+                self.writeUrlManifest(country_code, city_name, dataset, content)
+        if failedJobs:
+            print(f"{len(failedJobs)} url manifests failed.")
+        return failedJobs
+
+    def fetchCountryCityData(self):
+        #the listing is fetched once and shared by parseCityData and downloadParquetUrls, which may run at the same time
+        with self.catalogLock:
+            return self.catalogCache.getCountryCityData(self.eeaClient.fetchCountryCityData)
+
+    def invalidateCatalog(self):
+        self.catalogCache.invalidate()
+
+    def cityFolder(self,country_code,city_name):
         sanitized_city_name = city_name.replace(" ", "_").replace("/", "_").replace("\\", "_")
-        folder_path = os.path.join("AirQuality","download", country_code, sanitized_city_name)
-        if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
-
-        #make parquet file request to EEA API
-        request= {
-            "countries": [country_code],
-            "cities": [city_name],
-            "pollutants": [],
-            "dataset": dataset,
-            "aggregationType": aggregationType
-        }
-        response = requests.post("https://eeadmz1-downloads-api-appservice.azurewebsites.net/ParquetFile/urls", json=request)
-        if response.status_code != 200:
-            print(f"failed to download file for {country_code} - {city_name}: {response.status_code}")
-            return
-        #check response
+        return os.path.join("AirQuality","download", country_code, sanitized_city_name)
+
+    def writeUrlManifest(self,country_code,city_name,dataset,content):
+        #create folder structure for download
+        folder_path = self.cityFolder(country_code, city_name)
         try:
-            #fetch hourly entries instead if no daily entries exist
-            if(len(response.content) <= 16):
-                if(dataset != 3 and aggregationType == "day" ):
-                    self.make_ParquetRequest(country_code, city_name,dataset,"hour")
-                #print(f"No daily entries for: {country_code} {city_name}")
-                return
+            os.makedirs(folder_path, exist_ok=True)
             #write binary file
             file_name = f"urlFiles{dataset}.csv"
             urlFilePath = os.path.join(folder_path, file_name)
             with open(urlFilePath, 'wb') as output:
-                output.write(response.content)
+                output.write(content)
             #write txt
             info_file = os.path.join(folder_path, "info.txt")
             with open(info_file, 'w') as output:
@@ -132,7 +225,7 @@ class AirQualityData():
             print(f"error writing file for {country_code} - {city_name}: {e}")
 
     #downloads all parquet files into folder structure, given a csv with links
-    def download_parquet_files(self,root_folder: str):
+    def download_parquet_files(self,root_folder: str,max_workers=40):
         for dirpath, _, filenames in os.walk(root_folder):
             #get all csv download files
             csv_files = [f for f in filenames if f.startswith('urlFiles') and f.endswith('.csv')]
@@ -144,23 +237,30 @@ class AirQualityData():
                 df = pd.read_csv(csv_path)
                 downloads = pd.concat([downloads, df], ignore_index=True)
             print(f"Downloading from {dirpath}")
-            self.download_files_from_dataframe(downloads,dirpath)
+            self.download_files_from_dataframe(downloads,dirpath,max_workers)
 
     def download_file(self,url,output_folder):
-        filename = f"{url.split('/')[-3]}_{os.path.basename(url.split('?')[0])}" 
-        output_path = os.path.join(output_folder, filename)
+        """
+        :return: path of the downloaded file or None if the download failed
+        """
+        output_path = downloadPath(url,output_folder)
         if os.path.exists(output_path):
             print(f"File already exists {output_path}")
-            return
+            return output_path
+        #download to a temporary name, a parse worker must never see a partial file
+        partial_path = output_path + ".part"
         try:
             response = requests.get(url, stream=True, timeout=60)
             response.raise_for_status()
-            with open(output_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=1024):
+            with open(partial_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
                     if chunk:
                         f.write(chunk)
+            os.replace(partial_path, output_path)
+            return output_path
         except Exception as e:
-            return f"Failed to download {url}. Error: {e}"
+            print(f"Failed to download {url}. Error: {e}")
+            return None
         
     def download_files_from_dataframe(self,df, output_folder, max_workers=40):
         os.makedirs(output_folder, exist_ok=True)
@@ -169,128 +269,517 @@ class AirQualityData():
             for url in urls:
                 executor.submit(self.download_file, url,output_folder)
 
-    def parseAirQualityData(self,root_folder,max_workers=10):
+    def collectDownloadJobs(self,root_folder):
+        """
+        Lists every url of the urlFiles csv files below root_folder as a (url, folder, city, iso2 country code) job.
+
+        :param root_folder: folder or list of folders
+        """
+        jobs = []
+        folders = [root_folder] if isinstance(root_folder, str) else root_folder
+        for dirpath, _, filenames in (entry for folder in folders for entry in os.walk(folder)):
+            csv_files = [f for f in filenames if f.startswith('urlFiles') and f.endswith('.csv')]
+            if(len(csv_files)<=0):
+                continue
+            cityInfo = self.readCityInfo(dirpath)
+            if cityInfo is None:
+                continue
+            urls = pd.concat([pd.read_csv(os.path.join(dirpath, csv_file)) for csv_file in csv_files], ignore_index=True)
+            for url in urls["ParquetFileUrl"].dropna().unique():
+                jobs.append((url, dirpath, cityInfo[0], cityInfo[1]))
+        return jobs
+
+    def pipelineAirQualityData(self,root_folder,maxDownloadWorkers=20,max_workers=4,queueSize=64):
+        """
+        Downloads and parses parquet files at the same time.
+        Download threads put finished files on a bounded queue which the parse process pool consumes,
+        if parsing falls behind the download threads block until the queue has room again.
+
+        :param root_folder: folder or list of folders
+        :param queueSize: amount of downloaded but not yet submitted files
+        """
+        downloadJobs = self.collectDownloadJobs(root_folder)
+        isDone = self.loadedCheck()
+        print(f"Downloading and parsing {len(downloadJobs)} parquet files from: {root_folder}")
+        parseQueue = queue.Queue(maxsize=queueSize)
+        #set once the parse loop stopped taking jobs, e.g. because it raised
+        stopped = threading.Event()
+
+        def enqueue(job):
+            #a full queue is never drained after the parse loop stopped, the put gives up instead of blocking forever
+            while not stopped.is_set():
+                try:
+                    parseQueue.put(job, timeout=1)
+                    return
+                except queue.Full:
+                    continue
+
+        def download(url,output_folder,cityName,countryCodeIso2):
+            if stopped.is_set():
+                return
+            parquetFilePath = self.download_file(url,output_folder)
+            if parquetFilePath is None or isDone(parquetFilePath):
+                return
+            enqueue((parquetFilePath, cityName, countryCodeIso2, os.path.getsize(parquetFilePath)))
+
+        def produce():
+            downloader = self.sharedDownloader or ThreadPoolExecutor(max_workers=maxDownloadWorkers)
+            try:
+                wait([downloader.submit(download, *job) for job in downloadJobs])
+            finally:
+                if downloader is not self.sharedDownloader:
+                    downloader.shutdown()
+                #signal the end of the downloads to the parse loop
+                enqueue(None)
+
+        def consume():
+            try:
+                while True:
+                    job = parseQueue.get()
+                    if job is None:
+                        return
+                    yield job
+            finally:
+                stopped.set()
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            return self.runParseJobs(consume(),max_workers)
+        finally:
+            #the generator is not closed if runParseJobs raised before consuming it
+            stopped.set()
+            producer.join()
+
+    def streamAirQualityData(self,root_folder,max_workers=4,spoolThresholdMB:float=64,diskBudgetMB:float=1024,keepCache:bool=False,cacheBudgetMB:float=1024):
+        """
+        Loads every parquet url below root_folder straight from the http stream without a download folder.
+        Every worker fetches a file into a spooled buffer, parses and loads it and discards the buffer.
+
+        :param root_folder: folder or list of folders
+        :param spoolThresholdMB: files up to this size stay in memory, larger files are spooled to a temporary file
+        :param diskBudgetMB: disk space of all workers together for spooled files
+        :param keepCache: keep a copy of every loaded file in the download folder as long as the cache budget allows
+        :param cacheBudgetMB: disk space of all parquet files in the download folder, kept copies included
+        """
+        loadedSources = self.loadManifest.loadedSources("airMeasurement")
+        compactedSources = self.loadManifest.loadedSources(COMPACTED_TABLE)
+        jobs = []
+        skipped = 0
+        for url, output_folder, cityName, countryCodeIso2 in self.collectDownloadJobs(root_folder):
+            sourcePath = downloadPath(url,output_folder)
+            if self.loadManifest.isRecorded(sourcePath,"airMeasurement",loadedSources) or self.loadManifest.isRecorded(sourcePath,COMPACTED_TABLE,compactedSources):
+                skipped += 1
+                continue
+            jobs.append(((url, sourcePath), cityName, countryCodeIso2, 0))
+        if skipped > 0:
+            print(f"Skipping {skipped} parquet files loaded by a previous run.")
+        print(f"Streaming {len(jobs)} parquet files from: {root_folder}")
+        workers = self.workerCount(max_workers)
+        #the kept copies have their own budget, so a full cache only stops keeping copies and never fails a load
+        folders = [root_folder] if isinstance(root_folder, str) else root_folder
+        cachedBytes = sum(folderBytes(folder,".parquet") for folder in folders) if keepCache else 0
+        options = {
+            "spoolThreshold": int(spoolThresholdMB * 1e6),
+            #every worker holds at most one spooled file
+            "diskBytes": int(diskBudgetMB * 1e6 / workers),
+            "keepCache": keepCache,
+            #the room left in the download folder is split between the workers
+            "cacheBytes": max(0, int((cacheBudgetMB * 1e6 - cachedBytes) / workers)),
+            "run": uuid.uuid4().hex
+        }
+        return self.runParseJobs(jobs,max_workers,parseFile=AirQualityData.streamParquetFile,parseArgs=(options,))
+
+    def readCityInfo(self,dirpath):
+        #read info file
+        infoFileP = os.path.join(dirpath, "info.txt")
+        try:
+            with open(infoFileP,'r') as infoFile:
+                cityName = infoFile.readline().strip() 
+                countryCodeIso2 = infoFile.readline().strip()
+        except Exception as e:
+            print(f"Couldnt read {infoFileP}.")
+            return None
+        return cityName, countryCodeIso2
+
+    def collectParquetJobs(self,root_folder):
+        """
+        Lists every parquet file below root_folder as a (path, city, iso2 country code, size) job,
+        largest files first so the long running files do not end up at the tail of the schedule.
+        """
+        jobs = []
+        #files already loaded by a previous run are skipped, directly or through the compacted dataset
+        isDone = self.loadedCheck()
+        skipped = 0
         for dirpath, _, filenames in os.walk(root_folder):
-        #get all csv download files
             parquetFiles = [f for f in filenames if f.endswith('.parquet')]
             if(len(parquetFiles)<1):
                 continue
-            #read info file
-            infoFileP = os.path.join(dirpath, "info.txt")
+            cityInfo = self.readCityInfo(dirpath)
+            if cityInfo is None:
+                continue
+            cityName, countryCodeIso2 = cityInfo
+            for parquetFile in parquetFiles:
+                parquetFilePath = os.path.join(dirpath, parquetFile)
+                if isDone(parquetFilePath):
+                    skipped += 1
+                    continue
+                jobs.append((parquetFilePath, cityName, countryCodeIso2, os.path.getsize(parquetFilePath)))
+        if skipped > 0:
+            print(f"Skipping {skipped} parquet files loaded by a previous run.")
+        jobs.sort(key=lambda job: job[3], reverse=True)
+        return jobs
+
+    def parseAirQualityData(self,root_folder,max_workers=10,maxInFlight=None):
+        jobs = self.collectParquetJobs(root_folder)
+        print(f"Parsing {len(jobs)} parquet files from: {root_folder}")
+        self.runParseJobs(jobs,max_workers,maxInFlight)
+
+    def loadedCheck(self):
+        """
+        :return: function telling if a downloaded parquet file was loaded, directly or through the compacted dataset
+        """
+        loadedSources = self.loadManifest.loadedSources("airMeasurement")
+        compactedSources = self.loadManifest.loadedSources(COMPACTED_TABLE)
+        def isDone(parquetFilePath):
+            return self.loadManifest.isLoaded(parquetFilePath,COMPACTED_TABLE,compactedSources) or self.loadManifest.isLoaded(parquetFilePath,"airMeasurement",loadedSources)
+        return isDone
+
+    def compactAirQualityData(self,root_folder,datasetFolder,rowGroupSize:int=1000000):
+        """
+        Compacts the small per city parquet files below root_folder into a dataset partitioned by country, pollutant and year.
+        City and iso2 country code of info.txt are stored as columns, files compacted or loaded before are skipped.
+
+        :param rowGroupSize: maximum amount of rows per row group of the dataset
+        """
+        def markDone(parquetFilePath,rows):
+            self.loadManifest.markLoaded(parquetFilePath,COMPACTED_TABLE,rows)
+        start = time.perf_counter()
+        compacted = compactDownloads(root_folder,datasetFolder,self.readCityInfo,self.loadedCheck,markDone,rowGroupSize,self.memoryBudget)
+        print(f"Compacted {compacted} parquet files into {datasetFolder} in {time.perf_counter() - start:.2f}s")
+
+    def parseCompactedAirQualityData(self,datasetFolder,max_workers=10,maxInFlight=None):
+        """
+        Loads the files of a dataset written by compactAirQualityData, every file holds the measurements of many cities.
+        """
+        jobs = []
+        loadedSources = self.loadManifest.loadedSources("airMeasurement")
+        for dirpath, _, filenames in os.walk(datasetFolder):
+            for parquetFile in filenames:
+                parquetFilePath = os.path.join(dirpath, parquetFile)
+                if parquetFile.endswith('.parquet') and not self.loadManifest.isLoaded(parquetFilePath,"airMeasurement",loadedSources):
+                    jobs.append((parquetFilePath, None, None, os.path.getsize(parquetFilePath)))
+        jobs.sort(key=lambda job: job[3], reverse=True)
+        #city ids are resolved by the workers per row from the City and Country columns
+        iso2Codes = {iso3: iso2 for iso2, iso3 in self.countryCodeMap.items()}
+        cityIds = {
+            cityKey(cityName, iso2Codes[countryCode]): cityId
+            for (cityName, countryCode), cityId in self.dimensions.cityIds().items()
+            if countryCode in iso2Codes
+        }
+        print(f"Parsing {len(jobs)} compacted parquet files from: {datasetFolder}")
+        self.runParseJobs(jobs,max_workers,maxInFlight,parseArgs=(cityIds,))
+
+    def publishAirQualityShards(self,leases:WorkLeases,job,dataset1:bool,dataset2:bool,dataset3:bool):
+        """
+        Publishes one shard per city of the EEA listing, workers on other machines claim and load them with loadAirQualityShards.
+        """
+        datasets = [dataset for dataset, selected in ((1,dataset1),(2,dataset2),(3,dataset3)) if selected]
+        countryCity = self.fetchCountryCityData()
+        shards = [
+            (f"{row.countryCode}/{row.cityName}", {"countryCode": row.countryCode, "cityName": row.cityName, "datasets": datasets})
+            for row in countryCity.itertuples()
+        ]
+        leases.publish(job, shards)
+        print(f"Published {len(shards)} air quality shards.")
+
+    def loadAirQualityShards(self,leases:WorkLeases,job,streaming:dict=None,pollSeconds:float=5,max_workers=4,maxDownloadWorkers=20,shardsPerClaim:int=8):
+        """
+        Claims city shards until every shard of the job is loaded, by this or by other workers.
+        Every shard is downloaded (or streamed), parsed and loaded by the worker holding its lease only.
+        The shards of one claim are loaded together and all claims share one parse pool and one set of download threads.
+
+        :param streaming: options of streamAirQualityData, the files of a shard are streamed instead of downloaded if given
+        :param shardsPerClaim: shards leased at once, small cities keep the parse pool busy together
+        """
+        #the dimension rows were inserted by other workers, keys read before they finished are stale
+        self.dimensions.refresh()
+        def loadShards(shards):
+            failedJobs = self.fetchUrlManifests([(shard["countryCode"], shard["cityName"], dataset) for _, shard in shards for dataset in shard["datasets"]])
+            #a shard with a failed url manifest is not loaded, it is retried once its lease is given back
+            failedCities = {(country_code, city_name) for country_code, city_name, _ in failedJobs}
+            failedShards = [shardKey for shardKey, shard in shards if (shard["countryCode"], shard["cityName"]) in failedCities]
+            #cities without any parquet file have no url manifest
+            folders = {shardKey: self.cityFolder(shard["countryCode"], shard["cityName"]) for shardKey, shard in shards if shardKey not in failedShards}
+            folders = {shardKey: folder for shardKey, folder in folders.items() if os.path.isdir(folder)}
+            if len(folders) == 0:
+                return failedShards
+            if streaming is not None:
+                progress = self.streamAirQualityData(list(folders.values()),max_workers,**streaming)
+            else:
+                progress = self.pipelineAirQualityData(list(folders.values()),maxDownloadWorkers,max_workers)
+            #a shard failed if one of the files in its city folder failed
+            return failedShards + [
+                shardKey for shardKey, folder in folders.items()
+                if any(path.startswith(os.path.join(folder, "")) for path in progress["failedSources"])
+            ]
+        with self.sharedPools(max_workers,maxDownloadWorkers):
+            processed = leases.runShards(job,loadShards,pollSeconds,shardsPerClaim)
+        print(f"Loaded {processed} air quality shards on {leases.workerId}.")
+
+    def workerCount(self,max_workers):
+        #every worker holds one connection, so the worker count is bounded by maxConnections
+        return max(1, min(max_workers, self.maxConnections))
+
+    def startParsePool(self,workers):
+        """
+        :return: executor of the parse jobs, threads sharing the parser for an embedded database and processes otherwise
+        """
+        #partitions and dimension keys are looked up once, not per file
+        years = partitionYears(self.dataParser)
+        workerArgs = (self.dimensions.keys("measureUnit"), self.dimensions.keys("chemical"), self.memoryBudget.share(workers))
+        if self.dataParser.backend == "duckdb":
+            #an embedded database is written by one process only, files are parsed by threads instead
+            return ThreadPoolExecutor(max_workers=workers,initializer=shareParseWorker,initargs=(self.dataParser,years,*workerArgs,stageCounter()))
+        return ProcessPoolExecutor(max_workers=workers,mp_context=POOL_CONTEXT,initializer=initParseWorker,initargs=(self.db_params,1,years,*workerArgs))
+
+    @contextmanager
+    def sharedPools(self,max_workers=4,maxDownloadWorkers=20):
+        """
+        Keeps one parse pool and one set of download threads open while the block runs,
+        the loads inside it reuse them instead of starting their own for every call.
+        """
+        self.sharedParsePool = self.startParsePool(self.workerCount(max_workers))
+        self.sharedDownloader = ThreadPoolExecutor(max_workers=maxDownloadWorkers)
+        try:
+            with self.sharedParsePool, self.sharedDownloader:
+                yield
+        finally:
+            self.sharedParsePool = None
+            self.sharedDownloader = None
+
+    def runParseJobs(self,jobs,max_workers=10,maxInFlight=None,progressInterval=10.0,parseFile=None,parseArgs=()):
+        """
+        Feeds parse jobs to one long lived process pool.
+        At most maxInFlight jobs are submitted at once, new jobs are submitted as soon as one finishes.
+
+        :param jobs: iterable of (parquet file path, city name, iso2 country code, file size),
+            streamed jobs have a (url, source path) pair instead of the path,
+            jobs of compacted files have no city name, their workers resolve the city of every row
+        :param maxInFlight: amount of submitted but unfinished jobs, defaults to twice the worker count
+        :param progressInterval: seconds between progress reports
+        :param parseFile: static function called with the source, city id, pollutant maps and parseArgs, defaults to parseParquetFile
+        :return: dictionary with the amount of parsed files, bytes, loaded rows and failed files and the paths of the failed files
+        """
+        start = time.perf_counter()
+        parseFile = parseFile or AirQualityData.parseParquetFile
+        workers = self.workerCount(max_workers)
+        maxInFlight = maxInFlight or workers * 2
+        totalJobs = len(jobs) if hasattr(jobs, "__len__") else None
+        progress = {"files": 0, "bytes": 0, "rows": 0, "failed": 0, "failedSources": []}
+        lastReport = start
+        cityIds = self.dimensions.cityIds()
+        #a pool kept open by sharedPools is reused and stays open
+        pool = nullcontext(self.sharedParsePool) if self.sharedParsePool is not None else self.startParsePool(workers)
+        with pool as executor:
+            pending = {}
+            for source, cityName, countryCodeIso2, size in jobs:
+                #metrics and failures are recorded for the source path of a streamed url
+                parquetFilePath = source[1] if isinstance(source, tuple) else source
+                countryCode = self.countryCodeMap.get(countryCodeIso2)
+                cityId = cityIds.get((cityName, countryCode))
+                if cityId is None and cityName is not None:
+                    print(f"No city id for {cityName} {countryCode} found.")
+                    progress["files"] += 1
+                    progress["failed"] += 1
+                    progress["failedSources"].append(parquetFilePath)
+                    record = fileRecord(parquetFilePath,"airQuality")
+                    record["error"] = f"No city id for {cityName} {countryCode} found."
+                    self.metrics.addFile(record)
+                    continue
+                if len(pending) >= maxInFlight:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    self.collectParseResults(done,pending,progress)
+                future = executor.submit(
+                    parseFile,
+                    source,
+                    cityId,
+                    self.pollutantMapUnit,
+                    self.pollutantMapNotation,
+                    *parseArgs
+                )
+                pending[future] = (parquetFilePath, size)
+                if time.perf_counter() - lastReport >= progressInterval:
+                    lastReport = time.perf_counter()
+                    self.printParseProgress(progress,totalJobs,lastReport - start)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                self.collectParseResults(done,pending,progress)
+                if time.perf_counter() - lastReport >= progressInterval:
+                    lastReport = time.perf_counter()
+                    self.printParseProgress(progress,totalJobs,lastReport - start)
+        elapsed = time.perf_counter() - start
+        self.printParseProgress(progress,totalJobs,elapsed)
+        #threads sharing the parser already recorded their loads
+        if self.dataParser.backend != "duckdb":
+            self.dataParser.recordLoad("airMeasurement",progress["rows"],elapsed)
+        print(f"Loaded {progress['rows']} rows into airMeasurement in {elapsed:.2f}s ({progress['rows'] / max(elapsed, 1e-9):.0f} rows/s)")
+        return progress
+
+    def collectParseResults(self,done,pending,progress):
+        for future in done:
+            parquetFilePath, size = pending.pop(future)
+            progress["files"] += 1
             try:
-                with open(infoFileP,'r') as infoFile:
-                    cityName = infoFile.readline().strip() 
-                    countryCodeIso2 = infoFile.readline().strip()
+                record = future.result()
             except Exception as e:
-                print(f"Couldnt read {infoFileP}.")
+                progress["bytes"] += size
+                progress["failed"] += 1
+                progress["failedSources"].append(parquetFilePath)
+                print(f"Caught exception while parsing air data: {e}")
+                self.metrics.addFailure(parquetFilePath,"airQuality",e)
                 continue
-            futures = []
-            print(f"Parsing files from: {dirpath}")
-            with ProcessPoolExecutor(max_workers=max_workers) as executor:
-                for parquetFile in parquetFiles:
-                    future = executor.submit(
-                        AirQualityData.parseParquetFile,
-                        os.path.join(dirpath, parquetFile),
-                        cityName,
-                        countryCodeIso2,
-                        self.db_params,
-                        self.pollutantMapUnit,
-                        self.pollutantMapNotation,
-                        self.countryCodeMap
-                    )
-                    futures.append(future)
-
-            for future in as_completed(futures):
-                try:
-                    future.result()  # Wait for the result or raise an exception
-                except Exception as e:
-                    print(f"Caught exception while parsing air data: {e}")
+            self.metrics.addFile(record)
+            #streamed files are only sized once they are fetched
+            progress["bytes"] += record["bytesRead"] or size
+            progress["rows"] += record["rowsWritten"]
+            if record["error"] is not None:
+                progress["failed"] += 1
+                progress["failedSources"].append(parquetFilePath)
+
+    def printParseProgress(self,progress,totalJobs,elapsed):
+        total = totalJobs if totalJobs is not None else "?"
+        print(f"Parsed {progress['files']}/{total} files, {progress['bytes'] / 1e6:.1f} MB, {progress['rows']} rows, {progress['failed']} failed in {elapsed:.0f}s")
 
     #method is static due to multi processing
     @staticmethod
-    def parseParquetFile(parquetFilePath,cityName,countryCodeIso2,db_params,pollutantMapUnit,pollutantMapNotation,countryCodeMap):
-        sqlDataParser = DataParser(db_params["user"],db_params["password"],db_params["host"],db_params["port"],db_params["dbname"])
-        airMeasurment = pd.read_parquet(parquetFilePath)
-        #filter out invalid rows
-        airMeasurment = airMeasurment[airMeasurment['Validity'] != -1]
-        if len(airMeasurment) == 0:
-            return
-        airMeasurment = airMeasurment[["Pollutant","Start","Value","Unit","AggType"]]
-        if ((airMeasurment['AggType'] == 'hour').any()):
-            airMeasurment = airMeasurment.groupby(pd.Grouper(key='Start', freq='D')).agg({
-                'Pollutant': 'first',  
-                'Value': 'mean',      
-                'Unit': 'first',      
-                'AggType': 'first'    
-            }).reset_index()
-        #grouping can create additional values
-        airMeasurment = airMeasurment.dropna(subset=["Pollutant", "Value"])
-        airMeasurment = airMeasurment[["Pollutant","Start","Value","Unit"]]
-        airMeasurment["Pollutant"] = airMeasurment["Pollutant"].astype(int)
-        airMeasurment["Value"] = airMeasurment["Value"].astype(float)
-        #get recommendedUnit in case unit in dataset is empty (happens a lot)
-        recommendedUnit = pollutantMapUnit.get(airMeasurment['Pollutant'].iloc[0],"noUnitFound")
-        airMeasurment["Pollutant"] = pollutantMapNotation.get(airMeasurment["Pollutant"].iloc[0],"noChemicalFound")
-        airMeasurment = airMeasurment.rename(columns={"Pollutant": "chemicalCode","Start":"date","Value":"value","Unit":"measureUnitCode"})
-        #fill unit if necessary
-        airMeasurment['measureUnitCode'] = airMeasurment['measureUnitCode'].fillna(recommendedUnit)
-        #Sanitize more
-        airMeasurment['measureUnitCode'] = airMeasurment['measureUnitCode'].replace("ugc.m-3", "ugC.m-3")
-        airMeasurment = airMeasurment[airMeasurment['measureUnitCode'] != "noUnitFound"]
-        airMeasurment = airMeasurment[airMeasurment['chemicalCode'] != "noChemicalFound"]
-        airMeasurment = airMeasurment[airMeasurment['value'] >= 0]
-        if len(airMeasurment) == 0:
+    @profiled("parseParquetFile")
+    def parseParquetFile(parquetFilePath,cityId,pollutantMapUnit,pollutantMapNotation,cityIds=None):
+        """
+        :param cityIds: city ids by cityKey for compacted files, cityId is None then
+        :return: metrics record of the file, it is returned to the main process instead of printed
+        """
+        start = time.perf_counter()
+        record = fileRecord(parquetFilePath,"airQuality")
+        try:
+            AirQualityData.loadParquetFile(parquetFilePath,cityId,pollutantMapUnit,pollutantMapNotation,record,cityIds=cityIds)
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            record["peakRssMB"] = peakRssMB()
+        return record
+
+    @staticmethod
+    @profiled("streamParquetFile")
+    def streamParquetFile(source,cityId,pollutantMapUnit,pollutantMapNotation,options):
+        """
+        Fetches a parquet url into a spooled buffer, loads it like a downloaded file and discards the buffer.
+
+        :param source: (url, source path) pair, the manifest entry and the kept copy use the source path
+        :param options: spoolThreshold, diskBytes and cacheBytes in bytes, keepCache and run token of the worker
+        :return: metrics record of the file
+        """
+        global workerHttpSession
+        url, sourcePath = source
+        start = time.perf_counter()
+        record = fileRecord(sourcePath,"airQuality")
+        record["url"] = url
+        if workerHttpSession is None:
+            workerHttpSession = requests.Session()
+        try:
+            spool, sourceInfo = fetchToSpool(url,options["spoolThreshold"],options["diskBytes"],workerHttpSession)
+            with spool:
+                record["bytesRead"] = sourceInfo["size"]
+                AirQualityData.loadParquetFile(spool,cityId,pollutantMapUnit,pollutantMapNotation,record,sourcePath,sourceInfo)
+                #copies are only kept while the share of the cache budget allows, a full cache stops keeping them
+                keptBytes = workerKeptBytes.get(options["run"], 0)
+                if options["keepCache"] and record["error"] is None and keptBytes + sourceInfo["size"] <= options["cacheBytes"]:
+                    try:
+                        keepCopy(spool,sourcePath)
+                        workerKeptBytes[options["run"]] = keptBytes + sourceInfo["size"]
+                    except OSError as e:
+                        #the rows are already loaded, a copy that cannot be written is only reported
+                        print(f"Couldnt keep a copy of {url}: {e}")
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            record["peakRssMB"] = peakRssMB()
+        return record
+
+    @staticmethod
+    def loadParquetFile(parquetFilePath,cityId,pollutantMapUnit,pollutantMapNotation,record,sourcePath=None,sourceInfo=None,cityIds=None):
+        """
+        :param parquetFilePath: path of the parquet file or a file object holding it
+        :param sourcePath: path the manifest entry is written for, defaults to parquetFilePath
+        :param sourceInfo: size and content hash of a source without a local file
+        :param cityIds: city ids by cityKey, a compacted file is aggregated per city and its rows get the id of their city
+        """
+        sourcePath = sourcePath or parquetFilePath
+        sqlDataParser = workerDataParser
+        columns = MEASUREMENT_COLUMNS if cityIds is None else COMPACTED_COLUMNS
+        #hourly values are averaged to daily values, daily values stay the same
+        aggregator = DailyAggregator() if cityIds is None else DailyAggregator(COMPACTED_KEYS)
+        #batches as large as the memory budget of the worker allows
+        batchSize = workerMemoryBudget.rowsFor(parquetBytesPerRow(parquetFilePath,columns))
+        for batch in iterMeasurementBatches(parquetFilePath,batchSize,record=record,columns=columns):
+            aggregator.add(batch)
+        daily = aggregator.result()
+        if daily is None:
+            workerLoadManifest.markLoaded(sourcePath,"airMeasurement",0,sourceInfo)
             return
-        countryCode = countryCodeMap.get(countryCodeIso2)
-        query = """
-            SELECT "city_ID"
-            FROM city
-            WHERE "name" = :city_name AND "countryCode" = :country_code
-        """
-        params = {
-            "city_name": cityName,  
-            "country_code": countryCode               
-        }
-        query = sqlDataParser.makeCall(query,params)
-        result = [item[0] for item in query]
-        if(len(result) < 1):
-            print(f"No city id for {cityName} {countryCode} found.")
+        if cityIds is not None:
+            cityIdColumn = resolveCityIds(daily,cityIds)
+            known = pc.is_valid(cityIdColumn)
+            daily = daily.append_column("city_ID", cityIdColumn).filter(known)
+            addFiltered(record,"unknownCity",len(known) - daily.num_rows)
+        airMeasurment = buildAirMeasurements(daily,pollutantMapUnit,pollutantMapNotation,workerKnownUnits,workerKnownChemicals)
+        addFiltered(record,"unknownUnitOrChemical",daily.num_rows - airMeasurment.num_rows)
+        record["rowsOut"] = airMeasurment.num_rows
+        if airMeasurment.num_rows == 0:
+            workerLoadManifest.markLoaded(sourcePath,"airMeasurement",0,sourceInfo)
             return
-        airMeasurment["city_ID"] = int(result[0])
-        sqlDataParser.parsePandaDFToTable(airMeasurment,"airMeasurement")
+        if cityIds is None:
+            airMeasurment = airMeasurment.append_column("city_ID", pa.array([cityId] * airMeasurment.num_rows, type=pa.int32()))
+        #rows, monthly rollup and manifest entry are committed together, a crash never leaves a half loaded file
+        markLoaded = workerLoadManifest.markLoadedInTransaction(sourcePath,"airMeasurement",airMeasurment.num_rows,sourceInfo)
+        partials = monthlyPartials(airMeasurment)
+        #the rollup sorts by the code columns, which arrow can not do on dictionaries
+        airMeasurment = compactTable(airMeasurment)
+        def inTransaction(cursor):
+            upsertMonthlyRollup(cursor,partials)
+            markLoaded(cursor)
+        routed = routeByYear(airMeasurment,workerPartitionYears)
+        writeStart = time.perf_counter()
+        loadedRows = sqlDataParser.parseFramesToTable(routed,"airMeasurement",reportRate=False,inTransaction=inTransaction)
+        record["dbWriteSeconds"] = time.perf_counter() - writeStart
+        record["rowsWritten"] = loadedRows
+        if loadedRows == 0:
+            workerLoadManifest.markFailed(sourcePath,"airMeasurement",sourceInfo)
+            record["error"] = "The load transaction failed."
 
     def parsePollutantData(self):
-        dfChemical = pd.read_csv(os.path.join("AirQuality","chemicalVocabulary.csv"))
+        dfChemical = self.sourceStore.load("chemicalVocabulary")
         dfChemical = dfChemical[["chemicalCode","name"]]
-        #remove duplicates
-        dfChemical = dfChemical.drop_duplicates(subset=['chemicalCode'])
-        #remove already existing chemicals
-        query = self.dataParser.makeCall("""SELECT DISTINCT "chemicalCode" FROM chemical""")
-        chemicals = [item[0] for item in query]
-        dfChemical = dfChemical[~dfChemical['chemicalCode'].isin(chemicals)]
-        #parse
-        self.dataParser.parsePandaDFToTable(dfChemical,"chemical")
+        #only chemicals missing in the database are inserted
+        self.dimensions.upsert("chemical",dfChemical)
 
     def parseMeasurementData(self):
-        measurementData = pd.read_csv(os.path.join("AirQuality","concentration.csv"))
+        measurementData = self.sourceStore.load("concentration")
         measurementData = measurementData[["URI","Label","Definition"]]
         measurementData["URI"] = measurementData["URI"].apply(lambda x : os.path.basename(x))
         measurementData = measurementData.rename(columns={"URI": "measureUnitCode","Label":"name","Definition":"description"})
-        self.dataParser.parsePandaDFToTable(measurementData,"measureUnit")  
+        self.dimensions.upsert("measureUnit",measurementData)
 
 
     def parseCityData(self):
         #fetch our data from the api
         countryCityData= self.fetchCountryCityData()
         #we need to convert from iso2 to iso3 country codes, we will use another mapping for this
-        countryCodes = pd.read_csv(os.path.join("AirQuality","countryCodes.csv"))
-        countryCodes = countryCodes[["alpha-2","alpha-3"]]
+        countryCodes = self.sourceStore.load("countryCodes")
         #merge tables on 3 digit country code
         countryCityData = countryCityData.merge(countryCodes, left_on="countryCode", right_on="alpha-2", how="left")
         #change structure to sql table
         city = countryCityData[["alpha-3","cityName"]].rename(columns={"alpha-3": "countryCode","cityName":"name"})
-        #parse data to database
-        self.dataParser.parsePandaDFToTable(city,"city")        
+        #parse data to database, cities of a previous run are not inserted again
+        self.dimensions.upsert("city",city)
 
 
 
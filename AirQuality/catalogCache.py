@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import pandas as pd
+
+class CatalogCache:
+    """
+    On disk cache of the EEA country/city listing and the parquet url manifest of every city.
+    Every entry stores its fetch timestamp and is refetched once it is older than ttl seconds.
+    """
+    def __init__(self,cacheFolder:str=os.path.join("AirQuality","cache"),ttl:float=7*24*3600):
+        """
+        :param cacheFolder: folder the cache entries are written to
+        :param ttl: seconds an entry stays valid, None keeps entries forever
+        """
+        self.cacheFolder = cacheFolder
+        self.ttl = ttl
+
+    def getCountryCityData(self,fetch):
+        """
+        :param fetch: function returning the country/city DataFrame, called on a cache miss,
+            it raises instead of returning an incomplete listing so no partial listing is cached
+        """
+        path = os.path.join(self.cacheFolder, "countryCity.json")
+        entry = self.readEntry(path)
+        if entry is not None:
+            return pd.DataFrame(entry["data"], columns=["countryCode","countryName","cityName"])
+        countryCityData = fetch()
+        self.writeEntry(path, countryCityData.to_dict(orient="records"))
+        return countryCityData
+
+    def loadUrlManifest(self,countryCode,cityName,dataset,aggregationType="day"):
+        """
+        :return: (True, csv content or None) on a cache hit, (False, None) otherwise
+        """
+        entry = self.readEntry(self.manifestPath(countryCode, cityName, dataset, aggregationType))
+        if entry is None:
+            return False, None
+        content = entry["data"]["content"]
+        return True, content.encode("utf-8") if content is not None else None
+
+    def storeUrlManifest(self,countryCode,cityName,dataset,content,aggregationType="day"):
+        #cities without files are cached as well, so they are not requested again
+        data = {
+            "countryCode": countryCode,
+            "cityName": cityName,
+            "dataset": dataset,
+            "aggregationType": aggregationType,
+            "content": content.decode("utf-8") if content is not None else None
+        }
+        self.writeEntry(self.manifestPath(countryCode, cityName, dataset, aggregationType), data)
+
+    def getUrlManifest(self,countryCode,cityName,dataset,fetch,aggregationType="day"):
+        """
+        :param fetch: function of country code, city name and dataset returning the csv content, called on a cache miss
+        :param aggregationType: aggregation fetch requests, manifests of different aggregations are cached separately
+        """
+        hit, content = self.loadUrlManifest(countryCode, cityName, dataset, aggregationType)
+        if hit:
+            return content
+        content = fetch(countryCode, cityName, dataset)
+        self.storeUrlManifest(countryCode, cityName, dataset, content, aggregationType)
+        return content
+
+    def invalidate(self):
+        #drop the whole catalog, the next run fetches everything again
+        shutil.rmtree(self.cacheFolder, ignore_errors=True)
+
+    def invalidateCountryCityData(self):
+        self.removeEntry(os.path.join(self.cacheFolder, "countryCity.json"))
+
+    def invalidateUrlManifest(self,countryCode,cityName,dataset,aggregationType="day"):
+        self.removeEntry(self.manifestPath(countryCode, cityName, dataset, aggregationType))
+
+    def manifestPath(self,countryCode,cityName,dataset,aggregationType="day"):
+        #city names can contain any character, the file name is derived from a hash
+        cityKey = hashlib.sha1(cityName.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cacheFolder, "manifests", countryCode, f"{cityKey}_{dataset}_{aggregationType}.json")
+
+    def readEntry(self,path):
+        try:
+            with open(path, "r", encoding="utf-8") as cacheFile:
+                entry = json.load(cacheFile)
+        except (OSError, ValueError):
+            return None
+        if self.ttl is not None and time.time() - entry["fetchedAt"] > self.ttl:
+            return None
+        return entry
+
+    def writeEntry(self,path,data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        #write to a temporary file first so an interrupted run never leaves a broken entry
+        temporaryPath = f"{path}.{os.getpid()}.tmp"
+        with open(temporaryPath, "w", encoding="utf-8") as cacheFile:
+            json.dump({"fetchedAt": time.time(), "data": data}, cacheFile)
+        os.replace(temporaryPath, path)
+
+    def removeEntry(self,path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,197 @@
+import json
+import os
+import shutil
+import time
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from AirQuality.parquetReader import MEASUREMENT_COLUMNS
+from AirQuality.dailyAggregation import mapValues
+from frameSchema import MemoryBudget, defaultMemoryBudget
+
+#columns of the compacted dataset, City and Country (iso2) are taken from the info.txt of the city folder
+COMPACTED_SCHEMA = pa.schema([
+    ("Pollutant", pa.int32()),
+    ("Start", pa.timestamp("ns")),
+    ("Value", pa.float64()),
+    ("Unit", pa.string()),
+    ("AggType", pa.string()),
+    ("Validity", pa.int32()),
+    ("City", pa.string()),
+    ("Country", pa.string())
+])
+#hive partitions of the dataset, written as country=../pollutant=../year=.. folders
+#the writer drops them from the files, Country, Pollutant and Start keep their values in every file
+PARTITION_SCHEMA = pa.schema([
+    ("country", pa.string()),
+    ("pollutant", pa.int32()),
+    ("year", pa.int16())
+])
+DATASET_SCHEMA = pa.unify_schemas([COMPACTED_SCHEMA, PARTITION_SCHEMA])
+#estimated in memory size of one row of the dataset
+COMPACTED_ROW_BYTES = 80
+#partitions of one country open at the same time (pollutants times years), bounds the rows buffered by the writer
+OPEN_PARTITIONS = 64
+#columns a parse worker reads from a compacted file
+COMPACTED_COLUMNS = MEASUREMENT_COLUMNS + ["City","Country"]
+#keys the daily aggregation of a compacted file groups by in addition to the day
+COMPACTED_KEYS = ("City","Country","Pollutant","Unit")
+#table name of the compacted source files in the load manifest
+COMPACTED_TABLE = "airQualityDataset"
+#rows per source of a staged country, written once all its files are complete
+STAGED_SOURCES = "sources.json"
+#separates city name and country code in the city id lookup
+CITY_KEY_SEPARATOR = "\x1f"
+
+def cityKey(cityName,countryCodeIso2):
+    return f"{cityName}{CITY_KEY_SEPARATOR}{countryCodeIso2}"
+
+def resolveCityIds(daily:pa.Table,cityIds:dict):
+    """
+    :param cityIds: dictionary of cityKey(city name, iso2 country code) to city_ID
+    :return: int32 array with the city_ID of every row, null for unknown cities
+    """
+    keys = pc.binary_join_element_wise(pc.cast(daily["City"], pa.string()), pc.cast(daily["Country"], pa.string()), CITY_KEY_SEPARATOR)
+    return mapValues(keys, cityIds, pa.int32())
+
+def compactedBatches(parquetFilePaths,cityName,countryCodeIso2,batchSize,rowCounts):
+    """
+    Yields the measurements of the parquet files of one city in the compacted schema with the partition columns appended.
+
+    :param rowCounts: dictionary the amount of rows of every file is written to
+    """
+    for parquetFilePath in parquetFilePaths:
+        rowCounts[parquetFilePath] = 0
+        for batch in pq.ParquetFile(parquetFilePath).iter_batches(batch_size=batchSize, columns=MEASUREMENT_COLUMNS):
+            rows = batch.num_rows
+            rowCounts[parquetFilePath] += rows
+            columns = [batch.column(name).cast(COMPACTED_SCHEMA.field(name).type) for name in MEASUREMENT_COLUMNS]
+            city, country = pa.repeat(cityName, rows), pa.repeat(countryCodeIso2, rows)
+            partition = [country, columns[0], pc.cast(pc.year(columns[1]), pa.int16())]
+            yield pa.RecordBatch.from_arrays(columns + [city, country] + partition, schema=DATASET_SCHEMA)
+
+def compactCountry(cityFolders,datasetFolder,basenameTemplate,rowGroupSize,memoryBudget:MemoryBudget):
+    """
+    Writes the parquet files of the cities of one country into the dataset.
+    Only the partitions of one country are open at a time, the rows they buffer stay within the memory budget.
+
+    :param cityFolders: list of (city name, iso2 country code, list of parquet file paths)
+    :return: dictionary of parquet file path to its amount of rows
+    """
+    rowCounts = {}
+    #the writer buffers up to min_rows_per_group rows in every open partition before it writes a row group
+    minRows = min(rowGroupSize, memoryBudget.rowsFor(COMPACTED_ROW_BYTES) // OPEN_PARTITIONS)
+    batches = (
+        batch
+        for cityName, countryCodeIso2, paths in cityFolders
+        for batch in compactedBatches(paths, cityName, countryCodeIso2, min(rowGroupSize, 65536), rowCounts)
+    )
+    ds.write_dataset(
+        batches,
+        datasetFolder,
+        schema=DATASET_SCHEMA,
+        format="parquet",
+        partitioning=ds.partitioning(PARTITION_SCHEMA, flavor="hive"),
+        basename_template=basenameTemplate,
+        existing_data_behavior="overwrite_or_ignore",
+        min_rows_per_group=minRows,
+        max_rows_per_group=rowGroupSize,
+        max_partitions=1 << 16
+    )
+    return rowCounts
+
+def stagingFolder(datasetFolder):
+    #countries are written next to the dataset first, the dataset never holds files of an unfinished country
+    return os.path.normpath(datasetFolder) + ".staging"
+
+def publishStaged(stagedFolder,datasetFolder,markDone):
+    """
+    Marks the sources of a staged country as compacted and moves its files into the dataset.
+    Both steps can be repeated, so a country of a crashed run is finished by the next run.
+
+    :return: dictionary of parquet file path to its amount of rows
+    """
+    with open(os.path.join(stagedFolder, STAGED_SOURCES)) as sourcesFile:
+        rowCounts = json.load(sourcesFile)
+    for path, rows in rowCounts.items():
+        markDone(path, rows)
+    for dirpath, _, filenames in os.walk(stagedFolder):
+        for filename in filenames:
+            if filename.endswith(".parquet"):
+                stagedPath = os.path.join(dirpath, filename)
+                datasetPath = os.path.join(datasetFolder, os.path.relpath(stagedPath, stagedFolder))
+                os.makedirs(os.path.dirname(datasetPath), exist_ok=True)
+                os.replace(stagedPath, datasetPath)
+    shutil.rmtree(stagedFolder)
+    return rowCounts
+
+def stageCountry(cityFolders,stagedFolder,basenameTemplate,rowGroupSize,memoryBudget:MemoryBudget):
+    """
+    Writes a country into its staging folder, the sources file is written last under a temporary name
+    so it only exists once all files of the country are complete.
+    """
+    rowCounts = compactCountry(cityFolders, stagedFolder, basenameTemplate, rowGroupSize, memoryBudget)
+    partialPath = os.path.join(stagedFolder, STAGED_SOURCES + ".part")
+    with open(partialPath, "w") as sourcesFile:
+        json.dump(rowCounts, sourcesFile)
+    os.replace(partialPath, os.path.join(stagedFolder, STAGED_SOURCES))
+
+def recoverStaged(datasetFolder,markDone):
+    """
+    Finishes the complete countries a crashed run left in the staging folder and deletes the partial ones,
+    the sources of a partial country were not marked and are compacted again.
+
+    :return: amount of recovered source files
+    """
+    stagingRoot = stagingFolder(datasetFolder)
+    if not os.path.isdir(stagingRoot):
+        return 0
+    recovered = 0
+    for name in sorted(os.listdir(stagingRoot)):
+        stagedFolder = os.path.join(stagingRoot, name)
+        if os.path.exists(os.path.join(stagedFolder, STAGED_SOURCES)):
+            recovered += len(publishStaged(stagedFolder, datasetFolder, markDone))
+        else:
+            shutil.rmtree(stagedFolder)
+    return recovered
+
+def compactDownloads(downloadFolder,datasetFolder,readCityInfo,doneCheck,markDone,rowGroupSize:int=1000000,memoryBudget:MemoryBudget=defaultMemoryBudget):
+    """
+    Rewrites the parquet files of the download tree (downloadFolder/<iso2>/<city>) into a hive partitioned dataset
+    with one folder per country, pollutant and year and large row groups.
+    Files written by earlier runs are kept, every run adds its own files.
+    Every country is written to a staging folder and only moved into the dataset once its sources are marked,
+    a crash leaves no files in the dataset whose sources are compacted again.
+
+    :param readCityInfo: function returning (city name, iso2 country code) of a city folder or None
+    :param doneCheck: function returning a function telling if a parquet file was compacted or loaded before,
+        called after the countries of a crashed run were recovered
+    :param markDone: function called with the path and amount of rows of every parquet file once its country is written
+    :return: amount of compacted source files
+    """
+    recovered = recoverStaged(datasetFolder, markDone)
+    if recovered > 0:
+        print(f"Recovered {recovered} parquet files compacted by an interrupted run.")
+    isDone = doneCheck()
+    countries = {}
+    for dirpath, _, filenames in os.walk(downloadFolder):
+        paths = sorted(os.path.join(dirpath, f) for f in filenames if f.endswith(".parquet"))
+        paths = [path for path in paths if not isDone(path)]
+        if len(paths) == 0:
+            continue
+        cityInfo = readCityInfo(dirpath)
+        if cityInfo is None:
+            continue
+        cityName, countryCodeIso2 = cityInfo
+        countries.setdefault(countryCodeIso2, []).append((cityName, countryCodeIso2, paths))
+    #unique per run and country, files of earlier runs are never overwritten
+    runToken = f"{int(time.time() * 1000)}-{os.getpid()}"
+    compacted = 0
+    for countryCodeIso2, cityFolders in sorted(countries.items()):
+        stagedFolder = os.path.join(stagingFolder(datasetFolder), f"{runToken}-{countryCodeIso2}")
+        stageCountry(cityFolders, stagedFolder, f"part-{runToken}-{countryCodeIso2}-{{i}}.parquet", rowGroupSize, memoryBudget)
+        rowCounts = publishStaged(stagedFolder, datasetFolder, markDone)
+        compacted += len(rowCounts)
+        print(f"Compacted {len(rowCounts)} parquet files of {countryCodeIso2}.")
+    return compacted
@@ -0,0 +1,90 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+
+class DailyAggregator:
+    """
+    Aggregates measurement batches to daily mean, min, max and count per pollutant, unit and day.
+    Works on arrow tables only, every batch is reduced to partial aggregates which are merged at the end.
+    """
+    def __init__(self,keys=("Pollutant","Unit"),compactEvery:int=32):
+        """
+        :param keys: columns grouped by in addition to the day
+        :param compactEvery: amount of partial aggregates kept before they are merged into one
+        """
+        self.keys = list(keys) + ["day"]
+        self.compactEvery = compactEvery
+        self.partials = []
+
+    def add(self,batch:pa.RecordBatch):
+        table = pa.Table.from_batches([batch])
+        table = table.append_column("day", pc.cast(table["Start"], pa.date32()))
+        partial = table.group_by(self.keys).aggregate([
+            ("Value", "sum"),
+            ("Value", "count"),
+            ("Value", "min"),
+            ("Value", "max")
+        ])
+        self.partials.append(partial.rename_columns(self.keys + ["sum","count","min","max"]))
+        #keep the amount of partials bounded for files with many batches
+        if len(self.partials) >= self.compactEvery:
+            self.partials = [self.merge()]
+
+    def merge(self):
+        combined = pa.concat_tables(self.partials).group_by(self.keys).aggregate([
+            ("sum", "sum"),
+            ("count", "sum"),
+            ("min", "min"),
+            ("max", "max")
+        ])
+        return combined.rename_columns(self.keys + ["sum","count","min","max"])
+
+    def result(self):
+        """
+        :return: arrow table with the key columns, day, sum, count, min, max and mean or None if nothing was added
+        """
+        if len(self.partials) == 0:
+            return None
+        daily = self.merge() if len(self.partials) > 1 else self.partials[0]
+        mean = pc.divide(daily["sum"], pc.cast(daily["count"], pa.float64()))
+        return daily.append_column("mean", mean)
+
+def mapValues(values:pa.Array,mapping:dict,valueType=None):
+    """
+    Vectorized dictionary lookup, values without a mapping become null.
+    """
+    keys = pa.array(list(mapping.keys()), type=values.type)
+    mapped = pa.array(list(mapping.values()), type=valueType)
+    return pc.take(mapped, pc.index_in(values, value_set=keys))
+
+def buildAirMeasurements(daily:pa.Table,pollutantMapUnit,pollutantMapNotation,knownUnits=None,knownChemicals=None):
+    """
+    Converts daily aggregates into rows of the airMeasurement table.
+    city_ID is only passed through if daily has one, aggregates of a single city file get it appended by the caller.
+    Pollutant ids are resolved per row, so files mixing pollutants are handled.
+    Rows without a known chemical or unit are dropped.
+
+    :param knownUnits: measure unit codes of the database, rows with other units are dropped if given
+    :param knownChemicals: chemical codes of the database, rows with other chemicals are dropped if given
+    """
+    pollutant = pc.cast(daily["Pollutant"], pa.int64())
+    chemicalCode = mapValues(pollutant, pollutantMapNotation, pa.string())
+    #get recommendedUnit in case unit in dataset is empty (happens a lot)
+    recommendedUnit = mapValues(pollutant, pollutantMapUnit, pa.string())
+    unit = pc.coalesce(pc.cast(daily["Unit"], pa.string()), recommendedUnit)
+    #Sanitize more
+    unit = pc.if_else(pc.equal(unit, "ugc.m-3"), "ugC.m-3", unit)
+    airMeasurement = pa.table({
+        "date": daily["day"],
+        "value": daily["mean"],
+        "measureUnitCode": unit,
+        "chemicalCode": chemicalCode
+    })
+    if "city_ID" in daily.column_names:
+        airMeasurement = airMeasurement.append_column("city_ID", daily["city_ID"])
+    keep = pc.and_(pc.is_valid(unit), pc.is_valid(chemicalCode))
+    #rows referencing a missing dimension row would fail the whole load transaction
+    if knownUnits is not None:
+        keep = pc.and_(keep, pc.is_in(unit, value_set=pa.array(sorted(knownUnits), type=pa.string())))
+    if knownChemicals is not None:
+        keep = pc.and_(keep, pc.is_in(chemicalCode, value_set=pa.array(sorted(knownChemicals), type=pa.string())))
+    return airMeasurement.filter(keep)
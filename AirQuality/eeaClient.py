@@ -0,0 +1,159 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import time
+import requests
+import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+#Api URL
+EEA_API_URL = "https://eeadmz1-downloads-api-appservice.azurewebsites.net"
+#responses of at most this size contain no parquet urls
+EMPTY_RESPONSE_SIZE = 16
+
+class RateLimiter:
+    """
+    Thread safe token bucket allowing requestsPerSecond requests with bursts of up to burst requests.
+    """
+    def __init__(self,requestsPerSecond:float,burst:int=1):
+        self.interval = 1.0 / requestsPerSecond if requestsPerSecond > 0 else 0.0
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.interval == 0.0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) / self.interval)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                waitTime = (1 - self.tokens) * self.interval
+            time.sleep(waitTime)
+
+class EEAClient:
+    """
+    Client for the EEA air quality download API.
+    One keep-alive session is shared by a bounded thread pool, failed requests are retried with exponential backoff.
+    """
+    def __init__(self,baseUrl:str=EEA_API_URL,maxConcurrency:int=16,requestsPerSecond:float=20.0,retries:int=5,backoffFactor:float=0.5,timeout:float=60):
+        """
+        :param baseUrl: url of the api, can point to a local stand-in server
+        :param maxConcurrency: amount of parallel requests and pooled connections
+        :param requestsPerSecond: rate limit over all threads, 0 disables it
+        :param retries: retries per request on connection errors and 429/5xx responses
+        :param backoffFactor: base of the exponential backoff between retries in seconds
+        """
+        self.baseUrl = baseUrl.rstrip("/")
+        self.maxConcurrency = maxConcurrency
+        self.timeout = timeout
+        self.rateLimiter = RateLimiter(requestsPerSecond, burst=maxConcurrency)
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoffFactor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=None,
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=maxConcurrency, pool_maxsize=maxConcurrency, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self,method,path,**kwargs):
+        self.rateLimiter.acquire()
+        return self.session.request(method, f"{self.baseUrl}{path}", timeout=self.timeout, **kwargs)
+
+    def fetchCountries(self):
+        #fetch all available countries
+        countriesResponse = self.request("GET", "/Country")
+        if countriesResponse.status_code != 200:
+            raise Exception(f"Failed to fetch countries: {countriesResponse.status_code}")
+        return countriesResponse.json()
+
+    def fetchCities(self,countryCode):
+        citiesResponse = self.request("POST", "/City", json=[countryCode])
+        if citiesResponse.status_code != 200:
+            raise Exception(f"Failed to fetch cities for {countryCode}: {citiesResponse.status_code}")
+        return citiesResponse.json()
+
+    def fetchCountryCityData(self):
+        """
+        Fetches the cities of all countries concurrently.
+
+        :return: DataFrame with countryCode, countryName and cityName
+        :raises Exception: if the cities of a country could not be fetched after all retries,
+            a listing with missing countries would be cached and used as if it was complete
+        """
+        countries = self.fetchCountries()
+        countryCityData = []
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.maxConcurrency) as executor:
+            futures = {executor.submit(self.fetchCities, country["countryCode"]): country for country in countries}
+            for future in as_completed(futures):
+                country = futures[future]
+                try:
+                    cities = future.result()
+                except Exception as e:
+                    print(f"Failed to fetch cities for {country['countryName']} ({country['countryCode']}): {e}")
+                    failed.append(country["countryCode"])
+                    continue
+                #store result in dictionary
+                for city in cities:
+                    countryCityData.append({
+                        "countryCode": country["countryCode"],
+                        "countryName": country["countryName"],
+                        "cityName": city["cityName"]
+                    })
+        if failed:
+            raise Exception(f"Failed to fetch the cities of {len(failed)} countries: {', '.join(sorted(failed))}")
+        #keep the order of the api independent from the completion order
+        return pd.DataFrame(countryCityData, columns=["countryCode","countryName","cityName"]).sort_values(["countryCode","cityName"], ignore_index=True)
+
+    def fetchParquetUrls(self,countryCode,cityName,dataset,aggregationType="day"):
+        """
+        Fetches the csv listing the parquet file urls of a city.
+        Falls back to hourly data if no daily data exists (not available for dataset 3).
+
+        :return: content of the csv or None if no files exist
+        """
+        aggregationTypes = [aggregationType]
+        if dataset != 3 and aggregationType == "day":
+            aggregationTypes.append("hour")
+        for aggregation in aggregationTypes:
+            #make parquet file request to EEA API
+            request = {
+                "countries": [countryCode],
+                "cities": [cityName],
+                "pollutants": [],
+                "dataset": dataset,
+                "aggregationType": aggregation
+            }
+            response = self.request("POST", "/ParquetFile/urls", json=request)
+            if response.status_code != 200:
+                raise Exception(f"failed to download file for {countryCode} - {cityName}: {response.status_code}")
+            if len(response.content) > EMPTY_RESPONSE_SIZE:
+                return response.content
+        return None
+
+    def fetchUrlManifests(self,jobs):
+        """
+        Fetches the parquet url csv of many cities concurrently.
+
+        :param jobs: iterable of (country code, city name, dataset)
+        :return: generator of ((country code, city name, dataset), csv content or None, exception or None) in completion order,
+            the content of a failed request is None
+        """
+        with ThreadPoolExecutor(max_workers=self.maxConcurrency) as executor:
+            futures = {executor.submit(self.fetchParquetUrls, *job): job for job in jobs}
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result(), None
+                except Exception as e:
+                    yield futures[future], None, e
@@ -0,0 +1,48 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+
+ROLLUP_KEYS = ["month","city_ID","chemicalCode","measureUnitCode"]
+
+#merges the partial aggregates of a file into the rollup, only the months of the file are touched
+UPSERT_QUERY = """
+    INSERT INTO "monthlyAirMeasurement" ("month", "city_ID", "chemicalCode", "measureUnitCode", "sum", "count", "min", "max")
+    VALUES %s
+    ON CONFLICT ("month", "city_ID", "chemicalCode", "measureUnitCode") DO UPDATE SET
+        "sum" = "monthlyAirMeasurement"."sum" + EXCLUDED."sum",
+        "count" = "monthlyAirMeasurement"."count" + EXCLUDED."count",
+        "min" = LEAST("monthlyAirMeasurement"."min", EXCLUDED."min"),
+        "max" = GREATEST("monthlyAirMeasurement"."max", EXCLUDED."max")
+"""
+#same upsert with one row per statement for cursors without execute_values support
+ROW_UPSERT_QUERY = UPSERT_QUERY.replace("VALUES %s", "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)")
+
+def monthlyPartials(airMeasurement:pa.Table):
+    """
+    Aggregates airMeasurement rows (with city_ID) to sum, count, min and max of the daily values per month, city, chemical and unit.
+
+    :return: arrow table sorted by the rollup key
+    """
+    month = pc.floor_temporal(airMeasurement["date"], unit="month")
+    partials = airMeasurement.append_column("month", month).group_by(ROLLUP_KEYS).aggregate([
+        ("value", "sum"),
+        ("value", "count"),
+        ("value", "min"),
+        ("value", "max")
+    ])
+    partials = partials.rename_columns(ROLLUP_KEYS + ["sum","count","min","max"])
+    #workers upsert in key order, so concurrent transactions lock rows in the same order and do not deadlock
+    return partials.sort_by([(key, "ascending") for key in ROLLUP_KEYS])
+
+def upsertMonthlyRollup(cursor,partials:pa.Table):
+    """
+    Merges partial aggregates into the monthlyAirMeasurement table within the transaction of the cursor.
+    """
+    if partials.num_rows == 0:
+        return
+    rows = list(zip(*(partials[column].to_pylist() for column in ROLLUP_KEYS + ["sum","count","min","max"])))
+    if isinstance(cursor, psycopg2.extensions.cursor):
+        execute_values(cursor, UPSERT_QUERY, rows, page_size=1000)
+    else:
+        cursor.executemany(ROW_UPSERT_QUERY, rows)
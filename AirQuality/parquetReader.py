@@ -0,0 +1,78 @@
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from metrics import addFiltered
+from frameSchema import CODE_COLUMNS
+
+#columns of the EEA parquet files needed to build air measurements
+MEASUREMENT_COLUMNS = ["Pollutant","Start","Value","Unit","AggType","Validity"]
+
+def measurementFilter():
+    """
+    Filter pushed down into the parquet scan: drops invalid measurements (Validity == -1) and negative values.
+    """
+    validity = ds.field("Validity")
+    return (validity.is_null() | (validity != -1)) & (ds.field("Value") >= 0)
+
+def droppedFilter():
+    """
+    Complement of measurementFilter: the rows it drops as invalid, negative or missing.
+    """
+    value = ds.field("Value")
+    return (ds.field("Validity") == -1) | value.is_null() | (value < 0)
+
+def iterMeasurementBatches(parquetFilePath,batchSize=65536,record=None,columns=MEASUREMENT_COLUMNS):
+    """
+    Streams the valid measurements of a parquet file as record batches.
+    Only the needed columns are read, invalid rows are dropped by the filter pushed into the scan
+    and row groups are decoded one after another, so memory stays bounded by the batch size and not by the file size.
+    Unit, AggType and the City and Country columns of compacted files are read as dictionaries instead of one string per row.
+
+    :param parquetFilePath: path of an EEA parquet file or a seekable file object holding one, e.g. a streamed download
+    :param batchSize: maximum amount of rows per batch
+    :param record: optional file metrics, counts read rows and the rows dropped as invalid, negative or missing
+        once all batches were read, see countFiltered
+    :param columns: columns to read, MEASUREMENT_COLUMNS and the extra columns of the file
+    """
+    readOptions = ds.ParquetReadOptions(dictionary_columns=[column for column in columns if column in CODE_COLUMNS])
+    fileFormat = ds.ParquetFileFormat(read_options=readOptions)
+    if isinstance(parquetFilePath, str):
+        source = ds.dataset(parquetFilePath, format=fileFormat)
+    else:
+        #a file object is scanned as a single fragment
+        source = fileFormat.make_fragment(parquetFilePath)
+    scanner = source.scanner(
+        columns=columns,
+        filter=measurementFilter(),
+        batch_size=batchSize,
+        batch_readahead=1,
+        fragment_readahead=1
+    )
+    rowsKept = 0
+    for batch in scanner.to_batches():
+        rowsKept += batch.num_rows
+        if batch.num_rows > 0:
+            yield batch
+    if record is not None:
+        countFiltered(source,record,rowsKept)
+
+def countFiltered(source,record,rowsKept):
+    """
+    Adds the read rows and the rows dropped per reason to the file metrics without changing the scan of the data.
+    The amount of rows comes from the parquet metadata, only a file with dropped rows is scanned a second time
+    for the Validity and Value of its dropped rows.
+
+    :param source: dataset or fragment the measurements were scanned from
+    :param rowsKept: rows the filtered scan returned
+    """
+    rowsRead = source.count_rows()
+    record["rowsRead"] += rowsRead
+    if rowsRead == rowsKept:
+        return
+    dropped = source.to_table(columns=["Validity","Value"], filter=droppedFilter())
+    invalid = pc.fill_null(pc.equal(dropped["Validity"], -1), False)
+    value = dropped["Value"]
+    negative = pc.and_not(pc.fill_null(pc.less(value, 0), False), invalid)
+    missing = pc.and_not(pc.is_null(value), invalid)
+    addFiltered(record, "invalidValidity", pc.sum(invalid).as_py() or 0)
+    addFiltered(record, "negativeValue", pc.sum(negative).as_py() or 0)
+    addFiltered(record, "missingValue", pc.sum(missing).as_py() or 0)
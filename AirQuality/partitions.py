@@ -0,0 +1,81 @@
+import datetime
+import pyarrow as pa
+import pyarrow.compute as pc
+
+#first year with a dedicated airMeasurement partition, older rows end up in the default partition
+PARTITION_FIRST_YEAR = 1990
+
+def partitionName(year):
+    return f"airMeasurement_{year}"
+
+def createPartitionedAirMeasurementSQL(firstYear=PARTITION_FIRST_YEAR,lastYear=None,cityHashPartitions=0):
+    """
+    DDL of airMeasurement partitioned by year, one partition per year and a default partition.
+
+    :param lastYear: last year with a dedicated partition, defaults to next year
+    :param cityHashPartitions: if greater than 0 every year is sub partitioned by hash of city_ID into this many partitions
+    """
+    if lastYear is None:
+        lastYear = datetime.date.today().year + 1
+    #the partition keys have to be part of the primary key
+    primaryKey = '"airMeasurement_ID", "date", "city_ID"' if cityHashPartitions > 0 else '"airMeasurement_ID", "date"'
+    statements = [f'''
+CREATE TABLE IF NOT EXISTS "airMeasurement" (
+    "airMeasurement_ID" BIGSERIAL,
+    "date" DATE NOT NULL,
+    "value" FLOAT NOT NULL,
+    "city_ID" INT REFERENCES city("city_ID"),
+    "measureUnitCode" VARCHAR(50) REFERENCES "measureUnit"("measureUnitCode"),
+    "chemicalCode" VARCHAR(50) REFERENCES "chemical"("chemicalCode"),
+    PRIMARY KEY ({primaryKey})
+) PARTITION BY RANGE ("date");''']
+    subPartition = ' PARTITION BY HASH ("city_ID")' if cityHashPartitions > 0 else ""
+    for year in range(firstYear, lastYear + 1):
+        statements.append(
+            f'CREATE TABLE IF NOT EXISTS "{partitionName(year)}" PARTITION OF "airMeasurement" '
+            f"FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01'){subPartition};"
+        )
+        for remainder in range(cityHashPartitions):
+            statements.append(
+                f'CREATE TABLE IF NOT EXISTS "{partitionName(year)}_{remainder}" PARTITION OF "{partitionName(year)}" '
+                f"FOR VALUES WITH (MODULUS {cityHashPartitions}, REMAINDER {remainder});"
+            )
+    statements.append('CREATE TABLE IF NOT EXISTS "airMeasurement_default" PARTITION OF "airMeasurement" DEFAULT;')
+    return "\n".join(statements)
+
+def partitionYears(dataParser):
+    """
+    :return: years with a dedicated airMeasurement partition, empty if the table is not partitioned
+    """
+    #only postgres tables are partitioned
+    if dataParser.backend != "postgres":
+        return set()
+    query = dataParser.makeCall("""
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+        JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+        WHERE parent.relname = 'airMeasurement'
+    """)
+    years = set()
+    for (name,) in query:
+        suffix = name[len("airMeasurement_"):]
+        if suffix.isdigit():
+            years.add(int(suffix))
+    return years
+
+def routeByYear(airMeasurement:pa.Table,years):
+    """
+    Splits airMeasurement rows by the partition of their year so they can be copied into the partition directly.
+    Rows of years without a partition are routed through the parent table.
+
+    :return: list of (table name, rows) pairs
+    """
+    if len(years) == 0:
+        return [("airMeasurement", airMeasurement)]
+    rowYears = pc.year(airMeasurement["date"])
+    routed = []
+    for year in pc.unique(rowYears).to_pylist():
+        rows = airMeasurement.filter(pc.equal(rowYears, year))
+        routed.append((partitionName(year) if year in years else "airMeasurement", rows))
+    return routed
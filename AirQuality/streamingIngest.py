@@ -0,0 +1,62 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import requests
+
+#bytes read from the http stream per chunk
+STREAM_CHUNK_SIZE = 1 << 20
+
+def downloadPath(url,output_folder):
+    #local path of a parquet url, shared by the download and the streaming ingest so their manifest entries match
+    filename = f"{url.split('/')[-3]}_{os.path.basename(url.split('?')[0])}"
+    return os.path.join(output_folder, filename)
+
+def folderBytes(folder,extension):
+    #size of the files with extension below folder, the kept copies of earlier runs count towards the cache budget
+    total = 0
+    for dirpath, _, filenames in os.walk(folder):
+        for filename in filenames:
+            if filename.endswith(extension):
+                total += os.path.getsize(os.path.join(dirpath, filename))
+    return total
+
+def fetchToSpool(url,spoolThreshold,diskBytes,session=None,timeout=60):
+    """
+    Streams a url into a SpooledTemporaryFile, files up to spoolThreshold bytes stay in memory, larger files are spooled to a temporary file.
+
+    :param diskBytes: disk space the spooled file may use, larger files fail instead of exceeding the disk budget
+    :return: spooled file positioned at its start and a dictionary with its size and sha256 content hash
+    """
+    http = session if session is not None else requests
+    spool = tempfile.SpooledTemporaryFile(max_size=spoolThreshold)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with http.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            expectedSize = int(response.headers.get("Content-Length") or 0)
+            if expectedSize > max(spoolThreshold, diskBytes):
+                raise ValueError(f"{url} has {expectedSize / 1e6:.1f} MB which exceeds the disk budget of {diskBytes / 1e6:.1f} MB")
+            for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max(spoolThreshold, diskBytes):
+                    raise ValueError(f"{url} exceeds the disk budget of {diskBytes / 1e6:.1f} MB")
+                digest.update(chunk)
+                spool.write(chunk)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, {"size": size, "contentHash": digest.hexdigest()}
+
+def keepCopy(spool,path):
+    """
+    Writes a spooled download to path, under a temporary name first so a parse of the folder never sees a partial file.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    partialPath = path + ".part"
+    spool.seek(0)
+    with open(partialPath, "wb") as keptFile:
+        shutil.copyfileobj(spool, keptFile, STREAM_CHUNK_SIZE)
+    os.replace(partialPath, path)
@@ -1,6 +1,27 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 from sqlDataParser import DataParser
+from loadManifest import LoadManifest, hashFile
+from metrics import RunMetrics, defaultRunMetrics, fileRecord, addFiltered, peakRssMB, profiled
+from dimensionRegistry import DimensionRegistry
+from taskGraph import POOL_CONTEXT
+from frameSchema import MemoryBudget, defaultMemoryBudget, compactFrame, concatFrames, dictionaryColumns, parquetBytesPerRow
 import os
+import time
+
+
+def isInSorted(values,sortedValues):
+    #membership test by binary search, np.isin would sort the whole hash array again on every call
+    if len(sortedValues) == 0:
+        return np.zeros(len(values), dtype=bool)
+    index = np.minimum(np.searchsorted(sortedValues, values), len(sortedValues) - 1)
+    return sortedValues[index] == values
+
+def mergeSorted(sortedValues,newValues):
+    #both arrays are sorted runs, the stable sort merges them in linear time
+    return np.sort(np.concatenate([sortedValues, newValues]), kind="stable")
 
 
 class EDGARData():
@@ -8,59 +29,224 @@ class EDGARData():
     Class Responsible for parsing EDGAR data.
     """
     
-    def __init__(self,dataParser:DataParser):
+    def __init__(self,dataParser:DataParser,max_workers:int=4,cacheFolder:str=os.path.join("EDGAR_Emissions","cache"),batchSize:int=None,metrics:RunMetrics=defaultRunMetrics,dimensions:DimensionRegistry=None,memoryBudget:MemoryBudget=defaultMemoryBudget):
+        """
+        :param max_workers: amount of processes converting workbooks
+        :param cacheFolder: folder of the parquet files converted from the workbooks
+        :param batchSize: amount of emission rows per batch in streaming mode, sized from the memory budget if not given
+        :param metrics: collects the metrics of every loaded workbook
+        :param dimensions: registry of the dimension keys shared with the other loaders, a registry is created if not given
+        :param memoryBudget: memory the emission batches may use
+        """
         self.dataParser = dataParser
+        self.metrics = metrics
+        self.dimensions = dimensions if dimensions is not None else DimensionRegistry(dataParser)
+        self.loadManifest = LoadManifest(dataParser)
+        self.max_workers = max_workers
+        self.cacheFolder = cacheFolder
+        self.batchSize = batchSize
+        self.memoryBudget = memoryBudget
 
-    def parseEdgarData(self):
+    def parseEdgarData(self,streaming:bool=False):
+        """
+        :param streaming: load every workbook in batches as soon as it is converted instead of loading all workbooks at once
+        """
         #Emissions Database for Global Atmospheric Research Dataset, Greenhouse Gas information comes in the form of multiple xlsx files
         EDGAREmissionDataList = ["IEA_EDGAR_CO2_1970_2023.xlsx","EDGAR_N2O_1970_2023.xlsx","EDGAR_F-gases_1990_2023.xlsx","EDGAR_CO2bio_1970_2023.xlsx","EDGAR_CH4_1970_2023.xlsx","EDGAR_AR5g_F-gases_1990_2023.xlsx","EDGAR_AR5_GHG_1970_2023.xlsx"]
-        #These are the tables we are interested in creating from this dataset
-        emissionDataAll =  pd.DataFrame()
-        sectorAll = pd.DataFrame()
-        chemicalAll = pd.DataFrame()
         #measureUnit for all datasets is the same 
         measureUnit = pd.DataFrame({'measureUnitCode': ['Gg'], 'name': ['Gigagrams']})
-        #they have very similiar structure so we can use the same procedure to build our dataframes
-        for data in EDGAREmissionDataList:
-            #read excel file
-            edgarData = pd.read_excel(os.path.join("EDGAR_Emissions","data",data), sheet_name='IPCC 2006',header=9)
-            #sector data
-            sector = edgarData[["ipcc_code_2006_for_standard_report","ipcc_code_2006_for_standard_report_name"]].drop_duplicates()
-            sector = sector.rename(columns={"ipcc_code_2006_for_standard_report": "sectorCode", "ipcc_code_2006_for_standard_report_name": "name"})
-            #chemical data
-            chemical = edgarData[["Substance"]].drop_duplicates().rename(columns={"Substance": "chemicalCode"})
-            chemical['name'] = pd.NA
-            #emission data
-            #transform individual year columns into one year and value column
-            emissionData = pd.melt(frame = edgarData, 
-                                id_vars=['IPCC_annex','Country_code_A3','ipcc_code_2006_for_standard_report','Substance','fossil_bio'], 
-                                var_name='year', 
-                                value_vars=edgarData.columns[9:],
-                                value_name='value'
-                            )
-            #bring data to form of sql database
-            emissionData = emissionData.drop('IPCC_annex',axis = 1)
-            emissionData['year'] = emissionData['year'].str.replace('Y_', '').astype(int)
-            emissionData['value'] = emissionData['value'].astype(float)
-            emissionData = emissionData.rename(columns={"Country_code_A3": "countryCode","ipcc_code_2006_for_standard_report":"sectorCode","Substance":"chemicalCode"})
-            #Append to rest of data
-            emissionDataAll = pd.concat([emissionDataAll,emissionData],ignore_index=True)
-            sectorAll = pd.concat([sectorAll,sector],ignore_index=True)
-            chemicalAll = pd.concat([chemicalAll,chemical],ignore_index=True)
+        #workbooks loaded by a previous run are skipped
+        loadedSources = self.loadManifest.loadedSources("emissionData")
+        workbookPaths = [os.path.join("EDGAR_Emissions","data",data) for data in EDGAREmissionDataList]
+        workbookPaths = [path for path in workbookPaths if not self.loadManifest.isLoaded(path,"emissionData",loadedSources)]
+        if len(workbookPaths) == 0:
+            print("All EDGAR workbooks were loaded by a previous run.")
+            return
+        if streaming:
+            self.streamEdgarData(workbookPaths,measureUnit)
+            return
+        start = time.perf_counter()
+        #all workbooks are loaded by one transaction, they share one metrics record
+        record = fileRecord(workbookPaths[0],"edgar")
+        record["source"] = [os.path.basename(path) for path in workbookPaths]
+        record["bytesRead"] = sum(os.path.getsize(path) for path in workbookPaths)
+        #workbooks are converted in parallel, every conversion is cached as parquet
+        converted = self.convertWorkbooks(workbookPaths)
+        #concatenate once instead of growing the frames inside the loop
+        emissionDataAll = concatFrames(compactFrame(pd.read_parquet(paths["emissionData"])) for paths in converted)
+        record["rowsRead"] = len(emissionDataAll)
+        sectorAll = pd.concat([pd.read_parquet(paths["sector"]) for paths in converted],ignore_index=True)
+        chemicalAll = pd.concat([pd.read_parquet(paths["chemical"]) for paths in converted],ignore_index=True)
 
         #Add measure unit
-        emissionDataAll["measureUnitCode"] = "Gg"
-        #drop potential duplicate data from concatenation
-        emissionDataAll = emissionDataAll.drop_duplicates()
-        sectorAll = sectorAll.drop_duplicates()
-        chemicalAll = chemicalAll.drop_duplicates()
+        emissionDataAll["measureUnitCode"] = pd.Categorical(["Gg"] * len(emissionDataAll))
         #Drop null values
+        rowsBefore = len(emissionDataAll)
         emissionDataAll = emissionDataAll.dropna(subset=["value"])
-        #Drop invalid country codes
-        queryCodes = self.dataParser.makeCall("""SELECT DISTINCT "countryCode" FROM country""")
-        countryCodes = [item[0] for item in queryCodes]
-        emissionDataAll = emissionDataAll[emissionDataAll['countryCode'].isin(countryCodes)]
-        self.dataParser.parsePandaDFToTable(chemicalAll,"chemical")
-        self.dataParser.parsePandaDFToTable(measureUnit,"measureUnit")
-        self.dataParser.parsePandaDFToTable(sectorAll,"sector")
-        self.dataParser.parsePandaDFToTable(emissionDataAll,"emissionData")
+        addFiltered(record,"missingValue",rowsBefore - len(emissionDataAll))
+        #the merge load method drops duplicates and invalid country codes in the database
+        if not self.dataParser.merges("emissionData"):
+            #drop potential duplicate data from concatenation
+            rowsBefore = len(emissionDataAll)
+            emissionDataAll = emissionDataAll.drop_duplicates()
+            addFiltered(record,"duplicate",rowsBefore - len(emissionDataAll))
+            #Drop invalid country codes
+            countryCodes = self.dimensions.keys("country")
+            rowsBefore = len(emissionDataAll)
+            emissionDataAll = emissionDataAll[emissionDataAll['countryCode'].isin(countryCodes)]
+            addFiltered(record,"unknownCountry",rowsBefore - len(emissionDataAll))
+        record["rowsOut"] = len(emissionDataAll)
+        #dimension rows written by a previous run or another loader are skipped
+        self.dimensions.upsert("chemical",chemicalAll)
+        self.dimensions.upsert("measureUnit",measureUnit)
+        self.dimensions.upsert("sector",sectorAll)
+        #emission rows and manifest entries of the workbooks are committed together
+        markLoaded = self.loadManifest.markLoadedInTransaction(workbookPaths,"emissionData",len(emissionDataAll))
+        writeStart = time.perf_counter()
+        record["rowsWritten"] = self.dataParser.parsePandaDFToTable(emissionDataAll,"emissionData",inTransaction=markLoaded)
+        record["dbWriteSeconds"] = time.perf_counter() - writeStart
+        if record["rowsWritten"] == 0 and record["rowsOut"] > 0:
+            record["error"] = "The load transaction failed."
+        record["seconds"] = time.perf_counter() - start
+        record["peakRssMB"] = peakRssMB()
+        self.metrics.addFile(record)
+
+    def streamEdgarData(self,workbookPaths,measureUnit):
+        """
+        Loads the workbooks one after another as their conversions finish.
+        Emission rows are read from the converted parquet file in batches of batchSize rows (or as many rows as the memory budget allows), filtered against the known
+        country codes, deduplicated by row hash and copied within one transaction per workbook.
+        Memory is bounded by the batch size and the 8 byte hashes of the loaded rows.
+        """
+        countryCodes = self.dimensions.keys("country")
+        self.dimensions.upsert("measureUnit",measureUnit)
+        #hashes of all emission rows loaded so far, kept sorted for the lookup
+        seenHashes = np.empty(0, dtype=np.uint64)
+        with ProcessPoolExecutor(max_workers=min(self.max_workers, len(workbookPaths)),mp_context=POOL_CONTEXT) as executor:
+            futures = {executor.submit(EDGARData.convertWorkbook, path, self.cacheFolder): path for path in workbookPaths}
+            for future in as_completed(futures):
+                workbookPath = futures[future]
+                start = time.perf_counter()
+                record = fileRecord(workbookPath,"edgar")
+                try:
+                    cachePaths = future.result()
+                except Exception as e:
+                    print(f"Caught exception while converting {workbookPath}: {e}")
+                    self.metrics.addFailure(workbookPath,"edgar",e)
+                    continue
+                #dimension rows have to exist before the emission rows referencing them
+                self.dimensions.upsert("chemical",pd.read_parquet(cachePaths["chemical"]))
+                self.dimensions.upsert("sector",pd.read_parquet(cachePaths["sector"]))
+                loaded = {"rows": 0, "hashes": np.empty(0, dtype=np.uint64), "record": record}
+                markLoaded = self.loadManifest.markLoadedInTransaction(workbookPath,"emissionData",lambda: loaded["rows"])
+                batches = self.emissionBatches(cachePaths["emissionData"],countryCodes,seenHashes,loaded)
+                #the batches are read while the transaction copies them, the write time includes reading the cached parquet file
+                writeStart = time.perf_counter()
+                record["rowsWritten"] = self.dataParser.parseFramesToTable(batches,"emissionData",inTransaction=markLoaded)
+                record["dbWriteSeconds"] = time.perf_counter() - writeStart
+                record["rowsOut"] = loaded["rows"]
+                #only rows of committed workbooks count as seen
+                if record["rowsWritten"] > 0 and len(loaded["hashes"]) > 0:
+                    seenHashes = mergeSorted(seenHashes, loaded["hashes"])
+                elif loaded["rows"] > 0:
+                    record["error"] = "The load transaction failed."
+                record["seconds"] = time.perf_counter() - start
+                record["peakRssMB"] = peakRssMB()
+                self.metrics.addFile(record)
+
+    def emissionBatches(self,emissionDataPath,countryCodes,seenHashes,loaded):
+        """
+        Yields the filtered and deduplicated emission rows of a converted workbook in batches.
+
+        :param seenHashes: sorted hashes of the rows loaded from previous workbooks
+        :param loaded: collects the amount of rows, the sorted row hashes and the metrics record of this workbook
+        """
+        record = loaded["record"]
+        #the merge load method drops duplicates and invalid country codes in the database
+        merged = self.dataParser.merges("emissionData")
+        batchSize = self.batchSize or self.memoryBudget.rowsFor(parquetBytesPerRow(emissionDataPath))
+        #codes are read as categories instead of one python string per row
+        parquetFile = pq.ParquetFile(emissionDataPath, read_dictionary=dictionaryColumns(emissionDataPath))
+        for batch in parquetFile.iter_batches(batch_size=batchSize):
+            emissionData = batch.to_pandas()
+            record["rowsRead"] += len(emissionData)
+            #Add measure unit
+            emissionData["measureUnitCode"] = "Gg"
+            emissionData = compactFrame(emissionData)
+            #Drop null values and invalid country codes
+            rowsBefore = len(emissionData)
+            emissionData = emissionData.dropna(subset=["value"])
+            addFiltered(record,"missingValue",rowsBefore - len(emissionData))
+            if merged:
+                loaded["rows"] += len(emissionData)
+                yield emissionData
+                continue
+            rowsBefore = len(emissionData)
+            emissionData = emissionData[emissionData['countryCode'].isin(countryCodes)]
+            addFiltered(record,"unknownCountry",rowsBefore - len(emissionData))
+            #drop duplicates within the batch, of previous batches and of previous workbooks
+            rowHashes = pd.util.hash_pandas_object(emissionData, index=False).to_numpy()
+            _, firstIndex = np.unique(rowHashes, return_index=True)
+            keep = np.zeros(len(rowHashes), dtype=bool)
+            keep[firstIndex] = True
+            keep &= ~isInSorted(rowHashes, seenHashes)
+            keep &= ~isInSorted(rowHashes, loaded["hashes"])
+            addFiltered(record,"duplicate",len(keep) - int(keep.sum()))
+            emissionData = emissionData[keep]
+            if len(emissionData) == 0:
+                continue
+            loaded["hashes"] = mergeSorted(loaded["hashes"], np.sort(rowHashes[keep]))
+            loaded["rows"] += len(emissionData)
+            yield emissionData
+
+    def convertWorkbooks(self,workbookPaths):
+        """
+        Converts the workbooks with one process per workbook.
+
+        :return: list of dictionaries with the cached parquet path of the emissionData, sector and chemical frame per workbook
+        """
+        with ProcessPoolExecutor(max_workers=min(self.max_workers, len(workbookPaths)),mp_context=POOL_CONTEXT) as executor:
+            return list(executor.map(EDGARData.convertWorkbook, workbookPaths, [self.cacheFolder] * len(workbookPaths)))
+
+    #method is static due to multi processing
+    @staticmethod
+    @profiled("convertWorkbook")
+    def convertWorkbook(workbookPath,cacheFolder):
+        """
+        Converts a workbook into the emissionData, sector and chemical frames and caches them as parquet files.
+        The cache is keyed by the content hash of the workbook, a changed workbook is converted again.
+        """
+        workbookName = os.path.splitext(os.path.basename(workbookPath))[0]
+        cacheBase = os.path.join(cacheFolder, f"{workbookName}-{hashFile(workbookPath)[:16]}")
+        cachePaths = {table: f"{cacheBase}.{table}.parquet" for table in ("emissionData","sector","chemical")}
+        if all(os.path.exists(path) for path in cachePaths.values()):
+            return cachePaths
+        #read excel file
+        edgarData = pd.read_excel(workbookPath, sheet_name='IPCC 2006',header=9)
+        #sector data
+        sector = edgarData[["ipcc_code_2006_for_standard_report","ipcc_code_2006_for_standard_report_name"]].drop_duplicates()
+        sector = sector.rename(columns={"ipcc_code_2006_for_standard_report": "sectorCode", "ipcc_code_2006_for_standard_report_name": "name"})
+        #chemical data
+        chemical = edgarData[["Substance"]].drop_duplicates().rename(columns={"Substance": "chemicalCode"})
+        chemical['name'] = pd.Series(pd.NA, index=chemical.index, dtype="string")
+        #emission data
+        #codes are repeated once per year by the melt, as categories every code is stored once
+        edgarData = compactFrame(edgarData.rename(columns={"Country_code_A3": "countryCode","ipcc_code_2006_for_standard_report":"sectorCode","Substance":"chemicalCode"}))
+        #transform individual year columns into one year and value column
+        emissionData = pd.melt(frame = edgarData, 
+                            id_vars=['IPCC_annex','countryCode','sectorCode','chemicalCode','fossil_bio'], 
+                            var_name='year', 
+                            value_vars=edgarData.columns[9:],
+                            value_name='value'
+                        )
+        #bring data to form of sql database
+        emissionData = emissionData.drop('IPCC_annex',axis = 1)
+        emissionData['year'] = emissionData['year'].str.replace('Y_', '').astype("int16")
+        emissionData['value'] = emissionData['value'].astype(float)
+        os.makedirs(cacheFolder, exist_ok=True)
+        for table, frame in (("emissionData",emissionData),("sector",sector),("chemical",chemical)):
+            #write to a temporary name so an interrupted conversion is never mistaken for a cache hit
+            temporaryPath = f"{cachePaths[table]}.{os.getpid()}.tmp"
+            frame.to_parquet(temporaryPath, index=False)
+            os.replace(temporaryPath, cachePaths[table])
+        return cachePaths
@@ -1,27 +1,74 @@
-import pandas as pd
 from sqlDataParser import DataParser
-import os
+from loadManifest import LoadManifest
+from sourceLoader import SourceStore, defaultSourceStore
+from metrics import RunMetrics, defaultRunMetrics, fileRecord, addFiltered, peakRssMB
+from dimensionRegistry import DimensionRegistry
+import time
 
 class OWIDDataset:
-    def __init__(self,dataParser:DataParser):
+    def __init__(self,dataParser:DataParser,sourceStore:SourceStore=defaultSourceStore,metrics:RunMetrics=defaultRunMetrics,dimensions:DimensionRegistry=None):
         self.dataParser = dataParser
+        self.metrics = metrics
+        self.dimensions = dimensions if dimensions is not None else DimensionRegistry(dataParser)
+        self.loadManifest = LoadManifest(dataParser)
+        #the csv is read once and shared by parseCountries and parseCountryInfomation
+        self.sourceStore = sourceStore
+        self.sourcePath = sourceStore.path("owid")
 
     def parseCountries(self):
-        owidData = pd.read_csv(os.path.join("OWID","owid-co2-data.csv"))
+        if self.loadManifest.isLoaded(self.sourcePath,"country"):
+            print("OWID countries were loaded by a previous run.")
+            return
+        start = time.perf_counter()
+        record = fileRecord(self.sourcePath,"owid.country")
+        owidData = self.sourceStore.load("owid")
+        record["rowsRead"] = len(owidData)
         #keep relevant country data, remove duplicate rows and null value iso_codes
-        country = owidData[["iso_code","country"]].drop_duplicates().dropna(subset=["iso_code"])
+        country = owidData[["iso_code","country"]].drop_duplicates()
+        addFiltered(record,"duplicate",len(owidData) - len(country))
+        rowsBefore = len(country)
+        country = country.dropna(subset=["iso_code"])
+        addFiltered(record,"missingIsoCode",rowsBefore - len(country))
         #rename columns according to sql database
         country = country.rename(columns={"iso_code": "countryCode", "country": "name"})
-        self.dataParser.parsePandaDFToTable(country,"country")
+        record["rowsOut"] = len(country)
+        markLoaded = self.loadManifest.markLoadedInTransaction(self.sourcePath,"country",len(country))
+        self.loadAndRecord(country,"country",markLoaded,record,start,dimension="country")
 
     def parseCountryInfomation(self):
-        owidData = pd.read_csv(os.path.join("OWID","owid-co2-data.csv"))
+        if self.loadManifest.isLoaded(self.sourcePath,"countryInfo"):
+            print("OWID country information was loaded by a previous run.")
+            return
+        start = time.perf_counter()
+        record = fileRecord(self.sourcePath,"owid.countryInfo")
+        owidData = self.sourceStore.load("owid")
+        record["rowsRead"] = len(owidData)
         #tranform to desired form
         owidData = owidData[["year","iso_code","population","gdp","energy_per_capita"]]
         owidData = owidData.dropna(subset=["iso_code"])
+        addFiltered(record,"missingIsoCode",record["rowsRead"] - len(owidData))
+        record["rowsOut"] = len(owidData)
         owidData = owidData.rename(columns={"iso_code": "countryCode", "energy_per_capita": "energyConsumptionPerCapita"})
         #fill nan values with -1
         owidData["population"] = owidData["population"].fillna(-1).astype(int)
         owidData["gdp"] = owidData["gdp"].fillna(-1).astype(int)
-        self.dataParser.parsePandaDFToTable(owidData,"countryInfo")
+        markLoaded = self.loadManifest.markLoadedInTransaction(self.sourcePath,"countryInfo",len(owidData))
+        self.loadAndRecord(owidData,"countryInfo",markLoaded,record,start)
+
+    def loadAndRecord(self,dataframe,tableName,markLoaded,record,start,dimension=None):
+        """
+        :param dimension: name of the dimension if the rows are inserted through the dimension registry
+        """
+        writeStart = time.perf_counter()
+        if dimension is not None:
+            record["rowsWritten"] = self.dimensions.upsert(dimension,dataframe,inTransaction=markLoaded)
+        else:
+            record["rowsWritten"] = self.dataParser.parsePandaDFToTable(dataframe,tableName,inTransaction=markLoaded)
+        record["dbWriteSeconds"] = time.perf_counter() - writeStart
+        record["seconds"] = time.perf_counter() - start
+        #the manifest entry is committed in the transaction of the rows, a load writing no new row can still succeed
+        if not self.loadManifest.isLoaded(self.sourcePath,tableName):
+            record["error"] = "The load transaction failed."
+        record["peakRssMB"] = peakRssMB()
+        self.metrics.addFile(record)
 
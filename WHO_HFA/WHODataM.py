@@ -1,17 +1,38 @@
-import pandas as pd
 from sqlDataParser import DataParser
-import os
+from loadManifest import LoadManifest
+from sourceLoader import SourceStore, defaultSourceStore
+from metrics import RunMetrics, defaultRunMetrics, fileRecord, addFiltered, peakRssMB
+import time
 
 class WHOData:
-    def __init__(self,dataParser:DataParser):
+    def __init__(self,dataParser:DataParser,sourceStore:SourceStore=defaultSourceStore,metrics:RunMetrics=defaultRunMetrics):
         self.dataParser = dataParser
+        self.metrics = metrics
+        self.loadManifest = LoadManifest(dataParser)
+        self.sourceStore = sourceStore
 
     def parseWHOData(self):
-        column_names = ["countryCode", "COUNTRY_GRP", "SEX", "year", "rate"]
-        who_data = pd.read_csv(os.path.join("WHO_HFA","HFA_221_EN.csv"), skiprows=26, names=column_names, header=None)
+        sourcePath = self.sourceStore.path("who")
+        if self.loadManifest.isLoaded(sourcePath,"sDRRespiratoryDisease"):
+            print("HFA data was loaded by a previous run.")
+            return
+        start = time.perf_counter()
+        record = fileRecord(sourcePath,"who")
+        who_data = self.sourceStore.load("who")
+        record["rowsRead"] = len(who_data)
         who_data = who_data[["countryCode","year","rate"]]
         who_data = who_data.dropna(subset=["year", "rate", "countryCode"])
+        addFiltered(record,"missingValue",record["rowsRead"] - len(who_data))
+        record["rowsOut"] = len(who_data)
         who_data["year"] = who_data["year"].astype(int)
-        self.dataParser.parsePandaDFToTable(who_data,"sDRRespiratoryDisease")
+        markLoaded = self.loadManifest.markLoadedInTransaction(sourcePath,"sDRRespiratoryDisease",len(who_data))
+        writeStart = time.perf_counter()
+        record["rowsWritten"] = self.dataParser.parsePandaDFToTable(who_data,"sDRRespiratoryDisease",inTransaction=markLoaded)
+        record["dbWriteSeconds"] = time.perf_counter() - writeStart
+        record["seconds"] = time.perf_counter() - start
+        if record["rowsWritten"] == 0 and record["rowsOut"] > 0:
+            record["error"] = "The load transaction failed."
+        record["peakRssMB"] = peakRssMB()
+        self.metrics.addFile(record)
 
 
@@ -0,0 +1,330 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from sqlDataParser import DataParser
+from loadManifest import LoadManifest
+
+#emissions of one chemical per country, year and sector, fossil and bio emissions are summed
+EMISSION_QUERY = """
+    SELECT "countryCode", "year", "sectorCode" AS "key", sum("value") AS "value"
+    FROM "emissionData"
+    WHERE "chemicalCode" = %(chemicalCode)s
+    GROUP BY "countryCode", "year", "sectorCode"
+"""
+
+#mean of the daily values of all cities of a country, the rollup holds sum and count per month so no daily row is read
+ROLLUP_CONCENTRATION_QUERY = """
+    SELECT c."countryCode", CAST(EXTRACT(YEAR FROM m."month") AS INT) AS "year", m."chemicalCode" AS "key",
+        sum(m."sum") / sum(m."count") AS "value"
+    FROM "monthlyAirMeasurement" m JOIN "city" c ON c."city_ID" = m."city_ID"
+    WHERE m."measureUnitCode" = %(measureUnitCode)s AND c."countryCode" IS NOT NULL
+    GROUP BY c."countryCode", CAST(EXTRACT(YEAR FROM m."month") AS INT), m."chemicalCode"
+"""
+
+#same mean read from the daily rows, for databases loaded before the rollup existed
+DAILY_CONCENTRATION_QUERY = """
+    SELECT c."countryCode", CAST(EXTRACT(YEAR FROM a."date") AS INT) AS "year", a."chemicalCode" AS "key",
+        avg(a."value") AS "value"
+    FROM "airMeasurement" a JOIN "city" c ON c."city_ID" = a."city_ID"
+    WHERE a."measureUnitCode" = %(measureUnitCode)s AND c."countryCode" IS NOT NULL
+    GROUP BY c."countryCode", CAST(EXTRACT(YEAR FROM a."date") AS INT), a."chemicalCode"
+"""
+
+RESPIRATORY_QUERY = """
+    SELECT "countryCode", "year", "rate" AS "respiratoryRate" FROM "sDRRespiratoryDisease"
+"""
+
+COUNTRY_INFO_QUERY = """
+    SELECT "countryCode", "year", "population", "gdp" FROM "countryInfo"
+"""
+
+#panel column name of a sector and of a pollutant
+EMISSION_PREFIX = "emission_"
+CONCENTRATION_PREFIX = "concentration_"
+
+#variances at or below this many rounding errors of the values are treated as zero, the column is constant then
+VARIANCE_TOLERANCE = 16 * np.finfo(np.float64).eps
+
+def varianceTolerance(count,scale,squares):
+    """
+    Largest variance rounding can produce for a constant column.
+
+    :param count: amount of rows the variance is based on
+    :param scale: largest absolute value of the column before it was centered
+    :param squares: sum of squares of the centered values
+    """
+    return count * (VARIANCE_TOLERANCE * scale) ** 2 + VARIANCE_TOLERANCE * squares
+
+def pairwiseCorrelation(matrix,minPeriods:int=3):
+    """
+    Pearson correlation of every pair of columns over the rows where both columns have a value.
+
+    :param matrix: float matrix with one column per variable, NaN where a value is missing
+    :return: (correlation matrix, matrix with the amount of rows every correlation is based on),
+        NaN where fewer than minPeriods rows are shared or a column is constant
+    """
+    present = ~np.isnan(matrix)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        #every column is centered on its mean first, a large mean would cancel out the digits of the variance otherwise
+        mean = np.where(present, matrix, 0.0).sum(axis=0) / present.sum(axis=0)
+    values = np.where(present, matrix - mean, 0.0)
+    scale = np.where(present, np.abs(matrix), 0.0).max(axis=0, initial=0.0)
+    present = present.astype(np.float64)
+    #sums of column i over the rows shared with column j, computed for all pairs at once by matrix products
+    count = present.T @ present
+    sums = values.T @ present
+    squares = (values * values).T @ present
+    products = values.T @ values
+    with np.errstate(divide="ignore", invalid="ignore"):
+        covariance = products - sums * sums.T / count
+        variance = squares - sums * sums / count
+        constant = variance <= varianceTolerance(count, scale[:, None], squares)
+        correlation = covariance / np.sqrt(variance * variance.T)
+    correlation[(count < minPeriods) | constant | constant.T] = np.nan
+    return correlation, count.astype(np.int64)
+
+def correlateWith(matrix,target,minPeriods:int=3):
+    """
+    Pearson correlation of every column of matrix with target over the rows where both have a value.
+
+    :return: (correlations, amount of rows every correlation is based on)
+    """
+    present = ~np.isnan(matrix) & ~np.isnan(target)[:, None]
+    count = present.sum(axis=0)
+    x = np.where(present, matrix, 0.0)
+    y = np.where(present, target[:, None], 0.0)
+    scaleX = np.abs(x).max(axis=0, initial=0.0)
+    scaleY = np.abs(y).max(axis=0, initial=0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        #both sides are centered on their mean over the shared rows before the products
+        x = np.where(present, x - x.sum(axis=0) / count, 0.0)
+        y = np.where(present, y - y.sum(axis=0) / count, 0.0)
+        squaresX = (x * x).sum(axis=0)
+        squaresY = (y * y).sum(axis=0)
+        constant = (squaresX <= varianceTolerance(count, scaleX, squaresX)) | (squaresY <= varianceTolerance(count, scaleY, squaresY))
+        correlation = (x * y).sum(axis=0) / np.sqrt(squaresX * squaresY)
+    correlation[(count < minPeriods) | constant] = np.nan
+    return correlation, count
+
+class Panel:
+    """
+    Country×year panel of the datasets. Every column is a read only float64 matrix with one row per country
+    and one column per year, NaN where a dataset has no value. Years are contiguous, a lag is a shift along the year axis.
+    """
+    def __init__(self,countries,years,columns):
+        """
+        :param countries: sorted numpy array of country codes
+        :param years: numpy array of contiguous years
+        :param columns: dictionary of column name to matrix
+        """
+        self.countries = countries
+        self.years = years
+        self.columns = columns
+        for matrix in columns.values():
+            #panels are shared through the cache, callers must not change them
+            matrix.flags.writeable = False
+
+    def names(self):
+        return list(self.columns)
+
+    def __getitem__(self,name):
+        return self.columns[name]
+
+    def lagged(self,name,lag:int):
+        """
+        :return: matrix of the column where every cell holds the value of lag years earlier, negative lags look ahead
+        """
+        matrix = self.columns[name]
+        shifted = np.full(matrix.shape, np.nan)
+        if abs(lag) >= matrix.shape[1]:
+            return shifted
+        if lag >= 0:
+            shifted[:, lag:] = matrix[:, :matrix.shape[1] - lag]
+        else:
+            shifted[:, :lag] = matrix[:, -lag:]
+        return shifted
+
+    def toArrow(self,names=None):
+        """
+        :return: arrow table with one row per country and year that has a value in any of the columns
+        """
+        names = names or self.names()
+        stacked = np.stack([self.columns[name].ravel() for name in names], axis=1)
+        keep = ~np.isnan(stacked).all(axis=1)
+        countries = np.repeat(self.countries, len(self.years))[keep]
+        years = np.tile(self.years, len(self.countries))[keep]
+        arrays = [pa.array(countries, pa.string()), pa.array(years, pa.int32())]
+        arrays += [pa.array(stacked[keep, i], from_pandas=True) for i in range(len(names))]
+        return pa.Table.from_arrays(arrays, names=["countryCode", "year"] + names)
+
+def columnArray(table,name,dataType):
+    #nulls become NaN, an empty result has null typed columns
+    return pc.cast(table[name], dataType).to_numpy(zero_copy_only=False)
+
+def buildPanel(tables):
+    """
+    Scatters query results into one panel.
+
+    :param tables: list of (arrow table with countryCode and year, prefix) where a table with a key column
+        is pivoted into one panel column per key (prefix + key) from its value column,
+        the other columns of a table without a key column become panel columns
+    """
+    codes = [columnArray(table, "countryCode", pa.string()) for table, _ in tables]
+    years = [columnArray(table, "year", pa.int32()) for table, _ in tables]
+    countries = np.unique(np.concatenate(codes).astype(str)) if codes else np.array([], dtype=str)
+    allYears = np.concatenate(years) if years else np.array([], dtype=np.int32)
+    yearRange = np.arange(allYears.min(), allYears.max() + 1) if len(allYears) else np.array([], dtype=np.int32)
+    columns = {}
+    for (table, prefix), tableCodes, tableYears in zip(tables, codes, years):
+        rows = np.searchsorted(countries, tableCodes.astype(str))
+        cells = tableYears - (yearRange[0] if len(yearRange) else 0)
+        if "key" in table.column_names:
+            keys, keyIndex = np.unique(columnArray(table, "key", pa.string()).astype(str), return_inverse=True)
+            cube = np.full((len(keys), len(countries), len(yearRange)), np.nan)
+            cube[keyIndex, rows, cells] = columnArray(table, "value", pa.float64())
+            for i, key in enumerate(keys):
+                columns[prefix + key] = cube[i]
+            continue
+        for name in table.column_names:
+            if name in ("countryCode", "year"):
+                continue
+            matrix = np.full((len(countries), len(yearRange)), np.nan)
+            matrix[rows, cells] = columnArray(table, name, pa.float64())
+            columns[name] = matrix
+    return Panel(countries, yearRange, columns)
+
+class ResultCache:
+    """
+    Keeps the most recently used results, every result is dropped once the data version changed.
+    """
+    def __init__(self,maxEntries:int=32):
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.version = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self,key,version,compute):
+        """
+        :param compute: function computing the result if it is not cached for this version
+        """
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        #computed outside the lock, concurrent callers of different results do not wait for each other
+        result = compute()
+        with self.lock:
+            if version == self.version:
+                self.entries[key] = result
+                while len(self.entries) > self.maxEntries:
+                    self.entries.popitem(last=False)
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.version = None
+
+class Analytics:
+    """
+    Country×year panels of emissions per sector, mean pollutant concentrations, the respiratory death rate,
+    population and GDP with correlations between them. Query results are fetched as arrow columns and
+    all computations run on numpy matrices. Results are cached until a loader commits new rows.
+    """
+    def __init__(self,dataParser:DataParser,cacheSize:int=32):
+        """
+        :param cacheSize: amount of panels and correlation tables kept in the cache
+        """
+        self.dataParser = dataParser
+        self.loadManifest = LoadManifest(dataParser)
+        self.cache = ResultCache(cacheSize)
+
+    def dataVersion(self):
+        #every loader records its sources in the manifest in the transaction of its rows,
+        #rows loaded by this process are counted as well in case a load bypassed the manifest
+        loadedRows = sum(rows for rows, _ in list(self.dataParser.loadStats.values()))
+        return self.loadManifest.version() + (loadedRows,)
+
+    def cached(self,key,compute):
+        return self.cache.get(key, self.dataVersion(), compute)
+
+    def panel(self,emissionChemical:str="CO2",pollutants=None,measureUnitCode:str="ug.m-3",fromRollup:bool=True):
+        """
+        :param emissionChemical: chemical code of the emissions, the panel holds one emission column per sector
+        :param pollutants: chemical codes of the pollutants with a concentration column, all pollutants if None
+        :param measureUnitCode: unit of the concentrations, measurements in other units are left out
+        :param fromRollup: read the concentrations from monthlyAirMeasurement instead of airMeasurement
+        :return: Panel with the columns emission_<sector>, concentration_<pollutant>, respiratoryRate, population and gdp
+        """
+        key = self.panelKey(emissionChemical, pollutants, measureUnitCode, fromRollup)
+        return self.cached(key, lambda: self.computePanel(*key[1:]))
+
+    @staticmethod
+    def panelKey(emissionChemical:str="CO2",pollutants=None,measureUnitCode:str="ug.m-3",fromRollup:bool=True):
+        #cache key of a panel, the results computed from it include it in their keys
+        pollutants = tuple(sorted(pollutants)) if pollutants is not None else None
+        return ("panel", emissionChemical, pollutants, measureUnitCode, fromRollup)
+
+    def computePanel(self,emissionChemical,pollutants,measureUnitCode,fromRollup):
+        emissions = self.dataParser.fetchArrow(EMISSION_QUERY, {"chemicalCode": emissionChemical})
+        concentrationQuery = ROLLUP_CONCENTRATION_QUERY if fromRollup else DAILY_CONCENTRATION_QUERY
+        concentrations = self.dataParser.fetchArrow(concentrationQuery, {"measureUnitCode": measureUnitCode})
+        if pollutants is not None:
+            concentrations = concentrations.filter(pc.is_in(pc.cast(concentrations["key"], pa.string()), pa.array(pollutants, pa.string())))
+        return buildPanel([
+            (emissions, EMISSION_PREFIX),
+            (concentrations, CONCENTRATION_PREFIX),
+            (self.dataParser.fetchArrow(RESPIRATORY_QUERY), None),
+            (self.dataParser.fetchArrow(COUNTRY_INFO_QUERY), None)
+        ])
+
+    def correlations(self,names=None,minPeriods:int=3,**panelOptions):
+        """
+        Correlations between panel columns over all countries and years where both columns have a value.
+
+        :param names: panel columns to correlate, all columns if None
+        :param panelOptions: arguments of panel
+        :return: arrow table with the column name and one correlation column per panel column, one row per panel column
+        """
+        key = ("correlations", tuple(names) if names is not None else None, minPeriods, self.panelKey(**panelOptions))
+        def compute():
+            panel = self.panel(**panelOptions)
+            selected = list(names) if names is not None else panel.names()
+            matrix = np.stack([panel[name].ravel() for name in selected], axis=1) if selected else np.empty((0, 0))
+            correlation, _ = pairwiseCorrelation(matrix, minPeriods)
+            columns = {"column": pa.array(selected, pa.string())}
+            for i, name in enumerate(selected):
+                columns[name] = pa.array(correlation[:, i], from_pandas=True)
+            return pa.table(columns)
+        return self.cached(key, compute)
+
+    def lagCorrelations(self,x,y,lags=range(0, 6),minPeriods:int=3,**panelOptions):
+        """
+        Correlations of column y with column x lag years earlier, e.g. the respiratory death rate with the
+        emissions of a sector some years before.
+
+        :param lags: lags in years, negative lags correlate y with later values of x
+        :return: arrow table with lag, correlation and the amount of country years every correlation is based on
+        """
+        lags = tuple(lags)
+        key = ("lagCorrelations", x, y, lags, minPeriods, self.panelKey(**panelOptions))
+        def compute():
+            panel = self.panel(**panelOptions)
+            #every lag is one column, all lags are correlated at once
+            lagged = np.stack([panel.lagged(x, lag).ravel() for lag in lags], axis=1)
+            correlation, count = correlateWith(lagged, panel[y].ravel(), minPeriods)
+            return pa.table({
+                "lag": pa.array(lags, pa.int32()),
+                "correlation": pa.array(correlation, from_pandas=True),
+                "count": pa.array(count, pa.int64())
+            })
+        return self.cached(key, compute)
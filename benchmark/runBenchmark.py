@@ -0,0 +1,261 @@
+import argparse
+import datetime
+import functools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from urllib.parse import quote
+import pandas as pd
+import psycopg2
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import main
+from sqlDataParser import DataParser
+from sourceLoader import SourceStore
+from OWID.OWIDDatasetM import OWIDDataset
+from EDGAR_Emissions.EDGARDatasetM import EDGARData
+from AirQuality.airQualityM import AirQualityData
+from benchmark.syntheticData import DEFAULT_CONFIG, generateAll
+from metrics import peakRssMB
+from dimensionRegistry import DimensionRegistry
+from frameSchema import MemoryBudget
+
+def folderSize(path,extension=None):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            if extension is None or filename.endswith(extension):
+                size += os.path.getsize(os.path.join(dirpath, filename))
+    return size
+
+def gitCommit():
+    try:
+        return subprocess.run(["git","rev-parse","--short","HEAD"], cwd=PROJECT_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class StageRecorder:
+    """
+    Measures wall time, loaded rows, input bytes and peak memory of every benchmark stage.
+    """
+    def __init__(self,dataParser:DataParser=None):
+        self.dataParser = dataParser
+        self.stages = []
+
+    def loadedRows(self):
+        if self.dataParser is None:
+            return 0
+        return sum(rows for rows, _ in self.dataParser.loadStats.values())
+
+    def run(self,name,function,inputBytes=0):
+        rowsBefore = self.loadedRows()
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        rows = self.loadedRows() - rowsBefore
+        peakOwn, peakChildren = peakRssMB(), peakRssMB(children=True)
+        stage = {
+            "stage": name,
+            "seconds": seconds,
+            "rows": rows,
+            "rowsPerSecond": rows / max(seconds, 1e-9),
+            "inputMB": inputBytes / 1e6,
+            "MBPerSecond": inputBytes / 1e6 / max(seconds, 1e-9),
+            "peakRssMB": peakOwn,
+            "peakChildRssMB": peakChildren
+        }
+        self.stages.append(stage)
+        print(f"{name}: {seconds:.2f}s, {rows} rows ({stage['rowsPerSecond']:.0f} rows/s), {stage['inputMB']:.1f} MB ({stage['MBPerSecond']:.1f} MB/s)")
+        return stage
+
+class QuietRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self,format,*args):
+        pass
+
+def serveFolder(folder):
+    """
+    Serves a folder over http on a free local port, stands in for the EEA download server.
+
+    :return: server and its base url, stop the server with shutdown()
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietRequestHandler, directory=folder))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def writeUrlFiles(downloadFolder,streamFolder,baseUrl):
+    """
+    Writes the info.txt and a urlFiles csv listing the served parquet files of every city folder, like downloadParquetUrls does.
+    """
+    for dirpath, _, filenames in os.walk(downloadFolder):
+        parquetFiles = sorted(f for f in filenames if f.endswith(".parquet"))
+        if len(parquetFiles) == 0:
+            continue
+        relativeFolder = os.path.relpath(dirpath, downloadFolder)
+        cityFolder = os.path.join(streamFolder, relativeFolder)
+        os.makedirs(cityFolder, exist_ok=True)
+        shutil.copy(os.path.join(dirpath, "info.txt"), os.path.join(cityFolder, "info.txt"))
+        urls = [f"{baseUrl}/{quote(relativeFolder.replace(os.sep, '/'))}/{quote(name)}" for name in parquetFiles]
+        pd.DataFrame({"ParquetFileUrl": urls}).to_csv(os.path.join(cityFolder, "urlFiles.csv"), index=False)
+
+def createDatabase(db_params,name):
+    #CREATE DATABASE can not run inside a transaction
+    conn = psycopg2.connect(**{**db_params, "dbname": "postgres"})
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+            cur.execute(f'CREATE DATABASE "{name}"')
+    finally:
+        conn.close()
+
+def dropDatabase(db_params,name):
+    conn = psycopg2.connect(**{**db_params, "dbname": "postgres"})
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+    finally:
+        conn.close()
+
+def runBenchmark(db_params,config=DEFAULT_CONFIG,loaderOptions=None,workFolder=None,keepData=False):
+    """
+    Generates synthetic data, loads it into a throwaway database and measures every loader.
+
+    :param db_params: connection parameters, dbname is replaced by a throwaway database,
+        an embedded duckdb database is written into the work folder
+    :param loaderOptions: loadMethod, copyFormat, edgarStreaming, parseWorkers, memoryBudgetMB, streamed, compacted and the airMeasurement_options of main.py,
+        streamed loads the air quality files from a local http server instead of the download folder,
+        compacted compacts the download folder into a partitioned dataset and loads that
+    :return: dictionary with the configuration and the measurements of every stage
+    """
+    loaderOptions = {**defaultLoaderOptions(), **(loaderOptions or {})}
+    temporaryFolder = workFolder is None
+    workFolder = workFolder or tempfile.mkdtemp(prefix="airquality-benchmark-")
+    embedded = db_params.get("backend") == "duckdb"
+    if embedded:
+        benchmarkParams = {**db_params, "path": os.path.join(workFolder, "benchmark.duckdb")}
+    else:
+        benchmarkParams = {**db_params, "dbname": f"benchmark_{os.getpid()}"}
+    previousFolder = os.getcwd()
+    recorder = StageRecorder()
+    cities = []
+    def generate():
+        cities.extend(generateAll(workFolder, PROJECT_ROOT, config))
+    recorder.run("generate", generate)
+    if not embedded:
+        createDatabase(db_params, benchmarkParams["dbname"])
+    dataParser = None
+    try:
+        #the loaders read their sources relative to the project folder
+        os.chdir(workFolder)
+        memoryBudget = MemoryBudget(loaderOptions["memoryBudgetMB"])
+        dataParser = DataParser.fromParams(benchmarkParams, loadMethod=loaderOptions["loadMethod"], copyFormat=loaderOptions["copyFormat"], memoryBudget=memoryBudget)
+        recorder.dataParser = dataParser
+        sourceStore = SourceStore()
+        dimensions = DimensionRegistry(dataParser)
+        schemaOptions = {key: loaderOptions[key] for key in ("partitioned","cityHashPartitions","bulkMode")}
+        recorder.run("schema", lambda: main.create_database_schema(**schemaOptions, mergeKeys=loaderOptions["loadMethod"] == "merge", params=benchmarkParams))
+        owidDataset = OWIDDataset(dataParser, sourceStore, dimensions=dimensions)
+        def loadOWID():
+            owidDataset.parseCountries()
+            owidDataset.parseCountryInfomation()
+        recorder.run("owid", loadOWID, os.path.getsize(os.path.join("OWID","owid-co2-data.csv")))
+        edgarData = EDGARData(dataParser, dimensions=dimensions, memoryBudget=memoryBudget)
+        recorder.run("edgar", lambda: edgarData.parseEdgarData(streaming=loaderOptions["edgarStreaming"]), folderSize(os.path.join("EDGAR_Emissions","data"), ".xlsx"))
+        airQualityDataset = AirQualityData(dataParser, benchmarkParams, maxConnections=loaderOptions["parseWorkers"], sourceStore=sourceStore, dimensions=dimensions, memoryBudget=memoryBudget)
+        def loadAirQualityDimensions():
+            airQualityDataset.parsePollutantData()
+            airQualityDataset.parseMeasurementData()
+            #the city listing normally comes from the EEA api
+            city = pd.DataFrame(cities, columns=["name","countryCode"])
+            dimensions.upsert("city", city)
+        recorder.run("airQualityDimensions", loadAirQualityDimensions)
+        downloadFolder = os.path.join("AirQuality","download")
+        if loaderOptions["streamed"]:
+            server, baseUrl = serveFolder(downloadFolder)
+            try:
+                streamFolder = os.path.join("AirQuality","stream")
+                writeUrlFiles(downloadFolder, streamFolder, baseUrl)
+                recorder.run("airQuality", lambda: airQualityDataset.streamAirQualityData(streamFolder, loaderOptions["parseWorkers"]), folderSize(downloadFolder, ".parquet"))
+            finally:
+                server.shutdown()
+        elif loaderOptions["compacted"]:
+            datasetFolder = os.path.join("AirQuality","dataset")
+            recorder.run("airQualityCompaction", lambda: airQualityDataset.compactAirQualityData(downloadFolder, datasetFolder), folderSize(downloadFolder, ".parquet"))
+            recorder.run("airQuality", lambda: airQualityDataset.parseCompactedAirQualityData(datasetFolder, loaderOptions["parseWorkers"]), folderSize(datasetFolder, ".parquet"))
+        else:
+            recorder.run("airQuality", lambda: airQualityDataset.parseAirQualityData(downloadFolder, loaderOptions["parseWorkers"]), folderSize(downloadFolder, ".parquet"))
+        if loaderOptions["bulkMode"]:
+            recorder.run("finishBulkLoad", lambda: main.finish_bulk_load(benchmarkParams))
+    finally:
+        os.chdir(previousFolder)
+        if dataParser is not None:
+            dataParser.close()
+        if not embedded:
+            dropDatabase(db_params, benchmarkParams["dbname"])
+        if temporaryFolder and not keepData:
+            shutil.rmtree(workFolder, ignore_errors=True)
+    return {
+        "commit": gitCommit(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "backend": "duckdb" if embedded else "postgres",
+        "config": config,
+        "loaderOptions": loaderOptions,
+        "stages": recorder.stages,
+        "totalSeconds": sum(stage["seconds"] for stage in recorder.stages)
+    }
+
+def defaultLoaderOptions():
+    return {
+        "loadMethod": "copy",
+        "copyFormat": "text",
+        "edgarStreaming": True,
+        "parseWorkers": 4,
+        "memoryBudgetMB": main.memory_budget_mb,
+        "streamed": False,
+        "compacted": False,
+        **main.airMeasurement_options
+    }
+
+def saveResult(result,resultsFolder):
+    os.makedirs(resultsFolder, exist_ok=True)
+    timestamp = result["timestamp"].replace(":", "-")
+    path = os.path.join(resultsFolder, f"{timestamp}-{result['commit'] or 'unknown'}.json")
+    with open(path, "w", encoding="utf-8") as resultFile:
+        json.dump(result, resultFile, indent=2)
+    return path
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description="Benchmarks the loaders on synthetic EEA, EDGAR and OWID data.")
+    for key, value in DEFAULT_CONFIG.items():
+        if isinstance(value, bool):
+            parser.add_argument(f"--{key}", type=lambda text: text.lower() in ("1","true","yes"), default=value)
+        else:
+            parser.add_argument(f"--{key}", type=type(value), default=value)
+    parser.add_argument("--backend", choices=["postgres","duckdb"], default="postgres")
+    parser.add_argument("--loadMethod", choices=["copy","insert","merge"], default="copy")
+    parser.add_argument("--copyFormat", choices=["text","binary"], default="text")
+    parser.add_argument("--parseWorkers", type=int, default=4)
+    parser.add_argument("--memoryBudgetMB", type=float, default=main.memory_budget_mb)
+    parser.add_argument("--streamed", action="store_true", help="load the air quality files from a local http server")
+    parser.add_argument("--compacted", action="store_true", help="compact the air quality files into a partitioned dataset before loading them")
+    parser.add_argument("--resultsFolder", default=os.path.join(PROJECT_ROOT,"benchmark","results"))
+    parser.add_argument("--keepData", action="store_true", help="keep the generated work folder")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    arguments = parseArguments()
+    config = {key: getattr(arguments, key) for key in DEFAULT_CONFIG}
+    loaderOptions = {"loadMethod": arguments.loadMethod, "copyFormat": arguments.copyFormat, "parseWorkers": arguments.parseWorkers, "memoryBudgetMB": arguments.memoryBudgetMB, "streamed": arguments.streamed, "compacted": arguments.compacted}
+    db_params = main.duckdb_params if arguments.backend == "duckdb" else main.db_params
+    result = runBenchmark(db_params, config, loaderOptions, keepData=arguments.keepData)
+    print(f"Results written to {saveResult(result, arguments.resultsFolder)}")
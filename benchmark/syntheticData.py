@@ -0,0 +1,148 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+#static csv files of the project the loaders read next to the generated data
+STATIC_FILES = [
+    os.path.join("AirQuality","chemicalVocabulary.csv"),
+    os.path.join("AirQuality","chemicalUnitMap.csv"),
+    os.path.join("AirQuality","countryCodes.csv"),
+    os.path.join("AirQuality","concentration.csv")
+]
+
+#EEA pollutant ids with a chemical notation in chemicalVocabulary.csv: SO2, PM10, O3, NO2, CO, PM2.5
+POLLUTANT_IDS = [1, 5, 7, 8, 10, 6001]
+
+#workbook names parseEdgarData expects
+EDGAR_WORKBOOKS = ["IEA_EDGAR_CO2_1970_2023.xlsx","EDGAR_N2O_1970_2023.xlsx","EDGAR_F-gases_1990_2023.xlsx","EDGAR_CO2bio_1970_2023.xlsx","EDGAR_CH4_1970_2023.xlsx","EDGAR_AR5g_F-gases_1990_2023.xlsx","EDGAR_AR5_GHG_1970_2023.xlsx"]
+
+#default size of the generated data
+DEFAULT_CONFIG = {
+    "seed": 0,
+    "countries": 4,
+    "citiesPerCountry": 3,
+    "pollutants": 3,
+    "firstYear": 2019,
+    "years": 2,
+    "hourly": True,
+    "edgarSectors": 20,
+    "edgarFirstYear": 1970,
+    "edgarYears": 54
+}
+
+def pickCountries(projectRoot,count):
+    """
+    :return: DataFrame with the name, iso2 and iso3 code of the first count countries of countryCodes.csv
+    """
+    countryCodes = pd.read_csv(os.path.join(projectRoot,"AirQuality","countryCodes.csv"), usecols=["name","alpha-2","alpha-3"], keep_default_na=False)
+    countryCodes = countryCodes.rename(columns={"alpha-2": "iso2", "alpha-3": "iso3"})
+    return countryCodes.head(count).reset_index(drop=True)
+
+def generateAirQualityData(root,countries,citiesPerCountry,pollutants,firstYear,years,hourly,rng):
+    """
+    Writes one parquet file in the EEA schema per city, pollutant and year into root/<iso2>/<city>, like download_parquet_files does.
+
+    :return: list of (city name, alpha-3 country code) of the generated cities
+    """
+    cities = []
+    frequency = "h" if hourly else "D"
+    for country in countries.itertuples(index=False):
+        iso2, iso3 = country.iso2, country.iso3
+        for cityIndex in range(citiesPerCountry):
+            cityName = f"City {iso2} {cityIndex}"
+            cityFolder = os.path.join(root, iso2, cityName)
+            os.makedirs(cityFolder, exist_ok=True)
+            with open(os.path.join(cityFolder, "info.txt"), "w") as infoFile:
+                infoFile.write(f"{cityName}\n{iso2}")
+            cities.append((cityName, iso3))
+            for pollutant in POLLUTANT_IDS[:pollutants]:
+                for year in range(firstYear, firstYear + years):
+                    start = pd.date_range(f"{year}-01-01", f"{year + 1}-01-01", freq=frequency, inclusive="left")
+                    rows = len(start)
+                    measurements = pd.DataFrame({
+                        "Samplingpoint": f"{iso2}/SPO.{cityIndex}.{pollutant}",
+                        "Pollutant": np.full(rows, pollutant, dtype=np.int32),
+                        "Start": start,
+                        "End": start + pd.Timedelta(1, unit=frequency),
+                        "Value": rng.gamma(2.0, 10.0, rows),
+                        "Unit": "ug.m-3",
+                        "AggType": "hour" if hourly else "day",
+                        #a few invalid measurements like in the real files
+                        "Validity": rng.choice(np.array([1, 1, 1, 2, -1], dtype=np.int32), rows),
+                        "Verification": np.ones(rows, dtype=np.int32),
+                        "ResultTime": start,
+                        "DataCapture": np.full(rows, np.nan),
+                        "FkObservationLog": None
+                    })
+                    measurements.to_parquet(os.path.join(cityFolder, f"SPO.{cityIndex}.{pollutant}_{year}.parquet"), index=False)
+    return cities
+
+def generateEdgarWorkbooks(folder,countries,sectors,firstYear,years,rng):
+    """
+    Writes the EDGAR workbooks with an 'IPCC 2006' sheet in the layout of the published files,
+    one row per country and sector and one Y_<year> column per year.
+    """
+    os.makedirs(folder, exist_ok=True)
+    for workbookIndex, workbookName in enumerate(EDGAR_WORKBOOKS):
+        substance = workbookName.split("_")[1] if workbookName.startswith("EDGAR") else "CO2"
+        substance = f"{substance}_{workbookIndex}"
+        rows = []
+        for country in countries.itertuples(index=False):
+            for sector in range(sectors):
+                rows.append({
+                    "IPCC_annex": "Annex_I",
+                    "C_group_IM24_sh": "Synthetic",
+                    "Country_code_A3": country.iso3,
+                    "Name": country.name,
+                    "ipcc_code_2006_for_standard_report": f"S.{sector}",
+                    "ipcc_code_2006_for_standard_report_name": f"Synthetic sector {sector}",
+                    "Substance": substance,
+                    "fossil_bio": "fossil" if sector % 2 == 0 else "bio"
+                })
+        workbook = pd.DataFrame(rows)
+        values = rng.gamma(2.0, 50.0, (len(workbook), years))
+        yearColumns = pd.DataFrame(values, columns=[f"Y_{year}" for year in range(firstYear, firstYear + years)])
+        workbook = pd.concat([workbook, yearColumns], axis=1)
+        with pd.ExcelWriter(os.path.join(folder, workbookName)) as writer:
+            #the header of the published workbooks is in the tenth row
+            workbook.to_excel(writer, sheet_name="IPCC 2006", startrow=9, index=False)
+
+def generateOWIDData(path,countries,firstYear,years,rng):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    yearRange = np.arange(firstYear, firstYear + years)
+    owid = pd.DataFrame({
+        "country": np.repeat(countries["name"].to_numpy(), len(yearRange)),
+        "year": np.tile(yearRange, len(countries)),
+        "iso_code": np.repeat(countries["iso3"].to_numpy(), len(yearRange)),
+        "population": rng.integers(100000, 100000000, len(countries) * len(yearRange)).astype(float),
+        #countryInfo stores the gdp as INT
+        "gdp": rng.integers(1000000, 2000000000, len(countries) * len(yearRange)).astype(float),
+        "energy_per_capita": rng.uniform(1000, 80000, len(countries) * len(yearRange)),
+        "co2": rng.uniform(0, 1000, len(countries) * len(yearRange))
+    })
+    owid.to_csv(path, index=False)
+
+def generateAll(workFolder,projectRoot,config=DEFAULT_CONFIG):
+    """
+    Builds a work folder with the layout of the project, synthetic EEA, EDGAR and OWID data and the static csv files.
+
+    :return: list of (city name, alpha-3 country code) of the generated air quality cities
+    """
+    rng = np.random.default_rng(config["seed"])
+    for staticFile in STATIC_FILES:
+        os.makedirs(os.path.join(workFolder, os.path.dirname(staticFile)), exist_ok=True)
+        shutil.copyfile(os.path.join(projectRoot, staticFile), os.path.join(workFolder, staticFile))
+    countries = pickCountries(projectRoot, config["countries"])
+    generateOWIDData(os.path.join(workFolder,"OWID","owid-co2-data.csv"), countries, config["edgarFirstYear"], config["edgarYears"], rng)
+    generateEdgarWorkbooks(os.path.join(workFolder,"EDGAR_Emissions","data"), countries, config["edgarSectors"], config["edgarFirstYear"], config["edgarYears"], rng)
+    return generateAirQualityData(
+        os.path.join(workFolder,"AirQuality","download"),
+        countries,
+        config["citiesPerCountry"],
+        config["pollutants"],
+        config["firstYear"],
+        config["years"],
+        config["hourly"],
+        rng
+    )
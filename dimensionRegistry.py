@@ -0,0 +1,101 @@
+import threading
+import pandas as pd
+from sqlDataParser import DataParser
+
+#natural key of every dimension table, city additionally has a surrogate id
+DIMENSIONS = {
+    "country": {"keyColumns": ["countryCode"]},
+    "chemical": {"keyColumns": ["chemicalCode"]},
+    "measureUnit": {"keyColumns": ["measureUnitCode"]},
+    "sector": {"keyColumns": ["sectorCode"]},
+    "city": {"keyColumns": ["name","countryCode"], "idColumn": "city_ID"}
+}
+
+class DimensionRegistry:
+    """
+    Keeps the natural keys of the dimension tables (and the ids of cities) in memory.
+    Every dimension is read from the database once, loaders insert new dimension rows through the registry
+    and resolve keys from its maps instead of querying the database per file or batch.
+    """
+    def __init__(self,dataParser:DataParser,dimensions:dict=DIMENSIONS):
+        self.dataParser = dataParser
+        self.dimensions = dimensions
+        #dimension name to set of keys, or dictionary of key to id for dimensions with an id column
+        self.maps = {}
+        self.lock = threading.Lock()
+        #loaders running at the same time insert into the same dimensions, the check and insert of new keys run one at a time
+        self.upsertLocks = {name: threading.Lock() for name in dimensions}
+
+    def keyOf(self,name,row):
+        keyColumns = self.dimensions[name]["keyColumns"]
+        return row[0] if len(keyColumns) == 1 else tuple(row)
+
+    def read(self,name):
+        dimension = self.dimensions[name]
+        columns = dimension["keyColumns"] + ([dimension["idColumn"]] if "idColumn" in dimension else [])
+        selected = ", ".join(f'"{column}"' for column in columns)
+        rows = self.dataParser.makeCall(f'SELECT {selected} FROM "{name}"')
+        keyCount = len(dimension["keyColumns"])
+        if "idColumn" in dimension:
+            return {self.keyOf(name, row[:keyCount]): int(row[keyCount]) for row in rows}
+        return {self.keyOf(name, row) for row in rows}
+
+    def get(self,name):
+        """
+        :return: set of the keys of a dimension or dictionary of key to id for city
+        """
+        with self.lock:
+            if name not in self.maps:
+                self.maps[name] = self.read(name)
+            return self.maps[name]
+
+    def refresh(self):
+        #keys are read from the database again on their next use, e.g. after other processes inserted dimension rows
+        with self.lock:
+            self.maps = {}
+
+    def keys(self,name):
+        return frozenset(self.get(name))
+
+    def cityIds(self):
+        """
+        :return: dictionary of (city name, iso3 country code) to city_ID
+        """
+        return dict(self.get("city"))
+
+    def upsert(self,name,dataframe:pd.DataFrame,inTransaction=None):
+        """
+        Inserts the rows of dataframe whose key is not known yet, known rows are left unchanged.
+
+        :param inTransaction: passed to DataParser.parsePandaDFToTable, called even if no row is new
+        :return: amount of inserted rows
+        """
+        with self.upsertLocks[name]:
+            return self.insertNew(name,dataframe,inTransaction)
+
+    def insertNew(self,name,dataframe:pd.DataFrame,inTransaction=None):
+        keyColumns = self.dimensions[name]["keyColumns"]
+        known = self.get(name)
+        #rows with a missing key can never be resolved
+        dataframe = dataframe.dropna(subset=keyColumns)
+        if self.dataParser.merges(name):
+            #duplicate and known keys are dropped by the database
+            newRows = dataframe
+        elif len(keyColumns) == 1:
+            dataframe = dataframe.drop_duplicates(subset=keyColumns)
+            newRows = dataframe[~dataframe[keyColumns[0]].isin(known)]
+        else:
+            dataframe = dataframe.drop_duplicates(subset=keyColumns)
+            keys = pd.MultiIndex.from_frame(dataframe[keyColumns])
+            newRows = dataframe[~keys.isin(list(known))]
+        if len(newRows) == 0 and inTransaction is None:
+            return 0
+        inserted = self.dataParser.parsePandaDFToTable(newRows,name,inTransaction=inTransaction)
+        if inserted > 0:
+            with self.lock:
+                if "idColumn" in self.dimensions[name]:
+                    #ids are assigned by the database
+                    self.maps[name] = self.read(name)
+                else:
+                    self.maps[name] = self.maps[name] | set(newRows[keyColumns[0]])
+        return inserted
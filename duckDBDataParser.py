@@ -0,0 +1,187 @@
+import re
+import threading
+import time
+import pandas as pd
+import pyarrow as pa
+from metrics import addStageRows
+
+#psycopg2 (%(name)s, %s) and sqlalchemy (:name) parameters in the duckdb notation
+PYFORMAT_NAMED = re.compile(r"%\((\w+)\)s")
+PYFORMAT_POSITIONAL = re.compile(r"%s")
+SQLALCHEMY_NAMED = re.compile(r"(?<![:\w]):([A-Za-z_]\w*)")
+#postgres schema constructs without a duckdb counterpart
+SERIAL_COLUMN = re.compile(r'"(\w+)"\s+(BIG)?SERIAL')
+BRIN_INDEX = re.compile(r"CREATE INDEX[^;]*USING BRIN[^;]*;", re.IGNORECASE)
+
+def translateSchema(schema):
+    """
+    Translates the postgres schema of main.py into duckdb DDL.
+    SERIAL columns become sequences, FLOAT becomes DOUBLE (FLOAT is double precision in postgres but single in duckdb),
+    stored generated columns become virtual, NULLS NOT DISTINCT is removed and BRIN indexes are dropped, duckdb keeps min/max zonemaps on its own.
+    """
+    statements = []
+    for statement in schema.split(";"):
+        if BRIN_INDEX.search(statement + ";"):
+            continue
+        table = re.search(r'CREATE TABLE IF NOT EXISTS "(\w+)"', statement)
+        for column, big in SERIAL_COLUMN.findall(statement):
+            sequence = f"{table.group(1)}_{column}_seq"
+            statements.append(f'CREATE SEQUENCE IF NOT EXISTS "{sequence}"')
+            columnType = "BIGINT" if big else "INTEGER"
+            statement = re.sub(rf'"{column}"\s+(BIG)?SERIAL', f'"{column}" {columnType} DEFAULT nextval(\'"{sequence}"\')', statement)
+        statement = re.sub(r"\bFLOAT\b", "DOUBLE", statement)
+        statement = re.sub(r"\bSTORED\b", "VIRTUAL", statement)
+        statement = re.sub(r"\s+NULLS NOT DISTINCT", "", statement)
+        statements.append(statement)
+    return ";".join(statements)
+
+def translateParameters(query):
+    query = PYFORMAT_NAMED.sub(r"$\1", query)
+    query = PYFORMAT_POSITIONAL.sub("?", query)
+    return SQLALCHEMY_NAMED.sub(r"$\1", query)
+
+class DuckDBCursor:
+    """
+    Wraps a duckdb connection with the part of the psycopg2 cursor interface the inTransaction functions use.
+    """
+    def __init__(self,connection):
+        self.connection = connection
+
+    def execute(self,query,params=None):
+        self.connection.execute(translateParameters(query), params if params is not None else [])
+
+    def executemany(self,query,paramsList):
+        self.connection.executemany(translateParameters(query), paramsList)
+
+    def fetchall(self):
+        return self.connection.fetchall()
+
+#Helper class to parse panda dataframes into an embedded duckdb database
+class DuckDBDataParser:
+    """
+    Embedded columnar backend with the interface of DataParser, no database server is needed.
+    Arrow tables and dataframes are scanned by duckdb in place instead of being serialized.
+    duckdb allows one writing process, so all write transactions of a parser run one after another.
+    """
+    backend = "duckdb"
+
+    def __init__(self,path:str,threads:int=None):
+        """
+        :param path: database file, ":memory:" keeps the database in memory
+        :param threads: threads duckdb uses per query, defaults to the amount of cores
+        """
+        try:
+            import duckdb
+        except ImportError as e:
+            raise ImportError("The duckdb backend needs the duckdb package, install it with pip install duckdb.") from e
+        config = {"threads": threads} if threads is not None else {}
+        self.connection = duckdb.connect(path, config=config)
+        self.path = path
+        #rows and seconds spent per table, used to report rows/s
+        self.loadStats = {}
+        self.statsLock = threading.Lock()
+        self.writeLock = threading.Lock()
+
+    @classmethod
+    def fromParams(cls,db_params,**kwargs):
+        #loading and pooling options of the postgres parser do not apply to an embedded database
+        return cls(db_params["path"],db_params.get("threads"))
+
+    def parsePandaDFToTable(self,dataframe:pd.DataFrame | pa.Table,tableName,reportRate:bool=True,inTransaction=None):
+        """
+        Loads a dataframe or arrow table into a table inside one transaction.
+
+        :param inTransaction: optional function called with a DuckDBCursor before the commit
+        :return: amount of rows loaded, 0 if the transaction failed
+        """
+        return self.parseFramesToTable([dataframe],tableName,reportRate,inTransaction)
+
+    def parseFramesToTable(self,frames,tableName,reportRate:bool=True,inTransaction=None):
+        """
+        Loads an iterable of dataframes, arrow tables or (table name, frame) pairs into a table inside one transaction.
+
+        :return: amount of rows loaded, 0 if the transaction failed
+        """
+        start = time.perf_counter()
+        rows = 0
+        with self.writeLock:
+            #every transaction runs on its own cursor, so threads sharing the parser do not interfere
+            cursor = self.connection.cursor()
+            try:
+                cursor.begin()
+                for dataframe in frames:
+                    targetTable = tableName
+                    if isinstance(dataframe, tuple):
+                        targetTable, dataframe = dataframe
+                    if len(dataframe) == 0:
+                        continue
+                    columnNames = dataframe.column_names if isinstance(dataframe, pa.Table) else list(dataframe.columns)
+                    columns = ",".join(f'"{column}"' for column in columnNames)
+                    cursor.register("incoming", dataframe)
+                    cursor.execute(f'INSERT INTO "{targetTable}" ({columns}) SELECT {columns} FROM incoming')
+                    cursor.unregister("incoming")
+                    rows += len(dataframe)
+                if inTransaction is not None:
+                    inTransaction(DuckDBCursor(cursor))
+                cursor.commit()
+            except Exception as e:
+                cursor.rollback()
+                rows = 0
+                print("Transaction failed:", e)
+            finally:
+                cursor.close()
+        elapsed = time.perf_counter() - start
+        self.recordLoad(tableName,rows,elapsed)
+        if reportRate and rows > 0:
+            print(f"Loaded {rows} rows into {tableName} in {elapsed:.2f}s ({rows / max(elapsed, 1e-9):.0f} rows/s)")
+        return rows
+
+    def merges(self,tableName):
+        #the staging merge load method is only available for postgres
+        return False
+
+    def recordLoad(self,tableName,rows,seconds):
+        #stages of a task graph load at the same time
+        with self.statsLock:
+            loadedRows, loadedSeconds = self.loadStats.get(tableName,(0,0.0))
+            self.loadStats[tableName] = (loadedRows + rows, loadedSeconds + seconds)
+        addStageRows(rows)
+
+    def printLoadStats(self):
+        for tableName, (rows, seconds) in self.loadStats.items():
+            print(f"{tableName}: {rows} rows in {seconds:.2f}s ({rows / max(seconds, 1e-9):.0f} rows/s)")
+
+    def makeCall(self, query, params=None):
+        cursor = self.connection.cursor()
+        try:
+            return cursor.execute(translateParameters(query), params or {}).fetchall()
+        finally:
+            cursor.close()
+
+    def fetchArrow(self,query,params=None):
+        #query result as an arrow table, duckdb hands its columns over without converting rows
+        cursor = self.connection.cursor()
+        try:
+            result = cursor.execute(translateParameters(query), params or {}).arrow()
+            #newer duckdb versions return a record batch reader
+            return result.read_all() if isinstance(result, pa.RecordBatchReader) else result
+        finally:
+            cursor.close()
+
+    def execute(self,query,params=None):
+        #single statement in psycopg2 parameter style, committed on its own, returns its rows or None
+        with self.writeLock:
+            cursor = self.connection.cursor()
+            try:
+                DuckDBCursor(cursor).execute(query, params)
+                return cursor.fetchall() if cursor.description is not None else None
+            finally:
+                cursor.close()
+
+    def executeScript(self,schema):
+        #schema statements of main.py written for postgres
+        with self.writeLock:
+            self.connection.execute(translateSchema(schema))
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,108 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+#code columns repeat a few hundred distinct values over millions of rows, they are kept as categories (pandas) or dictionaries (arrow)
+CODE_COLUMNS = ("countryCode","chemicalCode","measureUnitCode","sectorCode","fossil_bio","Unit","AggType","City","Country")
+#narrow integer types of the key columns, measured values stay float64 like the double precision columns they are loaded into
+INTEGER_COLUMNS = {
+    "year": ("int16", pa.int16()),
+    "city_ID": ("int32", pa.int32())
+}
+
+def compactFrame(frame:pd.DataFrame):
+    """
+    :return: shallow copy of frame with categorical code columns and narrow integer columns
+    """
+    frame = frame.copy(deep=False)
+    for column in frame.columns:
+        if column in CODE_COLUMNS and not isinstance(frame[column].dtype, pd.CategoricalDtype):
+            frame[column] = frame[column].astype("category")
+        elif column in INTEGER_COLUMNS and pd.api.types.is_integer_dtype(frame[column]):
+            frame[column] = frame[column].astype(INTEGER_COLUMNS[column][0])
+    return frame
+
+def compactTable(table:pa.Table):
+    """
+    :return: table with dictionary encoded code columns and narrow integer columns
+    """
+    for index, field in enumerate(table.schema):
+        if field.name in CODE_COLUMNS and pa.types.is_string(field.type):
+            table = table.set_column(index, field.name, table[field.name].dictionary_encode())
+        elif field.name in INTEGER_COLUMNS and pa.types.is_integer(field.type):
+            table = table.set_column(index, field.name, table[field.name].cast(INTEGER_COLUMNS[field.name][1]))
+    return table
+
+def concatFrames(frames):
+    """
+    Concatenates dataframes, categorical columns keep their dtype with the union of the categories
+    instead of being converted into object columns.
+    """
+    frames = list(frames)
+    if len(frames) == 0:
+        return pd.DataFrame()
+    for column in frames[0].columns:
+        if all(isinstance(frame[column].dtype, pd.CategoricalDtype) for frame in frames):
+            categories = frames[0][column].cat.categories
+            for frame in frames[1:]:
+                categories = categories.union(frame[column].cat.categories)
+            frames = [frame.assign(**{column: frame[column].cat.set_categories(categories)}) for frame in frames]
+    return pd.concat(frames, ignore_index=True)
+
+def dictionaryColumns(parquetFilePath,columns=CODE_COLUMNS):
+    #code columns of a parquet file, read directly as dictionaries instead of one python string per row
+    names = pq.read_schema(parquetFilePath).names
+    return [column for column in columns if column in names]
+
+def bytesPerRow(frame:pd.DataFrame | pa.Table,sample:int=1000):
+    """
+    In memory size of one row, object columns of dataframes are measured on the first sample rows only.
+    """
+    if len(frame) == 0:
+        return 1
+    if isinstance(frame, pa.Table):
+        return max(frame.nbytes / frame.num_rows, 1)
+    head = frame.head(sample)
+    return max(head.memory_usage(deep=True, index=False).sum() / len(head), 1)
+
+def parquetBytesPerRow(parquetFilePath,columns=None):
+    """
+    Uncompressed size of one row of a parquet file taken from its metadata, only the given columns are counted.
+    """
+    metadata = pq.ParquetFile(parquetFilePath).metadata
+    if metadata.num_rows == 0:
+        return 1
+    size = 0
+    for rowGroup in range(metadata.num_row_groups):
+        group = metadata.row_group(rowGroup)
+        for index in range(group.num_columns):
+            column = group.column(index)
+            if columns is None or column.path_in_schema in columns:
+                size += column.total_uncompressed_size
+    return max(size / metadata.num_rows, 1)
+
+class MemoryBudget:
+    """
+    Memory the ingestion frames of a run may use, loaders size their batches and COPY chunks from it.
+    One frame may use frameShare of the budget, filtering and encoding a frame make temporary copies of it.
+    """
+    def __init__(self,budgetMB:float=2048,frameShare:float=0.25):
+        self.budgetMB = budgetMB
+        self.frameShare = frameShare
+
+    def share(self,consumers):
+        """
+        :return: budget of one of consumers workers splitting this budget
+        """
+        return MemoryBudget(self.budgetMB / max(consumers, 1), self.frameShare)
+
+    def rowsFor(self,rowBytes,minimum:int=1024,maximum:int=None):
+        """
+        :param rowBytes: in memory size of one row
+        :return: amount of rows of one frame that stays within the budget
+        """
+        rows = max(int(self.budgetMB * 1e6 * self.frameShare / max(rowBytes, 1)), minimum)
+        return rows if maximum is None else min(rows, maximum)
+
+#budget shared by all dataset classes of a run
+defaultMemoryBudget = MemoryBudget()
@@ -0,0 +1,132 @@
+import hashlib
+import os
+from sqlDataParser import DataParser
+
+#statuses of a source in the load manifest
+STATUS_LOADING = "loading"
+STATUS_LOADED = "loaded"
+STATUS_FAILED = "failed"
+
+UPSERT_QUERY = """
+    INSERT INTO "loadManifest" ("sourcePath", "targetTable", "size", "mtime", "contentHash", "rowCount", "status", "updatedAt")
+    VALUES (%(sourcePath)s, %(targetTable)s, %(size)s, %(mtime)s, %(contentHash)s, %(rowCount)s, %(status)s, now())
+    ON CONFLICT ("sourcePath", "targetTable") DO UPDATE SET
+        "size" = EXCLUDED."size",
+        "mtime" = EXCLUDED."mtime",
+        "contentHash" = COALESCE(EXCLUDED."contentHash", "loadManifest"."contentHash"),
+        "rowCount" = EXCLUDED."rowCount",
+        "status" = EXCLUDED."status",
+        "updatedAt" = now()
+"""
+
+#changes whenever a source is loaded or loaded again
+VERSION_QUERY = """
+    SELECT count(*), max("updatedAt"), sum("rowCount") FROM "loadManifest" WHERE "status" = 'loaded'
+"""
+
+def sourceKey(path):
+    #paths are stored relative and normalized so runs from the project folder match each other
+    return os.path.normpath(path).replace(os.sep, "/")
+
+def hashFile(path,blockSize=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as sourceFile:
+        for block in iter(lambda: sourceFile.read(blockSize), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+class LoadManifest:
+    """
+    Records which source files were loaded into which table, so interrupted loads resume instead of restarting.
+    A source counts as loaded if its status is loaded and its size and mtime (or content hash) did not change.
+    The loaded status is written in the same transaction as the rows of the source.
+    Sources without a local file (streamed downloads) are described by a sourceInfo dictionary with their size and content hash.
+    """
+    def __init__(self,dataParser:DataParser):
+        self.dataParser = dataParser
+
+    def loadedSources(self,targetTable):
+        """
+        :return: dictionary of source path to (size, mtime, content hash) of all loaded sources of a table
+        """
+        query = self.dataParser.makeCall(
+            """SELECT "sourcePath", "size", "mtime", "contentHash" FROM "loadManifest" WHERE "targetTable" = :target_table AND "status" = :status""",
+            {"target_table": targetTable, "status": STATUS_LOADED}
+        )
+        return {row[0]: (row[1], row[2], row[3]) for row in query}
+
+    def isLoaded(self,path,targetTable,loadedSources=None):
+        """
+        :param loadedSources: result of loadedSources, avoids one query per file when checking many files
+        """
+        if loadedSources is None:
+            loadedSources = self.loadedSources(targetTable)
+        entry = loadedSources.get(sourceKey(path))
+        if entry is None or not os.path.exists(path):
+            return False
+        size, mtime, contentHash = entry
+        stat = os.stat(path)
+        if stat.st_size != size:
+            return False
+        if mtime is not None and abs(stat.st_mtime - mtime) < 1e-6:
+            return True
+        #the file was touched, only reload it if its content changed
+        return contentHash is not None and hashFile(path) == contentHash
+
+    def isRecorded(self,path,targetTable,loadedSources=None):
+        #loaded status of a source that has no local file to compare against
+        if loadedSources is None:
+            loadedSources = self.loadedSources(targetTable)
+        return sourceKey(path) in loadedSources
+
+    def describe(self,path,targetTable,status,rowCount=None,contentHash=None,sourceInfo=None):
+        if sourceInfo is not None:
+            size, mtime = sourceInfo["size"], None
+        else:
+            stat = os.stat(path)
+            size, mtime = stat.st_size, stat.st_mtime
+        return {
+            "sourcePath": sourceKey(path),
+            "targetTable": targetTable,
+            "size": size,
+            "mtime": mtime,
+            "contentHash": contentHash,
+            "rowCount": rowCount,
+            "status": status
+        }
+
+    def contentHash(self,path,sourceInfo=None):
+        return sourceInfo.get("contentHash") if sourceInfo is not None else hashFile(path)
+
+    def markLoading(self,path,targetTable,sourceInfo=None):
+        self.write(self.describe(path, targetTable, STATUS_LOADING, sourceInfo=sourceInfo))
+
+    def markFailed(self,path,targetTable,sourceInfo=None):
+        self.write(self.describe(path, targetTable, STATUS_FAILED, sourceInfo=sourceInfo))
+
+    def markLoaded(self,path,targetTable,rowCount,sourceInfo=None):
+        self.write(self.describe(path, targetTable, STATUS_LOADED, rowCount, self.contentHash(path,sourceInfo), sourceInfo))
+
+    def markLoadedInTransaction(self,paths,targetTable,rowCount,sourceInfo=None):
+        """
+        :param paths: source path or list of source paths loaded by one transaction
+        :param rowCount: amount of loaded rows or a function returning it once the rows are written
+        :param sourceInfo: size and content hash of a single source without a local file
+        :return: function for the inTransaction argument of DataParser.parsePandaDFToTable
+        """
+        if isinstance(paths, str):
+            paths = [paths]
+        def markLoaded(cursor):
+            loadedRows = rowCount() if callable(rowCount) else rowCount
+            for path in paths:
+                cursor.execute(UPSERT_QUERY, self.describe(path, targetTable, STATUS_LOADED, loadedRows, self.contentHash(path,sourceInfo), sourceInfo))
+        return markLoaded
+
+    def version(self):
+        """
+        :return: tuple that changes whenever a loader committed new rows, results computed from the tables before are stale then
+        """
+        return tuple(self.dataParser.makeCall(VERSION_QUERY)[0])
+
+    def write(self,entry):
+        self.dataParser.execute(UPSERT_QUERY, entry)
@@ -4,6 +4,12 @@ from OWID.OWIDDatasetM import OWIDDataset
 from WHO_HFA.WHODataM import WHOData
 from EDGAR_Emissions.EDGARDatasetM import EDGARData
 from AirQuality.airQualityM import AirQualityData
+from AirQuality.partitions import createPartitionedAirMeasurementSQL
+from metrics import defaultRunMetrics, PROFILE_FOLDER_VARIABLE
+from dimensionRegistry import DimensionRegistry
+from frameSchema import MemoryBudget
+from taskGraph import TaskGraph
+from workLease import WorkLeases
 import os
 
 
@@ -16,14 +22,81 @@ db_params = {
     "port": 5432
 }
 
+#Embedded database file used instead of the postgres server when database_backend is "duckdb"
+duckdb_params = {
+    "backend": "duckdb",
+    "path": "airQualityEmissionHealth.duckdb"
+}
+#machine readable report of the run with metrics per stage and source file
+run_report = os.path.join("reports","runReport.json")
+#folder for cProfile files of the hot paths, None disables profiling
+profile_folder = None
+
+#"copy" streams rows into the tables, "merge" stages the dimension, country and emission rows in UNLOGGED tables
+#and lets the database drop duplicates and rows with unknown foreign keys (postgres 15 or newer)
+load_method = "copy"
+
+#enabled: load the air quality files straight from the http stream instead of downloading them first
+#spoolThresholdMB: files up to this size stay in memory, larger files are spooled to a temporary file
+#diskBudgetMB: disk space of all parse workers for spooled files
+#keepCache: keep a copy of every loaded file in AirQuality/download while the cache budget allows
+#cacheBudgetMB: disk space of the parquet files in AirQuality/download, copies are no longer kept once it is full
+air_quality_streaming = {
+    "enabled": False,
+    "spoolThresholdMB": 64,
+    "diskBudgetMB": 1024,
+    "keepCache": False,
+    "cacheBudgetMB": 1024
+}
+
+#enabled: compact the downloaded air quality files into a dataset partitioned by country, pollutant and year and load that instead
+#datasetFolder: folder of the compacted dataset
+#rowGroupSize: maximum amount of rows per row group of the compacted files
+air_quality_compaction = {
+    "enabled": False,
+    "datasetFolder": os.path.join("AirQuality","dataset"),
+    "rowGroupSize": 1000000
+}
+
+#loader stages running at the same time, 1 runs them one after another
+stage_workers = 4
+
+#enabled: several main.py workers (on one or many machines, all with these db_params) share one load through the workLease table, needs postgres.
+#   Every stage runs on one worker only, the air quality files are split into one shard per city which every worker claims from.
+#runName: shared by the workers of one load, rerunning a name resumes its unfinished stages and shards, a new name starts a new load
+#leaseSeconds: seconds a claimed stage or shard stays leased without a heartbeat, after that another worker takes it over
+#pollSeconds: seconds a worker waits before asking for work again while other workers still hold leases
+distributed_load = {
+    "enabled": False,
+    "runName": "load",
+    "leaseSeconds": 300,
+    "pollSeconds": 5
+}
+
+#memory in MB the ingestion frames may use, batch and COPY chunk sizes of the loaders adapt to it
+memory_budget_mb = 2048
+
+#"postgres" loads into the server of db_params, "duckdb" into the file of duckdb_params (needs pip install duckdb)
+database_backend = "postgres"
+
+#airMeasurement layout
+#partitioned: partition airMeasurement by year, time range queries only scan the partitions of the range
+#cityHashPartitions: additionally split every year by hash of city_ID, 0 disables it
+#bulkMode: create the airMeasurement indexes and analyze the tables only after the load
+airMeasurement_options = {
+    "partitioned": True,
+    "cityHashPartitions": 0,
+    "bulkMode": True
+}
+
 #Database Schema
 create_schema = """
-CREATE TABLE "country" (
+CREATE TABLE IF NOT EXISTS "country" (
     "countryCode" VARCHAR(3) PRIMARY KEY,
     "name" VARCHAR(255)
 );
 
-CREATE TABLE "countryInfo" (
+CREATE TABLE IF NOT EXISTS "countryInfo" (
     "year" INT NOT NULL,
     "countryCode" VARCHAR(3) NOT NULL,
     "population" INT,
@@ -33,30 +106,31 @@ CREATE TABLE "countryInfo" (
     FOREIGN KEY ("countryCode") REFERENCES "country"("countryCode")
 );
 
-CREATE TABLE "city" (
+CREATE TABLE IF NOT EXISTS "city" (
     "city_ID" SERIAL PRIMARY KEY,
     "name" VARCHAR(255),
     "countryCode" VARCHAR(3),
-    FOREIGN KEY ("countryCode") REFERENCES "country"("countryCode")
+    FOREIGN KEY ("countryCode") REFERENCES "country"("countryCode"),
+    UNIQUE ("name", "countryCode")
 );
 
-CREATE TABLE "sector" (
+CREATE TABLE IF NOT EXISTS "sector" (
     "sectorCode" VARCHAR(50) PRIMARY KEY,
     "name" TEXT
 );
 
-CREATE TABLE "measureUnit" (
+CREATE TABLE IF NOT EXISTS "measureUnit" (
     "measureUnitCode" VARCHAR(50) PRIMARY KEY,
     "name" VARCHAR(100),
     "description" TEXT
 );
 
-CREATE TABLE "chemical" (
+CREATE TABLE IF NOT EXISTS "chemical" (
     "chemicalCode" VARCHAR(50) PRIMARY KEY,
     "name" VARCHAR(255)
 );
 
-CREATE TABLE "emissionData" (
+CREATE TABLE IF NOT EXISTS "emissionData" (
     "emissionData_ID" SERIAL PRIMARY KEY,
     "year" INT NOT NULL,
     "value" FLOAT NOT NULL,
@@ -67,14 +141,55 @@ CREATE TABLE "emissionData" (
     "measureUnitCode" VARCHAR(50) REFERENCES "measureUnit"("measureUnitCode")
 );
 
-CREATE TABLE "sDRRespiratoryDisease" (
+CREATE TABLE IF NOT EXISTS "sDRRespiratoryDisease" (
     "rate" FLOAT NOT NULL,
     "year" INT NOT NULL,
     "countryCode" VARCHAR(10) REFERENCES Country("countryCode"),
     PRIMARY KEY ("year", "countryCode")
 );
 
-CREATE TABLE "airMeasurement" (
+--monthly aggregates of the daily air measurements, merged by the air quality workers while loading
+CREATE TABLE IF NOT EXISTS "monthlyAirMeasurement" (
+    "month" DATE NOT NULL,
+    "city_ID" INT NOT NULL REFERENCES city("city_ID"),
+    "chemicalCode" VARCHAR(50) NOT NULL REFERENCES "chemical"("chemicalCode"),
+    "measureUnitCode" VARCHAR(50) NOT NULL REFERENCES "measureUnit"("measureUnitCode"),
+    "sum" FLOAT NOT NULL,
+    "count" BIGINT NOT NULL,
+    "min" FLOAT,
+    "max" FLOAT,
+    "average_value" FLOAT GENERATED ALWAYS AS ("sum" / "count") STORED,
+    PRIMARY KEY ("month", "city_ID", "chemicalCode", "measureUnitCode")
+);
+
+CREATE TABLE IF NOT EXISTS "loadManifest" (
+    "sourcePath" TEXT NOT NULL,
+    "targetTable" VARCHAR(100) NOT NULL,
+    "size" BIGINT,
+    "mtime" FLOAT,
+    "contentHash" VARCHAR(64),
+    "rowCount" BIGINT,
+    "status" VARCHAR(20) NOT NULL,
+    "updatedAt" TIMESTAMP NOT NULL DEFAULT now(),
+    PRIMARY KEY ("sourcePath", "targetTable")
+);
+
+CREATE TABLE IF NOT EXISTS "workLease" (
+    "job" VARCHAR(200) NOT NULL,
+    "shardKey" TEXT NOT NULL,
+    "payload" TEXT,
+    "status" VARCHAR(20) NOT NULL,
+    "owner" VARCHAR(200),
+    "leaseUntil" TIMESTAMPTZ,
+    "heartbeatAt" TIMESTAMPTZ,
+    "attempts" INT NOT NULL DEFAULT 0,
+    "updatedAt" TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY ("job", "shardKey")
+);
+"""
+
+create_air_measurement = """
+CREATE TABLE IF NOT EXISTS "airMeasurement" (
     "airMeasurement_ID" BIGSERIAL PRIMARY KEY,
     "date" DATE NOT NULL,
     "value" FLOAT NOT NULL,
@@ -83,46 +198,249 @@ CREATE TABLE "airMeasurement" (
     "chemicalCode" VARCHAR(50) REFERENCES "chemical"("chemicalCode")
 );
 """
-#Connect to database and execute schema query
-def create_database_schema():
+
+#natural key of emissionData the "merge" load method resolves conflicts on (postgres 15 or newer),
+#duplicates appended by earlier copy loads are removed first, the latest row of a key is kept
+create_emission_natural_key = """
+DELETE FROM "emissionData" WHERE "emissionData_ID" IN (
+    SELECT "emissionData_ID" FROM (
+        SELECT "emissionData_ID", row_number() OVER (
+            PARTITION BY "countryCode", "sectorCode", "chemicalCode", "measureUnitCode", "fossil_bio", "year"
+            ORDER BY "emissionData_ID" DESC
+        ) AS "position"
+        FROM "emissionData"
+    ) ranked
+    WHERE "position" > 1
+);
+CREATE UNIQUE INDEX IF NOT EXISTS "emissionData_natural_key"
+ON "emissionData" ("countryCode", "sectorCode", "chemicalCode", "measureUnitCode", "fossil_bio", "year") NULLS NOT DISTINCT;
+"""
+
+#city tables created before the unique constraint existed lack it
+city_key_exists = """
+SELECT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = to_regclass('"city"') AND contype = 'u')
+"""
+
+#such a table may hold a city several times, its measurements and monthly aggregates are moved to the city
+#with the lowest id before the duplicates are deleted, a worker that waited for the lock finds the key added
+create_city_key_sql = """
+CREATE TEMP TABLE "cityDuplicate" ON COMMIT DROP AS
+SELECT "city_ID", "keptID" FROM (
+    SELECT "city_ID", min("city_ID") OVER (PARTITION BY "name", "countryCode") AS "keptID"
+    FROM "city" WHERE "name" IS NOT NULL AND "countryCode" IS NOT NULL
+) ranked
+WHERE "city_ID" <> "keptID";
+UPDATE "airMeasurement" a SET "city_ID" = d."keptID" FROM "cityDuplicate" d WHERE a."city_ID" = d."city_ID";
+INSERT INTO "monthlyAirMeasurement" ("month", "city_ID", "chemicalCode", "measureUnitCode", "sum", "count", "min", "max")
+SELECT m."month", d."keptID", m."chemicalCode", m."measureUnitCode", sum(m."sum"), sum(m."count"), min(m."min"), max(m."max")
+FROM "monthlyAirMeasurement" m JOIN "cityDuplicate" d ON m."city_ID" = d."city_ID"
+GROUP BY 1, 2, 3, 4
+ON CONFLICT ("month", "city_ID", "chemicalCode", "measureUnitCode") DO UPDATE SET
+    "sum" = "monthlyAirMeasurement"."sum" + EXCLUDED."sum",
+    "count" = "monthlyAirMeasurement"."count" + EXCLUDED."count",
+    "min" = LEAST("monthlyAirMeasurement"."min", EXCLUDED."min"),
+    "max" = GREATEST("monthlyAirMeasurement"."max", EXCLUDED."max");
+DELETE FROM "monthlyAirMeasurement" m USING "cityDuplicate" d WHERE m."city_ID" = d."city_ID";
+DELETE FROM "city" c USING "cityDuplicate" d WHERE c."city_ID" = d."city_ID";
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = to_regclass('"city"') AND contype = 'u') THEN
+        ALTER TABLE "city" ADD CONSTRAINT "city_name_countryCode_key" UNIQUE ("name", "countryCode");
+    END IF;
+END $$;
+"""
+
+#indexes on a partitioned airMeasurement are created on every partition
+create_air_measurement_indexes = """
+CREATE INDEX IF NOT EXISTS idx_date_brin ON "airMeasurement" USING BRIN (date);
+CREATE INDEX IF NOT EXISTS idx_city_chemical ON "airMeasurement" ("city_ID", "chemicalCode");
+"""
+
+#Connect to database and execute query
+def execute_query(query,description,params=db_params):
+    #the embedded database translates the postgres statements itself
+    if params.get("backend") == "duckdb":
+        try:
+            parser = DataParser.fromParams(params)
+            parser.executeScript(query)
+            parser.close()
+        except Exception as e:
+            print(f"An error occurred while {description}:", e)
+            raise
+        return
+    conn = None
     try:
-        with psycopg2.connect(**db_params) as conn:
+        with psycopg2.connect(**params) as conn:
             with conn.cursor() as cur:
-                cur.execute(create_schema)
+                cur.execute(query)
     except psycopg2.Error as e:
-        print("An error occurred while creating the schema:", e)
+        #the statements run in one transaction, nothing of it was created, the stages depending on it must not start
+        print(f"An error occurred while {description}:", e)
+        raise
     finally:
         if conn:
             conn.close()
+
+#advisory lock held while the schema is created
+SCHEMA_LOCK_ID = 20240601
+
+#leases are compared with now() by workers in different time zones, tables created with TIMESTAMP columns are converted
+upgrade_work_lease = """
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'workLease' AND column_name = 'leaseUntil' AND data_type = 'timestamp without time zone'
+    ) THEN
+        ALTER TABLE "workLease"
+            ALTER COLUMN "leaseUntil" TYPE TIMESTAMPTZ,
+            ALTER COLUMN "heartbeatAt" TYPE TIMESTAMPTZ,
+            ALTER COLUMN "updatedAt" TYPE TIMESTAMPTZ;
+    END IF;
+END $$;
+"""
+
+#optimization/commands.sql of earlier versions created monthlyAirMeasurement as a materialized view, the rollup upsert fails on it
+drop_monthly_view = """
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_class WHERE oid = to_regclass('"monthlyAirMeasurement"') AND relkind = 'm') THEN
+        DROP MATERIALIZED VIEW "monthlyAirMeasurement";
+    END IF;
+END $$;
+"""
+
+#an empty rollup next to loaded measurements replaced the view or was created after the load, it is rebuilt from airMeasurement
+backfill_monthly_rollup = """
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM "monthlyAirMeasurement") AND EXISTS (SELECT 1 FROM "airMeasurement") THEN
+        INSERT INTO "monthlyAirMeasurement" ("month", "city_ID", "chemicalCode", "measureUnitCode", "sum", "count", "min", "max")
+        SELECT DATE_TRUNC('month', "date")::date, "city_ID", "chemicalCode", "measureUnitCode", SUM("value"), COUNT("value"), MIN("value"), MAX("value")
+        FROM "airMeasurement"
+        WHERE "city_ID" IS NOT NULL AND "chemicalCode" IS NOT NULL AND "measureUnitCode" IS NOT NULL
+        GROUP BY 1, 2, 3, 4;
+    END IF;
+END $$;
+"""
+
+#relkind of airMeasurement, "r" for a plain and "p" for a partitioned table, None if it does not exist
+air_measurement_kind = """
+SELECT c.relkind FROM pg_class c WHERE c.oid = to_regclass('"airMeasurement"')
+"""
+
+def airMeasurementKind(params=db_params):
+    return fetch_value(air_measurement_kind,params)
+
+def fetch_value(query,params=db_params):
+    #first column of the first row of a postgres query, None if it returns no row
+    with psycopg2.connect(**params) as conn:
+        with conn.cursor() as cur:
+            cur.execute(query)
+            row = cur.fetchone()
+    conn.close()
+    return row[0] if row is not None else None
+
+#Connect to database and execute schema query
+def create_database_schema(partitioned=False,cityHashPartitions=0,bulkMode=False,mergeKeys=False,params=db_params):
+    schema = create_schema
+    #partitioning is only supported by postgres and only applies when airMeasurement is created,
+    #partitions cannot be attached to a plain table created before
+    if partitioned and params.get("backend") != "duckdb" and airMeasurementKind(params) == "r":
+        print("airMeasurement exists as a plain table and keeps its layout, it is not partitioned.")
+        schema += create_air_measurement
+    elif partitioned and params.get("backend") != "duckdb":
+        schema += createPartitionedAirMeasurementSQL(cityHashPartitions=cityHashPartitions)
+    else:
+        schema += create_air_measurement
+    #without bulk mode the indexes are maintained during the load
+    if not bulkMode:
+        schema += create_air_measurement_indexes
+    if params.get("backend") != "duckdb":
+        #workers of a distributed load create the schema at the same time, CREATE IF NOT EXISTS is not safe against that
+        schema = f"SELECT pg_advisory_xact_lock({SCHEMA_LOCK_ID});" + drop_monthly_view + schema + upgrade_work_lease + backfill_monthly_rollup
+    execute_query(schema,"creating the schema",params)
+    if params.get("backend") != "duckdb":
+        create_city_key(params)
+    if mergeKeys and params.get("backend") != "duckdb":
+        create_merge_keys(params)
+
+#Unique key of the city names for city tables created without it, in its own transaction like the merge keys
+def create_city_key(params=db_params):
+    if fetch_value(city_key_exists,params):
+        return
+    execute_query(f"SELECT pg_advisory_xact_lock({SCHEMA_LOCK_ID});" + create_city_key_sql,"adding the unique key of city",params)
+
+#Natural keys needed by the "merge" load method, in their own transaction so a failure leaves the schema in place
+def create_merge_keys(params=db_params):
+    if fetch_value("""SELECT to_regclass('"emissionData_natural_key"')""",params) is not None:
+        return
+    execute_query(f"SELECT pg_advisory_xact_lock({SCHEMA_LOCK_ID});" + create_emission_natural_key,"creating the natural key of emissionData (needs postgres 15 or newer)",params)
+
+#Build the indexes skipped by bulk mode and refresh the planner statistics
+def finish_bulk_load(params=db_params):
+    execute_query(create_air_measurement_indexes + "ANALYZE;","creating the indexes",params)
             
 #Connect to database and execute schema query
 def main():
-    sqlDataParser = DataParser(db_params["user"],db_params["password"],db_params["host"],db_params["port"],db_params["dbname"])
-    #Create Schema
-    print("Parsing Schema.")
-    create_database_schema()
-    print("Schema Created successfully.")
-    #Parse OWID Dataset Data
-    print("Parsing OWID Data")
-    owidDataset = OWIDDataset(sqlDataParser)
-    owidDataset.parseCountries()
-    owidDataset.parseCountryInfomation()
-    print("OWID Data parsed successfully.")
-    #Parse Health Dataset
-    print("Parsing HFA Data")
-    wHODataset = WHOData(sqlDataParser)
-    wHODataset.parseWHOData()
-    print("HFA Data parsed successfully.")
-    #Parse EDGAR Emission data
-    print("Parsing EDGAR Emission Data")
-    edgarData = EDGARData(sqlDataParser)
-    edgarData.parseEdgarData()
-    print("EDGAR Emission Data parsed sucessfully")
-    #Parse Air Quality Dataset
-    print("Parsing Air Quality Data")
-    airQualityDataset = AirQualityData(sqlDataParser,db_params)
-    airQualityDataset.parseAllAirQualityData(True,False,False)
-    print("Air Quality Data Parsed successfully")
+    params = duckdb_params if database_backend == "duckdb" else db_params
+    if profile_folder is not None:
+        #read by the profiled hot paths of this process and of the worker processes
+        os.environ[PROFILE_FOLDER_VARIABLE] = profile_folder
+    memoryBudget = MemoryBudget(memory_budget_mb)
+    sqlDataParser = DataParser.fromParams(params,loadMethod=load_method,memoryBudget=memoryBudget)
+    metrics = defaultRunMetrics
+    #dimension keys are read once and shared by all datasets
+    dimensions = DimensionRegistry(sqlDataParser)
+    #EDGAR and the air quality files are loaded at the same time, each of them gets half of the memory budget
+    loaderBudget = memoryBudget.share(2) if stage_workers > 1 else memoryBudget
+    owidDataset = OWIDDataset(sqlDataParser,metrics=metrics,dimensions=dimensions)
+    wHODataset = WHOData(sqlDataParser,metrics=metrics)
+    edgarData = EDGARData(sqlDataParser,metrics=metrics,dimensions=dimensions,memoryBudget=loaderBudget)
+    airQualityDataset = AirQualityData(sqlDataParser,params,maxConnections=8,metrics=metrics,dimensions=dimensions,memoryBudget=loaderBudget)
+    streaming = {key: value for key, value in air_quality_streaming.items() if key != "enabled"} if air_quality_streaming["enabled"] else None
+    compacted = {key: value for key, value in air_quality_compaction.items() if key != "enabled"} if air_quality_compaction["enabled"] else None
+    leases = None
+    if distributed_load["enabled"]:
+        leases = WorkLeases(sqlDataParser,leaseSeconds=distributed_load["leaseSeconds"])
+        print(f"Joining distributed load {distributed_load['runName']} as {leases.workerId}.")
+    def once(name,function):
+        #in a distributed load a stage runs on one worker only, the other workers wait until it is done
+        if leases is None:
+            return function
+        return lambda: leases.runOnce(f"{distributed_load['runName']}:{name}",function,distributed_load["pollSeconds"])
+    #every stage starts as soon as the stages it depends on are done
+    tasks = TaskGraph(metrics,sqlDataParser)
+    tasks.add("schema", lambda: create_database_schema(**airMeasurement_options,mergeKeys=load_method == "merge",params=params))
+    tasks.add("country", once("country", owidDataset.parseCountries), ["schema"])
+    tasks.add("countryInfo", once("countryInfo", owidDataset.parseCountryInfomation), ["country"])
+    tasks.add("who", once("who", wHODataset.parseWHOData), ["country"])
+    #EDGAR inserts chemicals and units as well, after the vocabularies so workers of a distributed load never insert the same rows
+    tasks.add("edgar", once("edgar", lambda: edgarData.parseEdgarData(streaming=True)), ["country","chemical","measureUnit"])
+    tasks.add("city", once("city", airQualityDataset.parseCityData), ["country"])
+    tasks.add("chemical", once("chemical", airQualityDataset.parsePollutantData), ["schema"])
+    tasks.add("measureUnit", once("measureUnit", airQualityDataset.parseMeasurementData), ["schema"])
+    if leases is None:
+        tasks.add("airQualityDownload", lambda: airQualityDataset.downloadAirQualityData(True,False,False,streaming=streaming,compacted=compacted), ["country"])
+        tasks.add("airQuality", lambda: airQualityDataset.loadAirQualityData(streaming=streaming,compacted=compacted), ["city","chemical","measureUnit","airQualityDownload"])
+    else:
+        #every worker downloads and loads only the city shards it claimed
+        shardJob = f"{distributed_load['runName']}:airQuality"
+        tasks.add("airQualityShards", once("airQualityShards", lambda: airQualityDataset.publishAirQualityShards(leases,shardJob,True,False,False)), ["country"])
+        tasks.add("airQuality", lambda: airQualityDataset.loadAirQualityShards(leases,shardJob,streaming=streaming,pollSeconds=distributed_load["pollSeconds"]), ["city","chemical","measureUnit","airQualityShards"])
+    if airMeasurement_options["bulkMode"]:
+        #indexes are created and tables analyzed once every table is loaded
+        tasks.add("finishBulkLoad", once("finishBulkLoad", lambda: finish_bulk_load(params)), ["countryInfo","who","edgar","airQuality"])
+    print(f"Running {len(tasks.tasks)} stages with {stage_workers} at a time.")
+    try:
+        tasks.run(stage_workers)
+    finally:
+        tasks.printReport()
+    #Report load throughput per table and stage
+    sqlDataParser.printLoadStats()
+    metrics.printSummary()
+    metrics.writeReport(run_report)
+    print(f"Run report written to {run_report}")
 
 
 # Main entry point
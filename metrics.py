@@ -0,0 +1,241 @@
+import cProfile
+import datetime
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    #not available on windows, peak memory is not reported there
+    resource = None
+
+#folder the hot path profiles are written to, set it to enable profiling (inherited by worker processes)
+PROFILE_FOLDER_VARIABLE = "AIRQUALITY_PROFILE_FOLDER"
+
+def peakRssMB(children=False):
+    """
+    :param children: peak of the finished child processes (process pool workers) instead of this process
+    :return: peak resident memory in MB, None if unknown
+    """
+    if resource is None:
+        return None
+    #ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    scale = 1 if sys.platform == "darwin" else 1024
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    return resource.getrusage(who).ru_maxrss * scale / 1e6
+
+def fileRecord(source,stage):
+    """
+    :return: metrics of one source file, filled by the code parsing it
+    """
+    return {
+        "source": source,
+        "stage": stage,
+        "seconds": 0.0,
+        "bytesRead": os.path.getsize(source) if os.path.exists(source) else 0,
+        "rowsRead": 0,
+        "rowsOut": 0,
+        "rowsWritten": 0,
+        #rows dropped per reason
+        "rowsFiltered": {},
+        "dbWriteSeconds": 0.0,
+        "peakRssMB": None,
+        "error": None
+    }
+
+def addFiltered(record,reason,rows):
+    record["rowsFiltered"][reason] = record["rowsFiltered"].get(reason, 0) + int(rows)
+
+#profiles of the current process, one per hot path and thread
+profiles = {}
+
+def profilingFolder():
+    return os.environ.get(PROFILE_FOLDER_VARIABLE)
+
+def startProfile(name):
+    if profilingFolder() is None:
+        return None
+    key = (name, threading.get_ident())
+    profile = profiles.setdefault(key, cProfile.Profile())
+    try:
+        profile.enable()
+    except ValueError:
+        #another profiler is already active in this thread
+        return None
+    return key
+
+def stopProfile(key):
+    if key is None:
+        return
+    name, thread = key
+    profile = profiles[key]
+    profile.disable()
+    #workers of a process pool exit without running atexit handlers, the cumulative profile is dumped after every call
+    folder = profilingFolder()
+    os.makedirs(folder, exist_ok=True)
+    profile.dump_stats(os.path.join(folder, f"{name}-{os.getpid()}-{thread}.prof"))
+
+def profiled(name):
+    """
+    Decorator for hot paths, profiles every call with cProfile if AIRQUALITY_PROFILE_FOLDER is set and does nothing otherwise.
+    The files can be read with pstats or snakeviz, sampling profilers like py-spy need no hook at all.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            key = startProfile(name)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stopProfile(key)
+        return wrapper
+    return decorator
+
+class StageCounter:
+    """
+    Rows loaded and files recorded by one stage, stages running at the same time on different threads are counted separately.
+    """
+    def __init__(self):
+        self.rows = 0
+        self.files = []
+        self.lock = threading.Lock()
+
+    def addRows(self,rows):
+        with self.lock:
+            self.rows += rows
+
+    def addFile(self,record):
+        with self.lock:
+            self.files.append(record)
+
+#counter of the stage running on the current thread
+currentStage = threading.local()
+
+def stageCounter():
+    return getattr(currentStage, "counter", None)
+
+def attachStage(counter:StageCounter):
+    #worker threads of a stage count their loads towards the stage that started them
+    currentStage.counter = counter
+
+def addStageRows(rows):
+    #called by the data parsers for every load
+    counter = stageCounter()
+    if counter is not None:
+        counter.addRows(rows)
+
+class RunMetrics:
+    """
+    Collects wall time, rows, bytes and peak memory per stage and per source file of a run.
+    File records are plain dictionaries, process pool workers return them and the main process adds them here.
+    """
+    def __init__(self):
+        self.stages = []
+        self.files = []
+        self.lock = threading.Lock()
+        self.startedAt = datetime.datetime.now()
+        self.start = time.perf_counter()
+        #report of the task graph of the run, if the stages ran as one
+        self.taskGraph = None
+
+    @contextmanager
+    def stage(self,name,dataParser=None):
+        """
+        Measures a stage, rows written and files are the ones of the thread running the stage (and of threads attached to it),
+        so stages can run at the same time.
+
+        :param dataParser: rows written are only counted if the parser of the stage is given
+        """
+        outerCounter = stageCounter()
+        counter = StageCounter()
+        attachStage(counter)
+        start = time.perf_counter()
+        profileKey = startProfile(f"stage-{name}")
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = repr(e)
+            raise
+        finally:
+            stopProfile(profileKey)
+            attachStage(outerCounter)
+            #a nested stage also counts towards the stage around it
+            if outerCounter is not None:
+                outerCounter.addRows(counter.rows)
+                for record in counter.files:
+                    outerCounter.addFile(record)
+            files = counter.files
+            with self.lock:
+                self.stages.append({
+                    "stage": name,
+                    "seconds": time.perf_counter() - start,
+                    "rowsWritten": counter.rows if dataParser is not None else 0,
+                    "bytesRead": sum(record["bytesRead"] for record in files),
+                    "files": len(files),
+                    "failedFiles": sum(1 for record in files if record["error"] is not None),
+                    "peakRssMB": peakRssMB(),
+                    "peakChildRssMB": peakRssMB(children=True),
+                    "error": error
+                })
+
+    def addFile(self,record):
+        with self.lock:
+            self.files.append(record)
+        counter = stageCounter()
+        if counter is not None:
+            counter.addFile(record)
+
+    def addFailure(self,source,stage,exception):
+        #failures of workers are kept in the report instead of only being printed
+        record = fileRecord(source, stage)
+        record["error"] = "".join(traceback.format_exception(exception)).strip()
+        self.addFile(record)
+        return record
+
+    def report(self):
+        rowsFiltered = {}
+        with self.lock:
+            files = list(self.files)
+        for record in files:
+            for reason, rows in record["rowsFiltered"].items():
+                rowsFiltered[reason] = rowsFiltered.get(reason, 0) + rows
+        return {
+            "startedAt": self.startedAt.isoformat(timespec="seconds"),
+            "seconds": time.perf_counter() - self.start,
+            "peakRssMB": peakRssMB(),
+            "peakChildRssMB": peakRssMB(children=True),
+            "rowsFiltered": rowsFiltered,
+            "failedFiles": [record["source"] for record in files if record["error"] is not None],
+            "stages": self.stages,
+            "taskGraph": self.taskGraph,
+            "files": files
+        }
+
+    def recordTasks(self,taskGraphReport):
+        self.taskGraph = taskGraphReport
+
+    def writeReport(self,path):
+        report = self.report()
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        #write to a temporary name so an interrupted run never leaves a broken report
+        temporaryPath = f"{path}.{os.getpid()}.tmp"
+        with open(temporaryPath, "w", encoding="utf-8") as reportFile:
+            json.dump(report, reportFile, indent=2, default=str)
+        os.replace(temporaryPath, path)
+        return report
+
+    def printSummary(self):
+        for stage in self.stages:
+            print(f"{stage['stage']}: {stage['seconds']:.2f}s, {stage['rowsWritten']} rows, {stage['bytesRead'] / 1e6:.1f} MB, {stage['failedFiles']}/{stage['files']} files failed")
+
+#metrics shared by all dataset classes of a run
+defaultRunMetrics = RunMetrics()
@@ -1,19 +1,26 @@
---Create brin index for date 
-CREATE INDEX idx_date_brin ON "airMeasurement" USING BRIN (date);
--- Create index for pair city_ID and chemical code
-CREATE INDEX idx_city_chemical ON "airMeasurement" ("city_ID", "chemicalCode");
---Create materialized view for monthly measurement aggregates
-CREATE MATERIALIZED VIEW public."monthlyAirMeasurement" AS
+--The BRIN index on date and the index on the pair city_ID and chemical code are created by main.py,
+--in bulk mode after the load finished
+--monthlyAirMeasurement is a table created by main.py and kept up to date by the air quality workers,
+--rebuild it from airMeasurement for data loaded before the table existed
+BEGIN;
+TRUNCATE public."monthlyAirMeasurement";
+INSERT INTO public."monthlyAirMeasurement" ("month", "city_ID", "chemicalCode", "measureUnitCode", "sum", "count", "min", "max")
 SELECT
-    DATE_TRUNC('month', date) AS month,
+    DATE_TRUNC('month', date)::date AS month,
     "city_ID",
     "chemicalCode",
     "measureUnitCode",
-    AVG(value) AS average_value
+    SUM(value),
+    COUNT(value),
+    MIN(value),
+    MAX(value)
 FROM
     public."airMeasurement"
+WHERE
+    "city_ID" IS NOT NULL AND "chemicalCode" IS NOT NULL AND "measureUnitCode" IS NOT NULL
 GROUP BY
-    DATE_TRUNC('month', date),
+    DATE_TRUNC('month', date)::date,
     "city_ID",
     "chemicalCode",
     "measureUnitCode";
+COMMIT;
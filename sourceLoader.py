@@ -0,0 +1,100 @@
+import os
+import threading
+import pandas as pd
+from loadManifest import hashFile
+
+#raw source files with the columns and compact dtypes the loaders need
+SOURCES = {
+    "owid": {
+        "path": os.path.join("OWID","owid-co2-data.csv"),
+        "readOptions": {
+            "usecols": ["iso_code","country","year","population","gdp","energy_per_capita"],
+            #population and gdp exceed the float32 precision, they stay float64
+            "dtype": {"iso_code": "category", "country": "category", "year": "int16", "population": "float64", "gdp": "float64", "energy_per_capita": "float32"}
+        }
+    },
+    "who": {
+        "path": os.path.join("WHO_HFA","HFA_221_EN.csv"),
+        "readOptions": {
+            "skiprows": 26,
+            "header": None,
+            "names": ["countryCode", "COUNTRY_GRP", "SEX", "year", "rate"],
+            "usecols": ["countryCode", "year", "rate"],
+            "dtype": {"countryCode": "category", "year": "Int16", "rate": "float32"}
+        }
+    },
+    "chemicalVocabulary": {
+        "path": os.path.join("AirQuality","chemicalVocabulary.csv"),
+        "readOptions": {
+            "usecols": ["chemicalID","name","chemicalCode"],
+            "dtype": {"chemicalID": "int32", "name": "string", "chemicalCode": "string"}
+        }
+    },
+    "chemicalUnitMap": {
+        "path": os.path.join("AirQuality","chemicalUnitMap.csv"),
+        "readOptions": {
+            "dtype": {"chemicalID": "int32", "recommendedUnit": "category"}
+        }
+    },
+    "countryCodes": {
+        "path": os.path.join("AirQuality","countryCodes.csv"),
+        "readOptions": {
+            "usecols": ["alpha-2","alpha-3"],
+            "dtype": {"alpha-2": "string", "alpha-3": "string"},
+            #"NA" is the alpha-2 code of Namibia
+            "keep_default_na": False
+        }
+    },
+    "concentration": {
+        "path": os.path.join("AirQuality","concentration.csv"),
+        "readOptions": {
+            "usecols": ["URI","Label","Definition"],
+            "dtype": {"URI": "string", "Label": "string", "Definition": "string"},
+            "encoding": "utf-8-sig"
+        }
+    }
+}
+
+class SourceStore:
+    """
+    Reads every raw source file at most once per run with only the needed columns and compact dtypes.
+    Parsed frames are memoized in memory and cached as parquet files keyed by the content hash of the source,
+    so later runs skip the csv parsing as long as the source file does not change.
+    """
+    def __init__(self,cacheFolder:str=os.path.join("cache","sources"),sources:dict=SOURCES):
+        self.cacheFolder = cacheFolder
+        self.sources = sources
+        self.frames = {}
+        self.lock = threading.Lock()
+
+    def load(self,name):
+        """
+        :return: shallow copy of the memoized frame, adding or replacing columns does not change the store
+        """
+        with self.lock:
+            if name not in self.frames:
+                self.frames[name] = self.read(name)
+            return self.frames[name].copy(deep=False)
+
+    def path(self,name):
+        return self.sources[name]["path"]
+
+    def read(self,name):
+        source = self.sources[name]
+        cachePath = os.path.join(self.cacheFolder, f"{name}-{hashFile(source['path'])[:16]}.parquet")
+        if os.path.exists(cachePath):
+            return pd.read_parquet(cachePath)
+        frame = pd.read_csv(source["path"], **source["readOptions"])
+        os.makedirs(self.cacheFolder, exist_ok=True)
+        #write to a temporary name so an interrupted run never leaves a broken cache file
+        temporaryPath = f"{cachePath}.{os.getpid()}.tmp"
+        frame.to_parquet(temporaryPath, index=False)
+        os.replace(temporaryPath, cachePath)
+        return frame
+
+    def clear(self):
+        with self.lock:
+            self.frames = {}
+
+#store shared by all dataset classes of a run
+defaultSourceStore = SourceStore()
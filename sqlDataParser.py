@@ -1,46 +1,412 @@
+import io
+import threading
+import time
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 from sqlalchemy import create_engine,text
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import OperationalError, DBAPIError
+import psycopg2
+from stagingMerge import MERGE_TARGETS, createStagingSQL, mergeSQL
+from frameSchema import MemoryBudget, bytesPerRow
+from metrics import addStageRows
+
+#PGCOPY binary file header: signature, flags field and header extension length
+BINARY_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + np.array([0, 0], dtype=">i4").tobytes()
+BINARY_COPY_TRAILER = np.array([-1], dtype=">i2").tobytes()
+#postgres epoch is 2000-01-01, numpy epoch is 1970-01-01
+POSTGRES_EPOCH_DAYS = 10957
+POSTGRES_EPOCH_MICROSECONDS = POSTGRES_EPOCH_DAYS * 86400 * 1000000
+#fixed width binary representation of postgres types
+BINARY_FIXED_TYPES = {
+    "smallint": ">i2",
+    "integer": ">i4",
+    "bigint": ">i8",
+    "real": ">f4",
+    "double precision": ">f8",
+    "boolean": "u1",
+    "date": ">i4",
+    "timestamp without time zone": ">i8",
+}
+BINARY_TEXT_TYPES = ("character varying", "character", "text")
+INTEGER_TYPES = ("smallint", "integer", "bigint")
 
 
 #Helper class to parse panda dataframes
 class DataParser:
+    backend = "postgres"
 
-    def __init__(self, username:str, password:str,host:str,port:int,databaseName:str):
-        self.sqlEngine = create_engine(f"postgresql+psycopg2://{username}:{password}@{host}:{port}/{databaseName}")
+    def __init__(self, username:str, password:str,host:str,port:int,databaseName:str,loadMethod:str="copy",copyFormat:str="text",chunkSize:int=100000,poolSize:int=5,maxOverflow:int=10,poolRecycle:int=1800,testConnection:bool=True,memoryBudget:MemoryBudget=None):
+        """
+        :param loadMethod: "copy" streams frames with COPY FROM STDIN, "insert" uses DataFrame.to_sql,
+            "merge" copies the frames of the tables in MERGE_TARGETS into an UNLOGGED staging table and merges them with ON CONFLICT
+        :param copyFormat: "text" (csv encoded) or "binary" COPY format
+        :param chunkSize: amount of rows sent per COPY statement, the maximum if a memory budget is given
+        :param poolSize: connections kept open by the engine pool
+        :param maxOverflow: additional connections the pool may open under load
+        :param poolRecycle: seconds after which a pooled connection is replaced, before the server or a proxy drops it as idle
+        :param testConnection: run a SELECT 1 health check on creation
+        :param memoryBudget: smaller COPY chunks are sent for frames with wide rows so the encoded chunk stays within the budget
+        """
+        if loadMethod not in ("copy", "insert", "merge"):
+            raise ValueError(f"Unknown load method: {loadMethod}")
+        if copyFormat not in ("text", "binary"):
+            raise ValueError(f"Unknown copy format: {copyFormat}")
+        self.loadMethod = loadMethod
+        self.copyFormat = copyFormat
+        self.chunkSize = chunkSize
+        self.memoryBudget = memoryBudget
+        #rows and seconds spent per table, used to report rows/s
+        self.loadStats = {}
+        self.statsLock = threading.Lock()
+        self.columnTypes = {}
+        #the pool bounds the amount of connections this parser opens, there is no health check per checkout,
+        #old connections are recycled and a connection dropped by the server is replaced when a call fails on it
+        self.sqlEngine = create_engine(
+            f"postgresql+psycopg2://{username}:{password}@{host}:{port}/{databaseName}",
+            pool_size=poolSize,
+            max_overflow=maxOverflow,
+            pool_recycle=poolRecycle
+        )
         #Test database connection
-        try:
-            with self.sqlEngine.connect() as connection:
-                connection.execute(text("SELECT 1"))
-                print(f"Successful connection to Database.")
-        except OperationalError as e:
-            print(f"Error connecting to the database: {e}")
-        
+        if testConnection:
+            try:
+                with self.sqlEngine.connect() as connection:
+                    connection.execute(text("SELECT 1"))
+                    print(f"Successful connection to Database.")
+            except OperationalError as e:
+                print(f"Error connecting to the database: {e}")
+
         self.Session = sessionmaker(bind=self.sqlEngine)
 
+    @classmethod
+    def fromParams(cls,db_params,**kwargs):
+        #create a parser from the db_params dictionary used by main.py, {"backend": "duckdb", "path": ...} selects the embedded database
+        if db_params.get("backend") == "duckdb":
+            from duckDBDataParser import DuckDBDataParser
+            return DuckDBDataParser.fromParams(db_params,**kwargs)
+        return cls(db_params["user"],db_params["password"],db_params["host"],db_params["port"],db_params["dbname"],**kwargs)
+
     #parse data, rollback everything if fail
-    def parsePandaDFToTable(self,dataframe:pd.DataFrame,tableName):
+    def parsePandaDFToTable(self,dataframe:pd.DataFrame | pa.Table,tableName,reportRate:bool=True,inTransaction=None):
+        """
+        Loads a dataframe or arrow table into a table inside one transaction.
+
+        :param inTransaction: optional function called with the psycopg2 cursor before the commit,
+            statements it executes are committed or rolled back together with the loaded rows
+        :return: amount of rows loaded, 0 if the transaction failed
+        """
+        return self.parseFramesToTable([dataframe],tableName,reportRate,inTransaction)
+
+    def parseFramesToTable(self,frames,tableName,reportRate:bool=True,inTransaction=None):
+        """
+        Loads an iterable of dataframes or arrow tables into a table inside one transaction.
+        Frames are consumed one after another, so a generator keeps only one frame in memory.
+        An item can also be a (table name, frame) pair, which copies the frame into that table instead,
+        e.g. a partition of tableName.
+        With the "merge" load method the rows of merged tables are staged and merged before inTransaction is called.
+
+        :return: amount of rows loaded (inserted or updated by the merge), 0 if the transaction failed
+        """
+        start = time.perf_counter()
+        #a list of frames can be sent again if the transaction failed on a dropped connection, a generator is consumed
+        retry = isinstance(frames, (list, tuple))
+        rows = self.retryOnDisconnect(lambda: self.loadFrames(frames,tableName,inTransaction),retry)
+        elapsed = time.perf_counter() - start
+        self.recordLoad(tableName,rows,elapsed)
+        if reportRate and rows > 0:
+            print(f"Loaded {rows} rows into {tableName} in {elapsed:.2f}s ({rows / max(elapsed, 1e-9):.0f} rows/s)")
+        return rows
+
+    def loadFrames(self,frames,tableName,inTransaction):
+        #one transaction of parseFramesToTable, returns 0 if it failed and raises if its connection was dropped
         session = self.Session()
+        rows = 0
+        #target table to staging table and its columns
+        staging = {}
         #make whole parse atomic
         try:
-            #Insert dataframe
-            dataframe.to_sql(tableName, session.bind, if_exists='append', index=False)
+            #all chunks are copied over the same psycopg2 connection of the session transaction
+            cursor = session.connection().connection.dbapi_connection.cursor()
+            for dataframe in frames:
+                targetTable = tableName
+                if isinstance(dataframe, tuple):
+                    targetTable, dataframe = dataframe
+                if self.merges(targetTable):
+                    self.stageDataFrame(cursor,dataframe,targetTable,staging)
+                    continue
+                if self.loadMethod != "insert":
+                    self.copyDataFrame(cursor,dataframe,targetTable)
+                else:
+                    if isinstance(dataframe, pa.Table):
+                        dataframe = dataframe.to_pandas()
+                    #Insert dataframe
+                    dataframe.to_sql(targetTable, session.connection(), if_exists='append', index=False)
+                rows += len(dataframe)
+            for targetTable, (stagingName, columns) in staging.items():
+                cursor.execute(mergeSQL(targetTable,stagingName,columns))
+                rows += cursor.rowcount
+                cursor.execute(f'DROP TABLE "{stagingName}"')
+            if inTransaction is not None:
+                inTransaction(cursor)
             session.commit()
         except Exception as e:
+            if self.isDisconnect(e):
+                session.invalidate()
+                raise
             session.rollback()
+            rows = 0
             print("Transaction failed:", e)
         finally:
             session.close()
-            
-    #Make normal call
-    def makeCall(self, query):
-        with self.sqlEngine.connect() as connection:
-            return connection.execute(text(query)).fetchall()
+        return rows
+
+    def isDisconnect(self,error):
+        #True if the error means the connection was dropped, e.g. by a server restart or an idle timeout
+        if isinstance(error, DBAPIError):
+            return error.connection_invalidated
+        if isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+            return self.sqlEngine.dialect.is_disconnect(error, None, None)
+        return False
+
+    def retryOnDisconnect(self,function,retry:bool=True):
+        """
+        Calls function, if its connection was dropped the pooled connections are replaced and it is called once more.
+        Connections are not checked before they are used, so a dropped connection is only noticed here.
+
+        :param retry: False only replaces the connections, the error of a call that cannot be repeated is printed
+        :return: result of function, 0 if a call that cannot be repeated failed
+        """
+        try:
+            return function()
+        except Exception as e:
+            if not self.isDisconnect(e):
+                raise
+            #the other pooled connections were most likely dropped as well
+            self.sqlEngine.dispose()
+            if not retry:
+                print("Transaction failed, the database connection was lost:", e)
+                return 0
+        return function()
+
+    def merges(self,tableName):
+        #True if rows of the table are deduplicated and filtered against their foreign keys by the database
+        return self.loadMethod == "merge" and tableName in MERGE_TARGETS
+
+    def stageDataFrame(self,cursor,dataframe:pd.DataFrame | pa.Table,tableName,staging):
+        """
+        Copies a frame into the staging table of tableName, the staging table is created by the first frame of the transaction.
+        """
+        columnNames = dataframe.column_names if isinstance(dataframe, pa.Table) else list(dataframe.columns)
+        if tableName not in staging:
+            #named after the server process, concurrent loads of the same table stage into different tables
+            stagingName = f"{tableName}_staging_{cursor.connection.get_backend_pid()}"
+            cursor.execute(createStagingSQL(tableName,stagingName,columnNames))
+            staging[tableName] = (stagingName, columnNames)
+        stagingName, stagedColumns = staging[tableName]
+        if columnNames != stagedColumns:
+            raise ValueError(f"Frames of {tableName} have different columns: {columnNames} and {stagedColumns}")
+        self.copyDataFrame(cursor,dataframe,stagingName,typesTable=tableName)
+
+    def recordLoad(self,tableName,rows,seconds):
+        #stages of a task graph load at the same time
+        with self.statsLock:
+            loadedRows, loadedSeconds = self.loadStats.get(tableName,(0,0.0))
+            self.loadStats[tableName] = (loadedRows + rows, loadedSeconds + seconds)
+        addStageRows(rows)
+
+    def printLoadStats(self):
+        for tableName, (rows, seconds) in self.loadStats.items():
+            print(f"{tableName}: {rows} rows in {seconds:.2f}s ({rows / max(seconds, 1e-9):.0f} rows/s)")
+
+    def copyDataFrame(self,cursor,dataframe:pd.DataFrame | pa.Table,tableName,typesTable=None):
+        """
+        Streams a dataframe or arrow table into a table with COPY FROM STDIN in chunks of chunkSize rows.
+        Arrow tables are written as csv by arrow itself without a pandas conversion.
+        The cursor's transaction is neither committed nor rolled back here.
+
+        :param typesTable: table the column types are read from, defaults to tableName
+        """
+        if len(dataframe) == 0:
+            return
+        isArrow = isinstance(dataframe, pa.Table)
+        columnNames = dataframe.column_names if isArrow else list(dataframe.columns)
+        columnTypes = self.fetchColumnTypes(cursor,typesTable or tableName,columnNames)
+        columns = ",".join(f'"{column}"' for column in columnNames)
+        copyOption = "binary" if self.copyFormat == "binary" else "csv"
+        query = f'COPY "{tableName}" ({columns}) FROM STDIN WITH (FORMAT {copyOption})'
+        if copyOption == "csv" and not isArrow:
+            #pandas writes NULL and an empty string both as an empty field, NULL gets its own marker,
+            #arrow quotes every string so an unquoted empty field is NULL there
+            query = f"""COPY "{tableName}" ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"""
+        chunkSize = self.chunkSize
+        if self.memoryBudget is not None:
+            chunkSize = self.memoryBudget.rowsFor(bytesPerRow(dataframe),maximum=self.chunkSize)
+        for start in range(0, len(dataframe), chunkSize):
+            if isArrow:
+                chunk = dataframe.slice(start, chunkSize)
+            else:
+                chunk = dataframe.iloc[start:start + chunkSize]
+            if self.copyFormat == "binary":
+                if isArrow:
+                    chunk = chunk.to_pandas()
+                buffer = io.BytesIO(encodeBinaryCopy(chunk,columnTypes))
+            elif isArrow:
+                buffer = io.BytesIO()
+                pacsv.write_csv(prepareArrowTextCopy(chunk,columnTypes), buffer, write_options=pacsv.WriteOptions(include_header=False))
+                buffer.seek(0)
+            else:
+                buffer = io.StringIO()
+                prepareTextCopy(chunk,columnTypes).to_csv(buffer, index=False, header=False, na_rep="\\N")
+                buffer.seek(0)
+            cursor.copy_expert(query, buffer)
 
+    def fetchColumnTypes(self,cursor,tableName,columns):
+        #postgres data types of the target columns, cached per table
+        if tableName not in self.columnTypes:
+            cursor.execute(
+                "SELECT column_name, data_type FROM information_schema.columns WHERE table_name = %s AND table_schema = current_schema()",
+                (tableName,)
+            )
+            self.columnTypes[tableName] = dict(cursor.fetchall())
+        tableTypes = self.columnTypes[tableName]
+        missing = [column for column in columns if column not in tableTypes]
+        if missing:
+            raise ValueError(f"Columns {missing} do not exist in table {tableName}")
+        return [tableTypes[column] for column in columns]
 
     def makeCall(self, query, params=None):
         if params is None:
             params = {}
-        with self.sqlEngine.connect() as connection:
-            return connection.execute(text(query), params).fetchall()
+        def call():
+            with self.sqlEngine.connect() as connection:
+                return connection.execute(text(query), params).fetchall()
+        return self.retryOnDisconnect(call)
+
+    def fetchArrow(self,query,params=None):
+        """
+        Runs a query in psycopg2 parameter style and returns its result as an arrow table.
+        The rows are streamed with COPY TO STDOUT and parsed by arrow, no python tuple is created per row.
+        """
+        def copy(cursor):
+            #COPY takes no bind parameters, they are inlined by the driver
+            copyQuery = f"COPY ({cursor.mogrify(query, params).decode('utf-8')}) TO STDOUT WITH (FORMAT csv, HEADER)"
+            buffer = io.BytesIO()
+            cursor.copy_expert(copyQuery, buffer)
+            buffer.seek(0)
+            return buffer
+        buffer = self.retryOnDisconnect(lambda: self.onRawConnection(copy,commit=False))
+        #NULL is written as an empty field, an empty string as ""
+        convertOptions = pacsv.ConvertOptions(null_values=[""], strings_can_be_null=True, quoted_strings_can_be_null=False)
+        return pacsv.read_csv(buffer, convert_options=convertOptions)
+
+    def execute(self,query,params=None):
+        """
+        Single statement in psycopg2 parameter style, executed on a raw connection and committed on its own.
+
+        :return: rows returned by the statement (e.g. by RETURNING), None if it returns none
+        """
+        def run(cursor):
+            cursor.execute(query, params)
+            return cursor.fetchall() if cursor.description is not None else None
+        return self.retryOnDisconnect(lambda: self.onRawConnection(run))
+
+    def executeScript(self,schema):
+        self.retryOnDisconnect(lambda: self.onRawConnection(lambda cursor: cursor.execute(schema)))
+
+    def onRawConnection(self,function,commit:bool=True):
+        #calls function with a cursor of a pooled psycopg2 connection, a dropped connection is not returned to the pool
+        connection = self.sqlEngine.raw_connection()
+        try:
+            result = function(connection.cursor())
+            if commit:
+                connection.commit()
+            return result
+        except Exception as e:
+            if self.isDisconnect(e):
+                connection.invalidate()
+            raise
+        finally:
+            connection.close()
+
+    def close(self):
+        self.sqlEngine.dispose()
+
+
+def prepareTextCopy(chunk:pd.DataFrame,columnTypes):
+    #float columns with missing values would be written as 1.0 which integer columns reject
+    chunk = chunk.copy(deep=False)
+    for column, pgType in zip(chunk.columns, columnTypes):
+        if pgType in INTEGER_TYPES and pd.api.types.is_float_dtype(chunk[column]):
+            chunk[column] = chunk[column].astype("Int64")
+    return chunk
+
+
+def prepareArrowTextCopy(chunk:pa.Table,columnTypes):
+    #same coercion for arrow tables, large floats would be written in exponent notation
+    for index, pgType in enumerate(columnTypes):
+        if pgType in INTEGER_TYPES and pa.types.is_floating(chunk.column(index).type):
+            chunk = chunk.set_column(index, chunk.field(index).name, pc.cast(chunk.column(index), pa.int64()))
+    return chunk
+
+
+def encodeBinaryColumn(series:pd.Series,pgType):
+    """
+    Encodes one column into its PGCOPY binary payload.
+
+    :return: null mask, byte length per row and the concatenated payload of all non null values
+    """
+    isNull = series.isna().to_numpy()
+    valid = series[~isNull]
+    lengths = np.zeros(len(series), dtype=np.int64)
+    if pgType in BINARY_FIXED_TYPES:
+        dtype = np.dtype(BINARY_FIXED_TYPES[pgType])
+        if pgType == "date":
+            values = pd.to_datetime(valid).to_numpy().astype("datetime64[D]").astype(np.int64) - POSTGRES_EPOCH_DAYS
+        elif pgType == "timestamp without time zone":
+            values = pd.to_datetime(valid).to_numpy().astype("datetime64[us]").astype(np.int64) - POSTGRES_EPOCH_MICROSECONDS
+        else:
+            values = valid.to_numpy()
+        payload = np.ascontiguousarray(values.astype(dtype)).view(np.uint8)
+        lengths[~isNull] = dtype.itemsize
+    elif pgType in BINARY_TEXT_TYPES:
+        encoded = [str(value).encode("utf-8") for value in valid]
+        payload = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        lengths[~isNull] = [len(value) for value in encoded]
+    else:
+        raise ValueError(f"Binary copy does not support column type {pgType}")
+    return isNull, lengths, payload
+
+
+def encodeBinaryCopy(chunk:pd.DataFrame,columnTypes):
+    """
+    Encodes a dataframe into a PGCOPY binary stream.
+    Every field is scattered into one preallocated buffer with numpy instead of packing row by row.
+    """
+    rowCount = len(chunk)
+    columns = [encodeBinaryColumn(chunk[column], pgType) for column, pgType in zip(chunk.columns, columnTypes)]
+    #every row starts with a 2 byte field count, every field with a 4 byte length
+    rowSizes = np.full(rowCount, 2 + 4 * len(columns), dtype=np.int64)
+    for _, lengths, _ in columns:
+        rowSizes += lengths
+    rowStarts = np.cumsum(rowSizes) - rowSizes
+    buffer = np.empty(int(rowSizes.sum()), dtype=np.uint8)
+    fieldCount = np.full(rowCount, len(columns), dtype=">i2").view(np.uint8).reshape(rowCount, 2)
+    buffer[rowStarts[:, None] + np.arange(2)] = fieldCount
+    position = rowStarts + 2
+    for isNull, lengths, payload in columns:
+        header = np.where(isNull, -1, lengths).astype(">i4").view(np.uint8).reshape(rowCount, 4)
+        buffer[position[:, None] + np.arange(4)] = header
+        position = position + 4
+        hasPayload = lengths > 0
+        if hasPayload.any():
+            payloadLengths = lengths[hasPayload]
+            payloadStarts = np.cumsum(payloadLengths) - payloadLengths
+            #target index of every payload byte: row position plus offset inside the value
+            index = np.repeat(position[hasPayload] - payloadStarts, payloadLengths) + np.arange(len(payload))
+            buffer[index] = payload
+        position = position + lengths
+    return BINARY_COPY_HEADER + buffer.tobytes() + BINARY_COPY_TRAILER
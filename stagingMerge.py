@@ -0,0 +1,70 @@
+#natural key, conflict action and foreign keys of the tables the "merge" load method writes through a staging table
+#update: rows with a known key overwrite the stored values, otherwise they are skipped
+MERGE_TARGETS = {
+    "country": {"conflictColumns": ["countryCode"], "update": False, "references": {}},
+    "chemical": {"conflictColumns": ["chemicalCode"], "update": False, "references": {}},
+    "measureUnit": {"conflictColumns": ["measureUnitCode"], "update": False, "references": {}},
+    "sector": {"conflictColumns": ["sectorCode"], "update": False, "references": {}},
+    "city": {
+        "conflictColumns": ["name","countryCode"],
+        "update": False,
+        "references": {"countryCode": ("country","countryCode")}
+    },
+    "countryInfo": {
+        "conflictColumns": ["year","countryCode"],
+        "update": True,
+        "references": {"countryCode": ("country","countryCode")}
+    },
+    "sDRRespiratoryDisease": {
+        "conflictColumns": ["year","countryCode"],
+        "update": True,
+        "references": {"countryCode": ("country","countryCode")}
+    },
+    "emissionData": {
+        "conflictColumns": ["countryCode","sectorCode","chemicalCode","measureUnitCode","fossil_bio","year"],
+        "update": True,
+        "references": {
+            "countryCode": ("country","countryCode"),
+            "sectorCode": ("sector","sectorCode"),
+            "chemicalCode": ("chemical","chemicalCode"),
+            "measureUnitCode": ("measureUnit","measureUnitCode")
+        }
+    }
+}
+
+def quoteColumns(columns,prefix=""):
+    return ", ".join(f'{prefix}"{column}"' for column in columns)
+
+def createStagingSQL(tableName,stagingName,columns):
+    """
+    UNLOGGED staging table with the types of the loaded columns of tableName and without constraints.
+    Writes to it skip the write ahead log, it is dropped by the transaction that created it.
+    """
+    return f'CREATE UNLOGGED TABLE "{stagingName}" AS SELECT {quoteColumns(columns)} FROM "{tableName}" WITH NO DATA'
+
+def mergeSQL(tableName,stagingName,columns,target=None):
+    """
+    Set based merge of a staging table into tableName.
+    Rows referencing a missing key and duplicate keys of the staging table are dropped by the database,
+    rows whose key already exists are skipped or update the stored row.
+    """
+    target = target or MERGE_TARGETS[tableName]
+    conflictColumns = target["conflictColumns"]
+    #ON CONFLICT DO UPDATE may not touch a row twice, the staging rows are reduced to one row per key first
+    query = f'INSERT INTO "{tableName}" ({quoteColumns(columns)})\n'
+    query += f'SELECT DISTINCT ON ({quoteColumns(conflictColumns, "s.")}) {quoteColumns(columns, "s.")}\nFROM "{stagingName}" s'
+    conditions = []
+    for column, (referencedTable, referencedColumn) in target["references"].items():
+        if column in columns:
+            conditions.append(f'(s."{column}" IS NULL OR EXISTS (SELECT 1 FROM "{referencedTable}" r WHERE r."{referencedColumn}" = s."{column}"))')
+    if conditions:
+        query += "\nWHERE " + "\n  AND ".join(conditions)
+    #the staging table is only appended to by COPY, the row copied last has the highest ctid and wins
+    query += f"\nORDER BY {quoteColumns(conflictColumns, 's.')}, s.ctid DESC"
+    query += f"\nON CONFLICT ({quoteColumns(conflictColumns)}) "
+    updateColumns = [column for column in columns if column not in conflictColumns]
+    if target["update"] and updateColumns:
+        query += "DO UPDATE SET " + ", ".join(f'"{column}" = EXCLUDED."{column}"' for column in updateColumns)
+    else:
+        query += "DO NOTHING"
+    return query
@@ -0,0 +1,159 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing
+import time
+from metrics import RunMetrics, defaultRunMetrics
+
+#statuses of a task after a run
+TASK_DONE = "done"
+TASK_FAILED = "failed"
+TASK_SKIPPED = "skipped"
+#start method of the process pools of the stages, a child forked while another stage thread holds a lock can deadlock
+POOL_CONTEXT = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+class TaskGraph:
+    """
+    Runs loader stages as a dependency graph, every task starts as soon as all tasks it depends on are done.
+    Tasks run on threads, the heavy lifting happens in the database and in the process pools of the loaders.
+    If a task fails, the tasks depending on it are skipped while independent tasks still run.
+    """
+    def __init__(self,metrics:RunMetrics=defaultRunMetrics,dataParser=None):
+        """
+        :param metrics: every task is measured as a stage of metrics
+        :param dataParser: parser the rows written by the stages are counted on
+        """
+        self.metrics = metrics
+        self.dataParser = dataParser
+        #task name to (function, names of the tasks it depends on)
+        self.tasks = {}
+        #task name to status, start and end offset in seconds and error of the last run
+        self.results = {}
+        self.seconds = 0.0
+
+    def add(self,name,function,dependsOn=()):
+        """
+        :param function: called without arguments
+        :param dependsOn: names of tasks that have to be done before the task starts
+        """
+        if name in self.tasks:
+            raise ValueError(f"Task {name} was added twice.")
+        self.tasks[name] = (function, tuple(dependsOn))
+
+    def order(self):
+        #topological order of the tasks, fails on unknown dependencies and cycles
+        ordered = []
+        state = {}
+        def visit(name,path):
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise ValueError(f"Task dependencies form a cycle: {' -> '.join(path + [name])}")
+            if name not in self.tasks:
+                raise ValueError(f"Task {path[-1]} depends on the unknown task {name}.")
+            state[name] = "visiting"
+            for dependency in self.tasks[name][1]:
+                visit(dependency, path + [name])
+            state[name] = "done"
+            ordered.append(name)
+        for name in self.tasks:
+            visit(name, [])
+        return ordered
+
+    def runTask(self,name,start):
+        function, _ = self.tasks[name]
+        self.results[name] = {"status": None, "start": time.perf_counter() - start, "end": None, "error": None}
+        with self.metrics.stage(name,self.dataParser):
+            function()
+
+    def run(self,maxWorkers:int=4):
+        """
+        :param maxWorkers: amount of tasks running at the same time, 1 runs them one after another
+        :return: dictionary of task name to its result, the first exception of a failed task is raised after all other tasks ended
+        """
+        order = self.order()
+        self.results = {}
+        start = time.perf_counter()
+        remaining = list(order)
+        firstError = None
+        with ThreadPoolExecutor(max_workers=max(1, maxWorkers)) as executor:
+            running = {}
+            while remaining or running:
+                for name in list(remaining):
+                    dependencies = [self.results.get(dependency, {}).get("status") for dependency in self.tasks[name][1]]
+                    if any(status in (TASK_FAILED, TASK_SKIPPED) for status in dependencies):
+                        remaining.remove(name)
+                        self.results[name] = {"status": TASK_SKIPPED, "start": None, "end": None, "error": None}
+                        print(f"Skipping {name}, a task it depends on failed.")
+                    elif all(status == TASK_DONE for status in dependencies):
+                        remaining.remove(name)
+                        running[executor.submit(self.runTask, name, start)] = name
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    result = self.results[name]
+                    result["end"] = time.perf_counter() - start
+                    try:
+                        future.result()
+                        result["status"] = TASK_DONE
+                    except Exception as e:
+                        result["status"] = TASK_FAILED
+                        result["error"] = repr(e)
+                        print(f"Task {name} failed: {e}")
+                        firstError = firstError or e
+        self.seconds = time.perf_counter() - start
+        self.metrics.recordTasks(self.report())
+        if firstError is not None:
+            raise firstError
+        return self.results
+
+    def criticalPath(self):
+        """
+        Chain of dependent tasks with the longest total duration, it bounds the wall time of the run
+        no matter how many tasks run at the same time.
+
+        :return: list of task names from the first to the last task of the chain
+        """
+        finish = {}
+        previous = {}
+        for name in self.order():
+            result = self.results.get(name)
+            if result is None or result["end"] is None:
+                continue
+            dependencies = [dependency for dependency in self.tasks[name][1] if dependency in finish]
+            longest = max(dependencies, key=lambda dependency: finish[dependency], default=None)
+            finish[name] = (result["end"] - result["start"]) + (finish[longest] if longest is not None else 0.0)
+            previous[name] = longest
+        if not finish:
+            return []
+        name = max(finish, key=finish.get)
+        path = []
+        while name is not None:
+            path.append(name)
+            name = previous[name]
+        return path[::-1]
+
+    def report(self):
+        path = self.criticalPath()
+        tasks = []
+        for name in self.order():
+            result = self.results.get(name, {"status": None, "start": None, "end": None, "error": None})
+            seconds = result["end"] - result["start"] if result["end"] is not None else None
+            tasks.append({"task": name, "dependsOn": list(self.tasks[name][1]), **result, "seconds": seconds, "critical": name in path})
+        return {
+            "seconds": self.seconds,
+            "taskSeconds": sum(task["seconds"] or 0.0 for task in tasks),
+            "criticalPath": path,
+            "criticalPathSeconds": sum(task["seconds"] for task in tasks if task["critical"]),
+            "tasks": tasks
+        }
+
+    def printReport(self):
+        report = self.report()
+        for task in report["tasks"]:
+            if task["seconds"] is None:
+                print(f"{task['task']}: {task['status']}")
+                continue
+            marker = " *" if task["critical"] else ""
+            print(f"{task['task']}: {task['start']:.2f}s - {task['end']:.2f}s ({task['seconds']:.2f}s) {task['status']}{marker}")
+        print(f"Wall time {report['seconds']:.2f}s for {report['taskSeconds']:.2f}s of tasks, critical path ({report['criticalPathSeconds']:.2f}s): {' -> '.join(report['criticalPath'])}")
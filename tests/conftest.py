@@ -0,0 +1,38 @@
+import os
+import sys
+import pytest
+
+#the modules of the project are imported from the repository root, like main.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+import main
+
+#throwaway database next to the configured one, dropped after the tests
+TEST_DATABASE = "airQualityTest"
+
+def adminConnection():
+    conn = psycopg2.connect(**main.db_params, connect_timeout=3)
+    conn.autocommit = True
+    return conn
+
+@pytest.fixture(scope="session")
+def testParams():
+    """
+    Connection parameters of a test database with the schema of main.py, the tests are skipped without a local postgres.
+    """
+    try:
+        conn = adminConnection()
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"No local postgres: {e}")
+    with conn.cursor() as cur:
+        cur.execute(f'DROP DATABASE IF EXISTS "{TEST_DATABASE}"')
+        cur.execute(f'CREATE DATABASE "{TEST_DATABASE}"')
+    conn.close()
+    params = {**main.db_params, "dbname": TEST_DATABASE}
+    main.create_database_schema(params=params)
+    yield params
+    conn = adminConnection()
+    with conn.cursor() as cur:
+        cur.execute(f'DROP DATABASE IF EXISTS "{TEST_DATABASE}" WITH (FORCE)')
+    conn.close()
@@ -0,0 +1,68 @@
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class FakeEEAServer:
+    """
+    Local stand-in for the EEA download API. Every path answers with the responses queued for it,
+    the last response of a path is repeated. Requests are recorded with their time and json body.
+    """
+    def __init__(self):
+        self.responses = {}
+        self.requests = []
+        self.lock = threading.Lock()
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self,*args):
+                pass
+
+            def do_GET(self):
+                server.handle(self, None)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                server.handle(self, json.loads(self.rfile.read(length) or b"null"))
+        self.httpServer = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpServer.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpServer.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self,*args):
+        self.httpServer.shutdown()
+        self.httpServer.server_close()
+
+    def respond(self,path,*responses):
+        """
+        :param responses: (status, body, headers) tuples or functions of the json request returning one,
+            a body can also be a function of the json request
+        """
+        self.responses[path] = list(responses)
+
+    def handle(self,handler,body):
+        with self.lock:
+            self.requests.append((handler.path, body, time.monotonic()))
+            queued = self.responses.get(handler.path)
+            if not queued:
+                response = (404, b"", {})
+            else:
+                response = queued.pop(0) if len(queued) > 1 else queued[0]
+        status, content, headers = response(body) if callable(response) else response
+        if callable(content):
+            content = content(body)
+        if not isinstance(content, bytes):
+            content = json.dumps(content).encode("utf-8")
+        handler.send_response(status)
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.send_header("Content-Length", str(len(content)))
+        handler.end_headers()
+        handler.wfile.write(content)
+
+    def paths(self):
+        return [path for path, _, _ in self.requests]
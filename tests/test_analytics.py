@@ -0,0 +1,45 @@
+import numpy as np
+from analytics import Analytics, pairwiseCorrelation, correlateWith
+from sqlDataParser import DataParser
+
+def sampleColumns(rows=40,seed=0):
+    rng = np.random.default_rng(seed)
+    base = rng.normal(size=rows)
+    related = 0.9 * base + 0.44 * rng.normal(size=rows)
+    return base, related
+
+def test_constant_column_has_no_correlation():
+    base, _ = sampleColumns()
+    matrix = np.column_stack([base, np.full(len(base), 0.1)])
+    correlation, count = pairwiseCorrelation(matrix)
+    assert np.isnan(correlation[1, 1]) and np.isnan(correlation[0, 1]) and np.isnan(correlation[1, 0])
+    assert np.isclose(correlation[0, 0], 1.0)
+    assert count[0, 1] == len(base)
+    correlation, _ = correlateWith(matrix, base)
+    assert np.isclose(correlation[0], 1.0) and np.isnan(correlation[1])
+    correlation, _ = correlateWith(matrix, np.full(len(base), 0.1))
+    assert np.isnan(correlation).all()
+
+def test_large_mean_keeps_its_digits():
+    base, related = sampleColumns()
+    matrix = np.column_stack([base, 1e9 + 10 * related])
+    #missing values in different rows, every pair is based on its own rows
+    matrix[3, 0] = np.nan
+    matrix[7, 1] = np.nan
+    shared = np.delete(np.arange(len(base)), [3, 7])
+    expected = np.corrcoef(base[shared], related[shared])[0, 1]
+    correlation, count = pairwiseCorrelation(matrix)
+    assert count[0, 1] == len(base) - 2
+    assert np.isclose(correlation[0, 1], expected, atol=1e-9)
+    assert np.isclose(correlation[1, 1], 1.0, atol=1e-9)
+    correlation, _ = correlateWith(matrix[:, 1:], base)
+    assert np.isclose(correlation[0], np.corrcoef(np.delete(base, 7), np.delete(related, 7))[0, 1], atol=1e-9)
+
+def test_panel_options_given_as_lists_are_cached(testParams):
+    analytics = Analytics(DataParser.fromParams(testParams,testConnection=False))
+    first = analytics.correlations(pollutants=["NO2", "PM10"])
+    #the same pollutants in another order and as a tuple are the same cached result
+    assert analytics.correlations(pollutants=("PM10", "NO2")) is first
+    lagged = analytics.lagCorrelations("gdp", "respiratoryRate", lags=[0, 1], pollutants=["NO2"])
+    assert analytics.lagCorrelations("gdp", "respiratoryRate", lags=[0, 1], pollutants=("NO2",)) is lagged
+    assert analytics.cache.hits == 2
@@ -0,0 +1,31 @@
+import os
+import pytest
+from AirQuality.catalogCache import CatalogCache
+from AirQuality.eeaClient import EEAClient
+from fakeEEAServer import FakeEEAServer
+
+COUNTRIES = [{"countryCode": "AT", "countryName": "Austria"}, {"countryCode": "DE", "countryName": "Germany"}]
+
+def cities(body):
+    #the cities of DE fail on every attempt
+    if body == ["DE"]:
+        return (500, b"", {})
+    return (200, [{"cityName": "Wien"}], {})
+
+def test_listing_with_failed_country_is_not_cached(tmp_path):
+    cache = CatalogCache(str(tmp_path))
+    with FakeEEAServer() as server:
+        server.respond("/Country", (200, COUNTRIES, {}))
+        server.respond("/City", cities)
+        client = EEAClient(baseUrl=server.url, requestsPerSecond=0, retries=1, backoffFactor=0.01)
+        with pytest.raises(Exception, match="DE"):
+            cache.getCountryCityData(client.fetchCountryCityData)
+    assert not os.path.exists(os.path.join(str(tmp_path), "countryCity.json"))
+
+def test_url_manifests_are_cached_per_aggregation(tmp_path):
+    cache = CatalogCache(str(tmp_path))
+    cache.storeUrlManifest("AT", "Wien", 2, b"day", "day")
+    cache.storeUrlManifest("AT", "Wien", 2, b"hour", "hour")
+    assert cache.loadUrlManifest("AT", "Wien", 2) == (True, b"day")
+    assert cache.getUrlManifest("AT", "Wien", 2, None, "hour") == b"hour"
+    assert cache.loadUrlManifest("AT", "Wien", 2, "var") == (False, None)
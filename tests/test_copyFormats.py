@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+from sqlDataParser import DataParser
+
+TABLE = "copyRoundTrip"
+COLUMNS = '"name", "day", "small", "large", "ratio", "counted"'
+
+def sampleFrame():
+    #NULLs and empty strings in the text column, a float column with a missing value targets the bigint column
+    return pd.DataFrame({
+        "name": ["Wien", "", None, "a,b \"quoted\""],
+        "day": pd.to_datetime(["2020-01-01", None, "1999-12-31", "2024-02-29"]),
+        "small": np.array([1, -2, 3, 2147483647], dtype=np.int32),
+        "large": np.array([1 << 40, -1, 0, 9007199254740993], dtype=np.int64),
+        "ratio": [0.1, np.nan, -1e300, 2.5],
+        "counted": [1099511627776.0, np.nan, 3.0, 0.0]
+    })
+
+@pytest.fixture
+def copyTable(testParams):
+    parser = DataParser.fromParams(testParams,testConnection=False)
+    parser.executeScript(f'''
+        DROP TABLE IF EXISTS "{TABLE}";
+        CREATE TABLE "{TABLE}" ("row" SERIAL, "name" TEXT, "day" DATE, "small" INT, "large" BIGINT, "ratio" DOUBLE PRECISION, "counted" BIGINT);
+    ''')
+    yield testParams
+    parser.close()
+
+def loadRows(params,frame,**options):
+    parser = DataParser.fromParams(params,testConnection=False,**options)
+    parser.execute(f'TRUNCATE "{TABLE}" RESTART IDENTITY')
+    assert parser.parsePandaDFToTable(frame,TABLE,reportRate=False) == len(frame)
+    rows = parser.makeCall(f'SELECT {COLUMNS} FROM "{TABLE}" ORDER BY "row"')
+    parser.close()
+    return [tuple(row) for row in rows]
+
+def test_copy_formats_load_the_same_rows(copyTable):
+    frame = sampleFrame()
+    expected = loadRows(copyTable, frame, loadMethod="insert")
+    assert expected[1][0] == "" and expected[2][0] is None
+    assert expected[0][5] == 1099511627776 and expected[1][5] is None
+    assert loadRows(copyTable, frame, copyFormat="text") == expected
+    assert loadRows(copyTable, frame, copyFormat="binary") == expected
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    assert loadRows(copyTable, table, copyFormat="text") == expected
+    assert loadRows(copyTable, table, copyFormat="binary") == expected
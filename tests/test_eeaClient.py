@@ -0,0 +1,48 @@
+import time
+import pytest
+from AirQuality.eeaClient import EEAClient
+from fakeEEAServer import FakeEEAServer
+
+URLS_CSV = b"ParquetFileUrl\r\nhttps://example.org/SPO.1.parquet\r\n"
+
+def client(server,**kwargs):
+    options = {"requestsPerSecond": 0, "retries": 3, "backoffFactor": 0.1, "timeout": 5}
+    options.update(kwargs)
+    return EEAClient(baseUrl=server.url, **options)
+
+def test_retries_server_errors_with_backoff():
+    with FakeEEAServer() as server:
+        countries = [{"countryCode": "AT", "countryName": "Austria"}]
+        server.respond("/Country", (503, b"", {}), (502, b"", {}), (200, countries, {}))
+        assert client(server).fetchCountries() == countries
+        times = [requestTime for _, _, requestTime in server.requests]
+    assert len(times) == 3
+    #the second retry waits backoffFactor * 2 seconds
+    assert times[2] - times[1] >= 0.15
+
+def test_respects_retry_after():
+    with FakeEEAServer() as server:
+        server.respond("/Country", (429, b"", {"Retry-After": "1"}), (200, [], {}))
+        start = time.monotonic()
+        assert client(server).fetchCountries() == []
+    assert time.monotonic() - start >= 0.9
+    assert len(server.requests) == 2
+
+def test_gives_up_after_retries():
+    with FakeEEAServer() as server:
+        server.respond("/Country", (500, b"", {}))
+        with pytest.raises(Exception, match="500"):
+            client(server, retries=2, backoffFactor=0.01).fetchCountries()
+    assert len(server.requests) == 3
+
+def test_falls_back_to_hourly_data():
+    with FakeEEAServer() as server:
+        server.respond("/ParquetFile/urls", (200, lambda body: b"ParquetFileUrl\r\n" if body["aggregationType"] == "day" else URLS_CSV, {}))
+        assert client(server).fetchParquetUrls("AT", "Wien", 2) == URLS_CSV
+        assert [body["aggregationType"] for _, body, _ in server.requests] == ["day", "hour"]
+
+def test_no_hourly_fallback_for_dataset_3():
+    with FakeEEAServer() as server:
+        server.respond("/ParquetFile/urls", (200, b"ParquetFileUrl\r\n", {}))
+        assert client(server).fetchParquetUrls("AT", "Wien", 3) is None
+        assert [body["aggregationType"] for _, body, _ in server.requests] == ["day"]
@@ -0,0 +1,55 @@
+import os
+from sqlDataParser import DataParser
+from taskGraph import POOL_CONTEXT
+from workLease import WorkLeases
+
+JOB = "test:shards"
+SHARDS = 20
+
+def runWorker(params,workerId,timeZone,outputPath,dies):
+    """
+    Worker process claiming three shards at a time and writing the processed shard keys to outputPath.
+
+    :param timeZone: session time zone of the worker, leases have to expire at the same instant for every worker
+    :param dies: the worker exits while it holds its first claim
+    """
+    os.environ["PGTZ"] = timeZone
+    leases = WorkLeases(DataParser.fromParams(params,testConnection=False),workerId=workerId,leaseSeconds=2)
+    def process(shards):
+        with open(outputPath, "a") as output:
+            output.writelines(f"{shardKey}\n" for shardKey, _ in shards)
+        if dies:
+            os._exit(1)
+        return [shardKey for shardKey, payload in shards if payload["fails"]]
+    leases.runShards(JOB,process,pollSeconds=0.1,limit=3)
+
+def test_workers_share_shards(testParams,tmp_path):
+    leases = WorkLeases(DataParser.fromParams(testParams,testConnection=False),leaseSeconds=2,maxAttempts=3)
+    leases.publish(JOB, [(f"shard{i:02d}", {"fails": i == 0}) for i in range(SHARDS)])
+    #the dying worker runs 14 hours ahead of the others, its lease still expires after 2 seconds for them
+    workers = [("dying", "Pacific/Kiritimati", True)] + [(f"worker{i}", "UTC", False) for i in range(3)]
+    processes = []
+    for workerId, timeZone, dies in workers:
+        process = POOL_CONTEXT.Process(target=runWorker, args=(testParams, workerId, timeZone, str(tmp_path / workerId), dies))
+        process.start()
+        processes.append(process)
+        if dies:
+            #the dying worker claims its shards before the others start
+            process.join(timeout=60)
+    for process in processes[1:]:
+        process.join(timeout=60)
+    #workers still waiting for a lease that never expires are stopped before the assertions
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+            process.join()
+    assert [process.exitcode for process in processes[1:]] == [0, 0, 0]
+    outputs = {workerId: (tmp_path / workerId).read_text().split() for workerId, _, _ in workers if (tmp_path / workerId).exists()}
+    processed = [shardKey for workerId, shardKeys in outputs.items() if workerId != "dying" for shardKey in shardKeys]
+    #every shard is processed, the shards of the dying worker are taken over once its lease expired
+    assert set(processed) == {f"shard{i:02d}" for i in range(SHARDS)}
+    assert set(outputs["dying"]) <= set(processed)
+    #every other shard is processed once by the survivors, the failing shard is retried until it reached maxAttempts
+    assert all(processed.count(shardKey) == 1 for shardKey in set(processed) - {"shard00"})
+    assert processed.count("shard00") == 2
+    assert leases.counts(JOB) == {"done": SHARDS - 1, "givenUp": 1}
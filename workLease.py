@@ -0,0 +1,206 @@
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from sqlDataParser import DataParser
+
+#statuses of a shard in the lease table
+SHARD_PENDING = "pending"
+SHARD_LEASED = "leased"
+SHARD_DONE = "done"
+SHARD_FAILED = "failed"
+
+PUBLISH_QUERY = """
+    INSERT INTO "workLease" ("job", "shardKey", "payload", "status")
+    VALUES (%(job)s, %(shardKey)s, %(payload)s, 'pending')
+    ON CONFLICT ("job", "shardKey") DO NOTHING
+"""
+
+#open shards are pending, failed with attempts left or leased by a worker whose lease expired,
+#SKIP LOCKED lets concurrent workers claim different shards without waiting for each other
+CLAIM_QUERY = """
+    UPDATE "workLease" SET
+        "status" = 'leased',
+        "owner" = %(owner)s,
+        "leaseUntil" = now() + make_interval(secs => %(leaseSeconds)s),
+        "heartbeatAt" = now(),
+        "attempts" = "attempts" + 1,
+        "updatedAt" = now()
+    WHERE ("job", "shardKey") IN (
+        SELECT "job", "shardKey" FROM "workLease"
+        WHERE "job" = %(job)s
+            AND "attempts" < %(maxAttempts)s
+            AND ("status" IN ('pending', 'failed') OR ("status" = 'leased' AND "leaseUntil" < now()))
+        ORDER BY "attempts", "shardKey"
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING "shardKey", "payload", "attempts"
+"""
+
+HEARTBEAT_QUERY = """
+    UPDATE "workLease" SET "leaseUntil" = now() + make_interval(secs => %(leaseSeconds)s), "heartbeatAt" = now()
+    WHERE "owner" = %(owner)s AND "status" = 'leased'
+"""
+
+#a worker only finishes shards it still holds, a shard reassigned after its lease expired belongs to the new worker
+FINISH_QUERY = """
+    UPDATE "workLease" SET "status" = %(status)s, "leaseUntil" = NULL, "updatedAt" = now()
+    WHERE "job" = %(job)s AND "shardKey" = %(shardKey)s AND "owner" = %(owner)s AND "status" = 'leased'
+    RETURNING "shardKey"
+"""
+
+#expired leases and failed shards without attempts left are given up, nobody claims them anymore
+COUNT_QUERY = """
+    SELECT
+        CASE
+            WHEN "attempts" >= %(maxAttempts)s AND ("status" = 'failed' OR ("status" = 'leased' AND "leaseUntil" < now())) THEN 'givenUp'
+            WHEN "status" = 'leased' AND "leaseUntil" < now() THEN 'expired'
+            ELSE "status"
+        END,
+        count(*)
+    FROM "workLease" WHERE "job" = %(job)s
+    GROUP BY 1
+"""
+
+def defaultWorkerId():
+    #unique per process, several workers may run on one machine
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+class WorkLeases:
+    """
+    Shards of a job in the "workLease" table of the target database, claimed by workers on any number of machines.
+    A claimed shard is leased for leaseSeconds and kept alive by heartbeats, shards of a worker that died are
+    claimed again by another worker once their lease expired. Needs the postgres backend.
+    """
+    def __init__(self,dataParser:DataParser,workerId:str=None,leaseSeconds:float=300,maxAttempts:int=3):
+        """
+        :param workerId: name of this worker in the lease table, defaults to host name and process id
+        :param leaseSeconds: seconds a shard stays leased without a heartbeat
+        :param maxAttempts: claims of a shard before it is given up
+        """
+        if dataParser.backend != "postgres":
+            raise ValueError("Distributed loading needs the postgres backend, an embedded database has a single writer.")
+        self.dataParser = dataParser
+        self.workerId = workerId or defaultWorkerId()
+        self.leaseSeconds = leaseSeconds
+        self.maxAttempts = maxAttempts
+
+    def publish(self,job,shards):
+        """
+        Adds the shards of a job, shards published before keep their status.
+
+        :param shards: iterable of (shard key, payload dictionary)
+        """
+        for shardKey, payload in shards:
+            self.dataParser.execute(PUBLISH_QUERY, {"job": job, "shardKey": shardKey, "payload": json.dumps(payload)})
+
+    def claim(self,job,limit:int=1):
+        """
+        :return: list of (shard key, payload dictionary) leased to this worker, empty if no shard is open
+        """
+        rows = self.dataParser.execute(CLAIM_QUERY, {
+            "job": job,
+            "owner": self.workerId,
+            "leaseSeconds": self.leaseSeconds,
+            "maxAttempts": self.maxAttempts,
+            "limit": limit
+        })
+        return [(shardKey, json.loads(payload) if payload is not None else None) for shardKey, payload, _ in rows]
+
+    def finish(self,job,shardKey,failed:bool=False):
+        """
+        :param failed: failed shards are claimed again until they reach maxAttempts
+        :return: False if the lease expired and the shard belongs to another worker now
+        """
+        rows = self.dataParser.execute(FINISH_QUERY, {
+            "job": job,
+            "shardKey": shardKey,
+            "owner": self.workerId,
+            "status": SHARD_FAILED if failed else SHARD_DONE
+        })
+        return len(rows) > 0
+
+    def counts(self,job):
+        """
+        :return: dictionary of state (pending, leased, expired, failed, done, givenUp) to amount of shards
+        """
+        return dict(self.dataParser.execute(COUNT_QUERY, {"job": job, "maxAttempts": self.maxAttempts}))
+
+    def isDone(self,job):
+        #True once every shard of the job is done or given up
+        counts = self.counts(job)
+        return sum(counts.get(state, 0) for state in (SHARD_PENDING, SHARD_LEASED, SHARD_FAILED, "expired")) == 0
+
+    def renew(self):
+        self.dataParser.execute(HEARTBEAT_QUERY, {"owner": self.workerId, "leaseSeconds": self.leaseSeconds})
+
+    @contextmanager
+    def heartbeat(self,interval:float=None):
+        """
+        Renews every lease of this worker in a background thread while the block runs.
+
+        :param interval: seconds between heartbeats, defaults to a third of the lease
+        """
+        interval = interval or self.leaseSeconds / 3
+        stopped = threading.Event()
+        def beat():
+            while not stopped.wait(interval):
+                try:
+                    self.renew()
+                except Exception as e:
+                    #a missed heartbeat is retried, the lease only expires after leaseSeconds
+                    print(f"Heartbeat of {self.workerId} failed: {e}")
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def runShards(self,job,process,pollSeconds:float=5,limit:int=1):
+        """
+        Claims and processes up to limit shards of a job at a time until no shard is open or leased anymore.
+        While other workers still hold leases it waits, shards whose lease expires are taken over.
+
+        :param process: function called with the list of claimed (shard key, payload) pairs, returns the keys of the shards that failed
+        :return: amount of shards processed by this worker
+        """
+        processed = 0
+        with self.heartbeat():
+            while True:
+                claimed = self.claim(job, limit)
+                if not claimed:
+                    if self.isDone(job):
+                        return processed
+                    time.sleep(pollSeconds)
+                    continue
+                start = time.perf_counter()
+                try:
+                    failedKeys = set(process(claimed))
+                except Exception as e:
+                    print(f"Shards {', '.join(shardKey for shardKey, _ in claimed)} failed: {e}")
+                    failedKeys = {shardKey for shardKey, _ in claimed}
+                for shardKey, _ in claimed:
+                    if not self.finish(job, shardKey, shardKey in failedKeys):
+                        print(f"Lease of shard {shardKey} expired, it was reassigned to another worker.")
+                processed += len(claimed)
+                print(f"{len(claimed)} shards done, {len(failedKeys)} failed in {time.perf_counter() - start:.2f}s")
+
+    def runOnce(self,job,function,pollSeconds:float=5):
+        """
+        Runs function on exactly one of the workers calling runOnce with the same job, the others wait until it is done.
+        If the worker running it dies or it fails, another worker runs it again until maxAttempts is reached.
+
+        :raises RuntimeError: if function failed on every attempt
+        """
+        self.publish(job, [(job, None)])
+        def process(shards):
+            function()
+            return []
+        self.runShards(job, process, pollSeconds)
+        if self.counts(job).get("givenUp", 0) > 0:
+            raise RuntimeError(f"{job} failed on every attempt.")